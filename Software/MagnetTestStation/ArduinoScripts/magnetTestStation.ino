@@ -1,14 +1,33 @@
-#define MAX_STRING_LENGTH 10 // Maximum input string length
+#define MAX_STRING_LENGTH 32 // Maximum input string length
 #define DEFAULT_QUERY_STRING_LENGTH 7 // Default length of the query part of the input strings
+#define STREAM_QUERY_STRING_LENGTH 12 // Length of "STREAM:RATE:"
+#define COUNT_QUERY_STRING_LENGTH 7 // Length of "MEAS:N:"
+#define MAX_SAMPLE_COUNT 1000
+#define BAUD_RATE 115200
+
+// Binary stream frame, little endian:
+//   0xA5 0x5A | n channels (1 byte) | sequence (2 bytes) | timestamp in us (4 bytes) |
+//   n x ADC counts in 1/16 counts (2 bytes each) | Fletcher-16 checksum of the bytes after the sync word (2 bytes)
+// Every frame holds the mean of sample_count samples of each channel
+#define SYNC_0 0xA5
+#define SYNC_1 0x5A
+#define FRAME_SCALE 16
 
 short pins[] = {A0};
+#define N_PINS (sizeof(pins)/sizeof(pins[0]))
 char headers[4] = {'A', 'B', 'C', 'D'};
 int used_channels{0};
+int sample_count{1}; // Samples averaged per reading
+
+bool streaming{false};
+unsigned long stream_interval_us{10000}; // 100 Hz by default
+unsigned long next_frame_us{0};
+unsigned int frame_sequence{0};
 
 void setup() {
   // put your setup code here, to run once:
-  Serial.begin(9600);
-  for (int i=0; i<sizeof(pins); i++)
+  Serial.begin(BAUD_RATE);
+  for (unsigned int i=0; i<N_PINS; i++)
     pinMode(pins[i], INPUT);
 }
 
@@ -21,29 +40,67 @@ void loop() {
     String readSerialString{readString};
     if (readSerialString.equals("CH:AVA?\n"))
     {
-      Serial.println(sizeof(pins)-1);
+      Serial.println(N_PINS);
     }
     else if (readSerialString.substring(0, DEFAULT_QUERY_STRING_LENGTH).equals("CH:USE:"))
     {
-        used_channels = readSerialString.substring(DEFAULT_QUERY_STRING_LENGTH).toInt();
+        used_channels = min(readSerialString.substring(DEFAULT_QUERY_STRING_LENGTH).toInt(), (long)N_PINS);
         Serial.println(used_channels);
     }
     else if (readSerialString.equals("MEAS:ST\n"))
     {
       runMeasurement();
     }
+    else if (readSerialString.substring(0, COUNT_QUERY_STRING_LENGTH).equals("MEAS:N:"))
+    {
+      sample_count = constrain(readSerialString.substring(COUNT_QUERY_STRING_LENGTH).toInt(), 1, MAX_SAMPLE_COUNT);
+      Serial.println(sample_count);
+    }
+    else if (readSerialString.equals("MEAS:AVG\n"))
+    {
+      runAveragedMeasurement();
+    }
+    else if (readSerialString.substring(0, STREAM_QUERY_STRING_LENGTH).equals("STREAM:RATE:"))
+    {
+      // At most the frames the serial line carries (10 bits per byte), replies with the rate applied
+      long max_rate = BAUD_RATE / 10 / (9 + 2*used_channels + 2);
+      long rate = min(readSerialString.substring(STREAM_QUERY_STRING_LENGTH).toInt(), max_rate);
+      if (rate > 0)
+        stream_interval_us = 1000000UL / rate;
+      Serial.println(1000000UL / stream_interval_us);
+    }
+    else if (readSerialString.equals("STREAM:ON\n"))
+    {
+      // The reply line is sent before the first frame
+      Serial.println("OK");
+      frame_sequence = 0;
+      next_frame_us = micros();
+      streaming = true;
+    }
+    else if (readSerialString.equals("STREAM:OFF\n"))
+    {
+      streaming = false;
+      Serial.println("OK");
+    }
+  }
+  if (streaming && (long)(micros() - next_frame_us) >= 0)
+  {
+    next_frame_us += stream_interval_us;
+    sendFrame();
   }
 }
 
 void readSerial(char* readString, int length)
 {
   int i{0};
-  
-  while (Serial.available()>0 && i<length)
+
+  while (Serial.available()>0 && i<length-1)
   {
     readString[i] = Serial.read();
     i++;
-    delay(10);
+    if (readString[i-1] == '\n')
+      break;
+    delay(1);
   }
   // Serial.println(readString);
   return;
@@ -54,10 +111,74 @@ void runMeasurement()
   for (int i = 0; i<used_channels; i++)
   {
     Serial.print(headers[i]);
-    float fieldValue{analogRead(pins[i]) * 5. / 1023. - 2.5};
+    float fieldValue{averageCounts(pins[i], sample_count, NULL) * 5. / 1023. - 2.5};
     Serial.print(fieldValue,3);
     Serial.println();
-    delay(1000);
   }
   return;
 }
+
+float averageCounts(short pin, int count, float* std)
+{
+  // Mean and sample standard deviation of count readings (Welford)
+  float mean{0}, m2{0};
+  for (int k = 0; k<count; k++)
+  {
+    float x = analogRead(pin);
+    float delta = x - mean;
+    mean += delta / (k + 1);
+    m2 += delta * (x - mean);
+  }
+  if (std != NULL)
+    *std = count > 1 ? sqrt(m2 / (count - 1)) : 0;
+  return mean;
+}
+
+void runAveragedMeasurement()
+{
+  // One line for all channels: A<mean>,<std>;B<mean>,<std>... in V
+  for (int i = 0; i<used_channels; i++)
+  {
+    float std;
+    float mean = averageCounts(pins[i], sample_count, &std);
+    if (i > 0)
+      Serial.print(';');
+    Serial.print(headers[i]);
+    Serial.print(mean * 5. / 1023. - 2.5, 5);
+    Serial.print(',');
+    Serial.print(std * 5. / 1023., 5);
+  }
+  Serial.println();
+  return;
+}
+
+void sendFrame()
+{
+  byte frame[9 + 2*N_PINS + 2];
+  unsigned long timestamp{micros()};
+  int length{0};
+  frame[length++] = SYNC_0;
+  frame[length++] = SYNC_1;
+  frame[length++] = used_channels;
+  frame[length++] = frame_sequence & 0xFF;
+  frame[length++] = frame_sequence >> 8;
+  for (int k = 0; k<4; k++)
+    frame[length++] = (timestamp >> (8*k)) & 0xFF;
+  for (int i = 0; i<used_channels; i++)
+  {
+    unsigned int counts = averageCounts(pins[i], sample_count, NULL) * FRAME_SCALE + 0.5;
+    frame[length++] = counts & 0xFF;
+    frame[length++] = counts >> 8;
+  }
+  // Fletcher-16 of everything after the sync word
+  unsigned int sum1{0}, sum2{0};
+  for (int k = 2; k<length; k++)
+  {
+    sum1 = (sum1 + frame[k]) % 255;
+    sum2 = (sum2 + sum1) % 255;
+  }
+  frame[length++] = sum1;
+  frame[length++] = sum2;
+  Serial.write(frame, length);
+  frame_sequence++;
+}
@@ -2,6 +2,7 @@ import serial
 import string
 import numpy as np
 from time import sleep
+import sampleStream
 
 #TODO check headers compatibility with number of sensors declared...
 
@@ -20,8 +21,11 @@ class A1324LUA():
         self.n_sensors = n_sensors
         self.sensitivity = sensitivity
         self.ser = None
+        self.reader = None # StreamReader while streaming
+        self.sample_count = 1 # Samples averaged on the Arduino per reading
+        self.lastStd = None # Standard deviation of the samples of the last reading (mT)
 
-    def initialiseSerialCOM(self, baudrate=9600):
+    def initialiseSerialCOM(self, baudrate=115200):
         try:
             self.ser = serial.Serial(self.port)
             self.ser.baudrate = baudrate
@@ -53,9 +57,91 @@ class A1324LUA():
             return [False, str(e)]
     
     def close(self):
+        if self.reader is not None:
+            self.stopStream()
         self.ser.close()
 
+    def sampleBuffer(self):
+        """Ring buffer of streamed readings, or None when not streaming"""
+        return None if self.reader is None else self.reader.buffer
+
+    def streamError(self):
+        return None if self.reader is None else self.reader.error
+
+    def startStream(self, rate, capacity=100000):
+        """Start the continuous stream of binary frames at rate (Hz)
+
+        A StreamReader thread parses the frames into the ring buffer
+        self.reader.buffer, in mT
+        """
+        try:
+            self.ser.reset_input_buffer()
+            self.ser.write(f"STREAM:RATE:{int(rate)}\n".encode())
+            reply = self.ser.readline().decode().strip()
+            if not reply.isdigit():
+                raise Exception(f"Error in setting the stream rate: {reply}")
+            self.ser.write("STREAM:ON\n".encode())
+            if self.ser.readline().decode().strip() != "OK":
+                raise Exception("The station did not start streaming")
+            # Short reads keep the reader thread responsive to stop()
+            self.ser.timeout = 0.1
+            self.reader = sampleStream.StreamReader(self.ser, self.n_sensors, self.sensitivity, capacity)
+            self.reader.start()
+            return [True, int(reply)]
+        except Exception as e:
+            return [False, str(e)]
+
+    def stopStream(self):
+        try:
+            self.reader.stop()
+            self.ser.write("STREAM:OFF\n".encode())
+            sleep(0.1)
+            self.ser.reset_input_buffer()
+            self.ser.timeout = 2
+            return [True, None]
+        except Exception as e:
+            return [False, str(e)]
+        finally:
+            self.reader = None
+
+    def setSampleCount(self, sample_count):
+        """Number of samples the Arduino averages for each reading and stream frame"""
+        try:
+            self.ser.write(f"MEAS:N:{int(sample_count)}\n".encode())
+            reply = self.ser.readline().decode().strip()
+            if int(reply) != sample_count:
+                raise Exception(f"The station averages {reply} samples instead of {sample_count}")
+            self.sample_count = sample_count
+            return [True, self.sample_count]
+        except Exception as e:
+            return [False, str(e)]
+
+    def measureStatistics(self):
+        """Mean and standard deviation (mT) of sample_count samples of every
+        sensor, averaged on the Arduino and returned in a single reply
+        """
+        try:
+            headers = list(string.ascii_uppercase)
+            means = np.zeros(self.n_sensors)
+            stds = np.zeros(self.n_sensors)
+            self.ser.reset_input_buffer()
+            self.ser.write("MEAS:AVG\n".encode())
+            data = self.ser.readline().decode().strip()
+            for field in data.split(';'): # e.g. A-0.12345,0.00210
+                mean, std = field[1:].split(',')
+                means[headers.index(field[0])] = float(mean) * self.sensitivity
+                stds[headers.index(field[0])] = float(std) * self.sensitivity
+            self.lastStd = stds
+            return [True, means, stds]
+        except Exception as e:
+            return [False, str(e)]
+
     def startMeasure(self):
+        res = self.measureStatistics()
+        return res[:2]
+
+    def startSingleMeasure(self):
+        """Reading with MEAS:ST, one line per sensor"""
         try:
             self.ser.reset_input_buffer()
             sleep(0.1)
@@ -0,0 +1,143 @@
+import time
+import numpy as np
+
+EMPTY, SETTLING, CAPTURED = 0, 1, 2
+
+class AutoCapture():
+    """Detects magnets placed on the test stations in the sample stream and
+    captures one stable reading of each
+
+    Every channel goes through three states. EMPTY: a sample further than
+    insert_threshold from the zero means a magnet is being inserted. SETTLING:
+    the first window of samples after the insertion with a standard deviation
+    below settle_std, and halves whose means differ by less than settle_drift
+    (the reading is no longer creeping), is the reading of the magnet.
+    CAPTURED: the station waits for a sample within release_threshold of the
+    zero, the magnet removed. While a station is empty, every stable window
+    moves its zero to the window mean, following the drift of the sensor.
+
+    The rolling windows are computed with cumulative sums over the chunks given
+    to process, so kHz streams of many channels are handled in numpy. Every
+    channel is windowed over its own samples, NaN samples are skipped.
+    """
+
+    def __init__(self, n_channels, zeros=None, window=64, settle_std=0.1, settle_drift=0.02, insert_threshold=2.,
+                 release_threshold=None, rate_window=600.):
+        """
+
+        Args:
+            n_channels (int): number of stations
+            zeros (array): initial zero of every station in mT
+            window (int): samples in the window a reading is averaged over
+            settle_std (float): mT, standard deviation of a settled window
+            settle_drift (float): mT, difference of the means of the halves of a settled window
+            insert_threshold (float): mT from the zero that means a magnet is in
+            release_threshold (float): mT from the zero that means the magnet is
+                out, insert_threshold / 2 by default
+            rate_window (float): s over which the magnets per hour are counted
+        """
+        self.n_channels = n_channels
+        self.zeros = np.zeros(n_channels) if zeros is None else np.array(zeros, dtype=float)
+        self.window = window
+        self.settle_std = settle_std
+        self.settle_drift = settle_drift
+        self.insert_threshold = insert_threshold
+        self.release_threshold = insert_threshold / 2. if release_threshold is None else release_threshold
+        self.rate_window = rate_window
+        self.state = np.full(n_channels, EMPTY)
+        self.settleStart = np.zeros(n_channels, dtype=np.int64) # Sample number of the insertion
+        self.history = [np.zeros(0) for _ in range(n_channels)] # Last window - 1 samples of every channel
+        self.total = np.zeros(n_channels, dtype=np.int64) # Samples of every channel so far
+        self.startTime = time.time()
+        self.captureTimes = [[] for _ in range(n_channels)]
+
+    def rollingStats(self, c, values):
+        """Mean, standard deviation and drift (mean of the second half minus the
+        first) of the window of channel c ending at every sample of values, inf
+        std where fewer than window samples have been seen
+        """
+        data = np.concatenate((self.history[c], values)) - self.zeros[c]
+        sums = np.concatenate(([0.], np.cumsum(data)))
+        squares = np.concatenate(([0.], np.cumsum(data * data)))
+        n = len(values)
+        end = np.arange(len(self.history[c]) + 1, len(data) + 1)
+        start = np.maximum(end - self.window, 0)
+        count = end - start
+        mean = (sums[end] - sums[start]) / count
+        std = np.sqrt(np.maximum((squares[end] - squares[start]) / count - mean * mean, 0))
+        std[count < self.window] = np.inf
+        middle = np.maximum(end - self.window // 2, 0)
+        drift = ((sums[end] - sums[middle]) - (sums[middle] - sums[start])) / count * 2
+        return mean[-n:] + self.zeros[c], std[-n:], drift[-n:]
+
+    def process(self, timestamps, values):
+        """Feed a chunk of samples of shape (k, n_channels). NaN samples (the
+        channels a frame of another port does not cover) are skipped, so every
+        channel is windowed over its own samples. Returns the captures as a list
+        of (channel, timestamp, reading, zero) in mT, in time order
+        """
+        timestamps = np.asarray(timestamps, dtype=float)
+        values = np.asarray(values, dtype=float)
+        captures = []
+        for c in range(self.n_channels):
+            valid = np.isfinite(values[:, c])
+            captures += self.processChannel(c, timestamps[valid], values[valid, c])
+        return sorted(captures, key=lambda capture: capture[1])
+
+    def processChannel(self, c, timestamps, values):
+        """Run the state machine of channel c over its samples values (k,)"""
+        if len(values) == 0:
+            return []
+        mean, std, drift = self.rollingStats(c, values)
+        stable = (std < self.settle_std) & (np.abs(drift) < self.settle_drift)
+        captures = []
+        i = 0
+        while i < len(values):
+            if self.state[c] == EMPTY:
+                inserted = np.flatnonzero(np.abs(values[i:] - self.zeros[c]) > self.insert_threshold)
+                end = i + inserted[0] if len(inserted) else len(values)
+                # Re-zero on the last stable window of the empty station
+                empty = np.flatnonzero(stable[i:end])
+                if len(empty):
+                    self.zeros[c] = mean[i + empty[-1]]
+                if not len(inserted):
+                    break
+                self.state[c] = SETTLING
+                self.settleStart[c] = self.total[c] + end
+                i = end
+            elif self.state[c] == SETTLING:
+                # Windows that start after the insertion and are off the zero
+                after = self.total[c] + np.arange(i, len(values)) - self.window + 1 >= self.settleStart[c]
+                settled = np.flatnonzero(stable[i:] & after & (np.abs(mean[i:] - self.zeros[c]) > self.insert_threshold))
+                removed = np.flatnonzero(np.abs(values[i:] - self.zeros[c]) < self.release_threshold)
+                if len(removed) and (not len(settled) or removed[0] < settled[0]):
+                    # Taken out before it settled
+                    self.state[c] = EMPTY
+                    i += removed[0]
+                elif len(settled):
+                    j = i + settled[0]
+                    captures.append((c, timestamps[j], mean[j], self.zeros[c]))
+                    self.captureTimes[c].append(timestamps[j])
+                    self.state[c] = CAPTURED
+                    i = j + 1
+                else:
+                    break
+            else:
+                removed = np.flatnonzero(np.abs(values[i:] - self.zeros[c]) < self.release_threshold)
+                if not len(removed):
+                    break
+                self.state[c] = EMPTY
+                i += removed[0]
+        if self.window > 1:
+            self.history[c] = np.concatenate((self.history[c], values))[-(self.window - 1):]
+        self.total[c] += len(values)
+        return captures
+
+    def magnetCounts(self):
+        return [len(times) for times in self.captureTimes]
+
+    def magnetsPerHour(self, now=None):
+        """Magnets captured per hour on every station over the last rate_window s"""
+        now = time.time() if now is None else now
+        span = max(min(self.rate_window, now - self.startTime), 1.)
+        return [3600. * np.sum(np.array(times) > now - span) / span for times in self.captureTimes]
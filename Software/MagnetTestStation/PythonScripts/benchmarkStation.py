@@ -0,0 +1,112 @@
+"""
+Throughput and latency of the test station protocol against simulated stations
+
+Runs StationSimulator on pseudo-terminals and reports, for the polled
+(MEAS:AVG) and streamed modes of A1324LUA and for StationDriver on several
+ports, the readings per second. For the streamed modes it also reports the
+latency from the time a sample is taken to the time a consumer waiting on the
+ring buffer (as MeasurementJob does) has it. The polled mode has no sample
+time, so its round trip from sending MEAS:AVG to having the reply is reported
+instead, an upper bound of the age of the reading. Linux only.
+"""
+import threading
+import time
+import numpy as np
+import a1324lua
+import stationDriver
+from stationSimulator import StationSimulator
+
+duration = 3 # s per test
+n_sensors = 4
+sample_counts = [1, 16]
+stream_rates = [100, 500, 1000]
+n_ports = 4
+# Impairments of the simulated link for the streaming tests
+drop = 0.
+garble = 0.
+
+def connect(simulator, n, sample_count):
+    station = a1324lua.A1324LUA(simulator.port, n, 20.)
+    res = station.initialiseSerialCOM()
+    if not res[0]:
+        raise Exception(res[1])
+    station.setSampleCount(sample_count)
+    return station
+
+def benchmarkPolled(sample_count):
+    simulator = StationSimulator(n_sensors)
+    simulator.start()
+    station = connect(simulator, n_sensors, sample_count)
+    round_trips = []
+    start = time.perf_counter()
+    while time.perf_counter() - start < duration:
+        t = time.perf_counter()
+        if station.startMeasure()[0]:
+            round_trips.append(time.perf_counter() - t)
+    station.close()
+    simulator.stop()
+    return len(round_trips) / duration, np.array(round_trips)
+
+def consume(buffer, simulator, latencies, stop_event):
+    """Wait on the ring buffer like MeasurementJob and record the age of every new sample"""
+    next_sample = buffer.total
+    while not stop_event.is_set():
+        total = buffer.waitFor(next_sample + 1, timeout=0.5)
+        if total > next_sample:
+            now = time.perf_counter() - simulator.start_time
+            _, timestamps, _ = buffer.read(next_sample, total)
+            latencies.extend(now - timestamps)
+            next_sample = total
+
+def benchmarkStream(rate, sample_count):
+    simulator = StationSimulator(n_sensors, drop=drop, garble=garble)
+    simulator.start()
+    station = connect(simulator, n_sensors, sample_count)
+    station.startStream(rate)
+    latencies = []
+    stop_event = threading.Event()
+    consumer = threading.Thread(target=consume, args=(station.sampleBuffer(), simulator, latencies, stop_event))
+    consumer.start()
+    time.sleep(duration)
+    stop_event.set()
+    consumer.join()
+    parser = station.reader.parser
+    received, dropped, bad = station.sampleBuffer().total, parser.droppedFrames, parser.badFrames
+    station.close()
+    simulator.stop()
+    return received / duration, dropped, bad, np.array(latencies)
+
+def benchmarkDriver(rate, sample_count):
+    simulators = [StationSimulator(n_sensors) for _ in range(n_ports)]
+    ports = [simulator.start() for simulator in simulators]
+    driver = stationDriver.StationDriver(ports, [n_sensors] * n_ports, 20., sample_count)
+    res = driver.initialiseSerialCOM()
+    if not res[0]:
+        raise Exception(res[1])
+    driver.startAcquisition(rate)
+    start = driver.buffer.total
+    time.sleep(duration)
+    rows = driver.buffer.total - start
+    driver.close()
+    for simulator in simulators:
+        simulator.stop()
+    return rows / duration
+
+def describe(latencies, name="latency"):
+    if len(latencies) == 0:
+        return "no readings"
+    return f"{name} median {np.median(latencies)*1e3:.2f} ms, 95% {np.percentile(latencies, 95)*1e3:.2f} ms"
+
+if __name__ == "__main__":
+    for sample_count in sample_counts:
+        rate, round_trips = benchmarkPolled(sample_count)
+        print(f"Polled, {sample_count} samples/reading: {rate:.1f} readings/s, {describe(round_trips, 'round trip')}")
+    for sample_count in sample_counts:
+        for stream_rate in stream_rates:
+            rate, dropped, bad, latencies = benchmarkStream(stream_rate, sample_count)
+            print(f"Stream at {stream_rate} Hz, {sample_count} samples/reading: {rate:.1f} readings/s, "
+                  f"{dropped} dropped, {bad} bad frames, {describe(latencies)}")
+    for stream_rate in [0] + stream_rates[:1]:
+        rows = benchmarkDriver(stream_rate, sample_counts[0])
+        mode = "polled" if stream_rate == 0 else f"stream at {stream_rate} Hz"
+        print(f"StationDriver, {n_ports} ports x {n_sensors} sensors, {mode}: {rows:.1f} rows/s")
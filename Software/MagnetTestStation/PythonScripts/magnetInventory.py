@@ -0,0 +1,191 @@
+import sqlite3
+import csv
+import time
+from datetime import datetime
+import numpy as np
+
+MU0 = 4e-7 * np.pi
+MAGNET_COLUMNS = ("magnet_id", "batch", "station", "timestamp", "field", "magnetization") # Columns of the magnets view
+
+def axialFieldFactor(magnet_size, sensor_distance):
+    """B/Br on the axis of a cube magnet of side magnet_size at sensor_distance
+    from its face (both in mm), for a uniformly magnetized cube
+    """
+    a = magnet_size / 2.
+    def term(z):
+        return np.arctan(a * a / (z * np.sqrt(2 * a * a + z * z)))
+    return (term(sensor_distance) - term(sensor_distance + magnet_size)) / np.pi
+
+class MagnetInventory():
+    """SQLite inventory of the magnets graded on the test station
+
+    Every stored reading is a row of the measurements table with the magnet ID,
+    batch, station, time, raw reading and zero (mT). The field at the sensor,
+    raw - zero, is converted to the magnetization of the magnet (A/m) with
+    axialFieldFactor for the magnet size and sensor distance of the inventory,
+    which are kept in its settings table. The view magnets holds the last
+    measurement of every magnet.
+    """
+
+    def __init__(self, fname, magnet_size=12., sensor_distance=15.):
+        """
+
+        Args:
+            fname (string): database file, created if it does not exist
+            magnet_size (float): side of the cube magnets in mm
+            sensor_distance (float): mm from the magnet face to the Hall element,
+                set by the spacer of the test station so that the field stays
+                within the +-50 mT range of the A1324LUA
+        """
+        self.db = sqlite3.connect(fname)
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS settings (key TEXT PRIMARY KEY, value REAL);
+            CREATE TABLE IF NOT EXISTS measurements (
+                id INTEGER PRIMARY KEY,
+                magnet_id TEXT NOT NULL,
+                batch TEXT,
+                station INTEGER,
+                timestamp REAL,
+                raw REAL,
+                zero REAL,
+                field REAL,
+                magnetization REAL);
+            CREATE INDEX IF NOT EXISTS measurements_magnet ON measurements (magnet_id, timestamp);
+            CREATE INDEX IF NOT EXISTS measurements_batch ON measurements (batch);
+            CREATE INDEX IF NOT EXISTS measurements_magnetization ON measurements (magnetization);
+            CREATE VIEW IF NOT EXISTS magnets AS
+                SELECT magnet_id, batch, station, timestamp, field, magnetization FROM measurements m
+                WHERE id = (SELECT id FROM measurements WHERE magnet_id = m.magnet_id ORDER BY timestamp DESC, id DESC LIMIT 1);
+        """)
+        settings = dict(self.db.execute("SELECT key, value FROM settings"))
+        if settings:
+            # An existing inventory keeps the geometry its magnetizations were computed with
+            magnet_size, sensor_distance = settings["magnet_size"], settings["sensor_distance"]
+        else:
+            self.db.executemany("INSERT INTO settings VALUES (?, ?)",
+                                [("magnet_size", magnet_size), ("sensor_distance", sensor_distance)])
+            self.db.commit()
+        self.magnet_size = magnet_size
+        self.sensor_distance = sensor_distance
+        self.factor = axialFieldFactor(magnet_size, sensor_distance)
+
+    def close(self):
+        self.db.close()
+
+    def magnetization(self, field):
+        """Magnetization (A/m) of a magnet that gives field (mT) at the sensor"""
+        return np.asarray(field) * 1e-3 / self.factor / MU0
+
+    def magnetCount(self, batch):
+        """Number of magnets of a batch"""
+        return self.db.execute("SELECT COUNT(DISTINCT magnet_id) FROM measurements WHERE batch = ?", (batch,)).fetchone()[0]
+
+    def nextMagnetId(self, batch):
+        """ID for the next magnet of a batch, e.g. B12-0042"""
+        return f"{batch}-{self.magnetCount(batch) + 1:04d}"
+
+    def addMeasurement(self, magnet_id, batch, station, raw, zero, timestamp=None):
+        """Store a reading of raw mT with the station zero, returns the magnetization"""
+        timestamp = time.time() if timestamp is None else timestamp
+        field = raw - zero
+        magnetization = float(self.magnetization(field))
+        self.db.execute("INSERT INTO measurements (magnet_id, batch, station, timestamp, raw, zero, field, magnetization) "
+                        "VALUES (?, ?, ?, ?, ?, ?, ?, ?)", (magnet_id, batch, station, timestamp, raw, zero, field, magnetization))
+        self.db.commit()
+        return magnetization
+
+    def importLog(self, fname, batch):
+        """Import a tab separated log of mainInterface.py (station, date, time,
+        B, zero). Every line is a new magnet of the batch, numbered on from
+        its last one as nextMagnetId does. Raises ValueError, importing
+        nothing, if an ID is already taken.
+        Returns the number of imported readings
+        """
+        first = self.magnetCount(batch) + 1
+        rows = []
+        with open(fname) as f:
+            reader = csv.reader(f, delimiter="\t")
+            next(reader) # Header
+            for line, (station, date, clock, field, zero) in enumerate(reader, start=1):
+                try:
+                    timestamp = datetime.strptime(f"{date} {clock}", "%a %b %d %Y %H:%M:%S").timestamp()
+                except ValueError:
+                    timestamp = None
+                field, zero = float(field), float(zero)
+                rows.append((f"{batch}-{first + line - 1:04d}", batch, int(station), timestamp, field + zero, zero, field))
+        taken = set(row[0] for row in self.db.execute("SELECT DISTINCT magnet_id FROM measurements"))
+        collisions = [row[0] for row in rows if row[0] in taken]
+        if collisions:
+            raise ValueError(f"Magnet IDs already in the inventory: {', '.join(collisions[:10])}"
+                             + (f" and {len(collisions) - 10} more" if len(collisions) > 10 else ""))
+        magnetization = self.magnetization([row[-1] for row in rows])
+        with self.db:
+            self.db.executemany("INSERT INTO measurements (magnet_id, batch, station, timestamp, raw, zero, field, magnetization) "
+                                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)", [row + (float(m),) for row, m in zip(rows, magnetization)])
+        return len(rows)
+
+    def magnets(self, batch=None, order="magnetization DESC", limit=None):
+        """Last measurement of every magnet (of a batch), sorted, as a list of
+        (magnet_id, batch, station, timestamp, field, magnetization). order is
+        a comma separated list of columns of MAGNET_COLUMNS, each optionally
+        followed by ASC or DESC. Raises ValueError for anything else
+        """
+        terms = [[word.upper() if i else word for i, word in enumerate(term.split())] for term in order.split(",")]
+        for term in terms:
+            if not (1 <= len(term) <= 2 and term[0] in MAGNET_COLUMNS and term[1:] in ([], ["ASC"], ["DESC"])):
+                raise ValueError(f"Invalid order {order!r}, expected columns of {', '.join(MAGNET_COLUMNS)} with ASC or DESC")
+        query = "SELECT * FROM magnets"
+        args = []
+        if batch is not None:
+            query += " WHERE batch = ?"
+            args.append(batch)
+        query += " ORDER BY " + ", ".join(" ".join(term) for term in terms)
+        if limit is not None:
+            query += " LIMIT ?"
+            args.append(limit)
+        return self.db.execute(query, args).fetchall()
+
+    def grades(self, n_grades, batch=None):
+        """Split the magnets into n_grades equal groups by magnetization, 1 the
+        strongest. Returns a list of (magnet_id, magnetization, grade)
+        """
+        query = "SELECT magnet_id, magnetization, NTILE(?) OVER (ORDER BY magnetization DESC) FROM magnets"
+        args = [n_grades]
+        if batch is not None:
+            query += " WHERE batch = ?"
+            args.append(batch)
+        return self.db.execute(query, args).fetchall()
+
+    def histogram(self, bins=20, batch=None):
+        """Counts of magnets per magnetization bin, as numpy.histogram"""
+        magnetization = np.array([row[5] for row in self.magnets(batch)])
+        return np.histogram(magnetization, bins)
+
+    def exportStrengthTable(self, fname, batch=None, n_grades=1):
+        """CSV of the magnets sorted by magnetization (A/m), strongest first,
+        read with np.genfromtxt(fname, delimiter=',', skip_header=1, usecols=(1,2,3))
+        """
+        rows = self.grades(n_grades, batch)
+        fields = dict((row[0], row[4]) for row in self.magnets(batch))
+        with open(fname, "w", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(["magnet_id", "field_mT", "magnetization_A_per_m", "grade"])
+            for magnet_id, magnetization, grade in rows:
+                writer.writerow([magnet_id, f"{fields[magnet_id]:.3f}", f"{magnetization:.1f}", grade])
+        return len(rows)
+
+if __name__ == "__main__":
+    # Import test station logs into an inventory and export the strength table
+    inventory_fname = "magnet_inventory.db"
+    logs = {} # e.g. {"log_batch1.txt": "B1"}
+    strength_fname = "magnet_strengths.csv"
+    n_grades = 4
+
+    inventory = MagnetInventory(inventory_fname)
+    for log_fname, batch in logs.items():
+        print(f"Imported {inventory.importLog(log_fname, batch)} readings from {log_fname}")
+    counts, edges = inventory.histogram()
+    for count, low, high in zip(counts, edges[:-1], edges[1:]):
+        print(f"{low:10.0f} - {high:10.0f} A/m: {count}")
+    print(f"Exported {inventory.exportStrengthTable(strength_fname, n_grades=n_grades)} magnets to {strength_fname}")
+    inventory.close()
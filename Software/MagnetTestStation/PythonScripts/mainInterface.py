@@ -1,13 +1,22 @@
 import sys
 import glob
 from PyQt6.QtWidgets import (QLineEdit, QPushButton, QApplication,
-    QVBoxLayout, QHBoxLayout, QDialog, QGroupBox, QLabel, QSpinBox,QDoubleSpinBox, QComboBox, QMessageBox)
-from PyQt6.QtCore import Qt, QSize, QThread, QTime, QDate
-import a1324lua
+    QVBoxLayout, QHBoxLayout, QGridLayout, QDialog, QGroupBox, QLabel, QSpinBox,QDoubleSpinBox, QListWidget,
+    QAbstractItemView, QMessageBox, QCheckBox)
+from PyQt6.QtCore import Qt, QSize, QThread, QTimer
+import stationDriver
 import measurementJob
+import magnetInventory
+import autoCapture
+import rollingTrace
 import numpy as np
 from functools import partial
-import os.path
+
+STATIONS_PER_PORT = 4 # Hall sensors per Arduino (headers A-D in the sketch)
+STATIONS_PER_ROW = 8
+FRAME_RATE = 20 # Display updates per second, whatever the sample rate
+TRACE_SECONDS = 10 # Length of the traces
+STATS_SECONDS = 1 # Mean and std shown are over this time
 
 class MainInterface(QDialog):
 
@@ -18,9 +27,15 @@ class MainInterface(QDialog):
         self.isRunning = False # True if a measurement is running
         self.serialObj = None # The serial instrument instance
         self.zeros = None # List of the zeros for the magentic field measurements
-        self.lastMeasured = None # List of last meauserd values
-        self.log = None # File handler of the log
-        self.measurementThread = QThread()
+        self.lastMeasured = None # List of last meauserd values, mean over STATS_SECONDS
+        self.trace = None # rollingTrace.TraceHistory of the stations
+        self.nextSample = 0 # Next sample of the stream to display
+        self.autoCapture = None # autoCapture.AutoCapture while automatic capture is on
+        self.log = None # MagnetInventory the stored results go to
+        self.measurementThread = None
+        self.displayTimer = QTimer(self)
+        self.displayTimer.setInterval(1000 // FRAME_RATE)
+        self.displayTimer.timeout.connect(self.refreshDisplay)
 
         self.setWindowTitle("Magnet Test Station - User Interface")
 
@@ -29,11 +44,15 @@ class MainInterface(QDialog):
         optionGroup = QGroupBox("Options")
         n_stations_label = QLabel("N° Stations:")
         sensitivity_label = QLabel("Sensitivity (mT/V):")
-        serialPort_label = QLabel("Serial Port:")
-        filename_label = QLabel("Log File:")
+        serialPort_label = QLabel("Serial Ports:")
+        filename_label = QLabel("Inventory File:")
+        batch_label = QLabel("Batch:")
+        streamRate_label = QLabel("Stream Rate (Hz):")
+        sampleCount_label = QLabel("Samples/Reading:")
+        captureThreshold_label = QLabel("Magnet Threshold (mT):")
         
         self.n_stations = QSpinBox()
-        self.n_stations.setRange(1,4)
+        self.n_stations.setRange(1,64)
         self.n_stations.valueChanged.connect(self.setMeasLayout)
 
         self.sensitivity = QDoubleSpinBox()
@@ -45,11 +64,37 @@ class MainInterface(QDialog):
         elif sys.platform.startswith('linux') or sys.platform.startswith('cygwin'):
             # this excludes your current terminal "
             ports = glob.glob('/dev/tty[A]*')
+        # Extra ports from the command line, e.g. the pty of stationSimulator.py
+        ports += sys.argv[1:]
 
-        self.serialPort = QComboBox()
+        # Stations are assigned STATIONS_PER_PORT at a time to the selected ports, in order
+        self.serialPort = QListWidget()
+        self.serialPort.setSelectionMode(QAbstractItemView.SelectionMode.MultiSelection)
+        self.serialPort.setMaximumHeight(80)
         [self.serialPort.addItem(r) for r in ports]
+        if self.serialPort.count() > 0:
+            self.serialPort.item(0).setSelected(True)
+
+        self.filename = QLineEdit("magnet_inventory.db")
+
+        # Stored magnets get the IDs <batch>-0001, <batch>-0002, ...
+        self.batch = QLineEdit("B1")
 
-        self.filename = QLineEdit()
+        # 0 reads the stations one at a time with MEAS:ST
+        self.streamRate = QSpinBox()
+        self.streamRate.setRange(0,1000)
+        self.streamRate.setValue(100)
+
+        # Samples averaged on the Arduino for every reading
+        self.sampleCount = QSpinBox()
+        self.sampleCount.setRange(1,1000)
+        self.sampleCount.setValue(16)
+
+        # Store one reading of every magnet once it has settled, and zero the empty stations
+        self.autoCaptureBox = QCheckBox("Auto Capture")
+        self.captureThreshold = QDoubleSpinBox()
+        self.captureThreshold.setRange(0.1,50.)
+        self.captureThreshold.setValue(2.)
 
         option_HLayout1 = QHBoxLayout()
         option_HLayout1.addWidget(n_stations_label)
@@ -66,6 +111,18 @@ class MainInterface(QDialog):
         option_HLayout4 = QHBoxLayout()
         option_HLayout4.addWidget(filename_label)
         option_HLayout4.addWidget(self.filename)
+        option_HLayout4.addWidget(batch_label)
+        option_HLayout4.addWidget(self.batch)
+        option_HLayout4.addWidget(streamRate_label)
+        option_HLayout4.addWidget(self.streamRate)
+        option_HLayout4.addWidget(sampleCount_label)
+        option_HLayout4.addWidget(self.sampleCount)
+
+        option_HLayout5 = QHBoxLayout()
+        option_HLayout5.addWidget(self.autoCaptureBox)
+        option_HLayout5.addWidget(captureThreshold_label)
+        option_HLayout5.addWidget(self.captureThreshold)
+        option_HLayout5.addStretch()
 
         option_HLayout = QHBoxLayout()
         option_HLayout.addLayout(option_HLayout1)
@@ -77,6 +134,7 @@ class MainInterface(QDialog):
         option_VLayout = QVBoxLayout()
         option_VLayout.addLayout(option_HLayout)
         option_VLayout.addLayout(option_HLayout4)
+        option_VLayout.addLayout(option_HLayout5)
 
         optionGroup.setLayout(option_VLayout)
 
@@ -105,15 +163,20 @@ class MainInterface(QDialog):
     def setMeasLayout(self):
         self.mainLayout.removeWidget(self.measGroup)
         self.measGroup = QGroupBox("Measurements")
-        meas_HLayout = QHBoxLayout()
+        meas_HLayout = QGridLayout()
         self.measResult_labels = []
         self.zero_buttons = []
         self.store_buttons = []
+        self.count_labels = []
+        self.trace_widgets = []
         for n in range(self.n_stations.value()):
             station_label = QLabel(f"Test Station {n+1}:")
             station_label.setAlignment(Qt.AlignmentFlag.AlignCenter)
             measResult_label = QLabel("--")
             measResult_label.setAlignment(Qt.AlignmentFlag.AlignCenter)
+            count_label = QLabel("")
+            count_label.setAlignment(Qt.AlignmentFlag.AlignCenter)
+            trace_widget = rollingTrace.TraceWidget(None, n)
             zero_button = QPushButton("Zero")
             zero_button.setFixedSize(QSize(100,50))
             zero_button.pressed.connect(partial(self.setZero,n))
@@ -124,16 +187,20 @@ class MainInterface(QDialog):
             store_button.setEnabled(False)
 
             self.measResult_labels.append(measResult_label)
+            self.count_labels.append(count_label)
+            self.trace_widgets.append(trace_widget)
             self.zero_buttons.append(zero_button)
             self.store_buttons.append(store_button)
 
             station_VLayout = QVBoxLayout()
             station_VLayout.addWidget(station_label)
             station_VLayout.addWidget(measResult_label)
+            station_VLayout.addWidget(count_label)
+            station_VLayout.addWidget(trace_widget)
             station_VLayout.addWidget(zero_button)
             station_VLayout.addWidget(store_button)
 
-            meas_HLayout.addLayout(station_VLayout)
+            meas_HLayout.addLayout(station_VLayout, n // STATIONS_PER_ROW, n % STATIONS_PER_ROW)
         
         self.measGroup.setLayout(meas_HLayout)
         
@@ -151,8 +218,19 @@ class MainInterface(QDialog):
     def serialConnection(self):
 
         if not self.isConnected:
-            self.serialObj = a1324lua.A1324LUA(str(self.serialPort.currentText()), self.n_stations.value(), self.sensitivity.value())
+            ports = [self.serialPort.item(i).text() for i in range(self.serialPort.count()) if self.serialPort.item(i).isSelected()]
+            n_stations = self.n_stations.value()
+            n_ports = -(-n_stations // STATIONS_PER_PORT)
+            if len(ports) < n_ports:
+                QMessageBox.critical(self, "Failure", f"{n_stations} stations need {n_ports} serial ports, "\
+                                     f"{len(ports)} are selected", QMessageBox.StandardButton.Ok)
+                return
+            n_sensors = [min(STATIONS_PER_PORT, n_stations - STATIONS_PER_PORT*i) for i in range(n_ports)]
+            self.serialObj = stationDriver.StationDriver(ports[:n_ports], n_sensors, self.sensitivity.value(), self.sampleCount.value())
             res = self.serialObj.initialiseSerialCOM()
+            if not res[0]:
+                self.serialObj.close()
+                self.serialObj = None
             if res[0]:
                 QMessageBox.information(self, "Success", "Succesfully connected:\n"+res[1], QMessageBox.StandardButton.Ok)
                 self.isConnected = True
@@ -160,6 +238,7 @@ class MainInterface(QDialog):
                 self.serialPort.setEnabled(False)
                 self.n_stations.setEnabled(False)
                 self.sensitivity.setEnabled(False)
+                self.sampleCount.setEnabled(False)
                 self.zeros = np.zeros(self.n_stations.value())
             else:
                 QMessageBox.critical(self, "Failure", "Failed to connected:\n"+res[1], QMessageBox.StandardButton.Ok)
@@ -171,6 +250,7 @@ class MainInterface(QDialog):
             self.serialPort.setEnabled(True)
             self.n_stations.setEnabled(True)
             self.sensitivity.setEnabled(True)
+            self.sampleCount.setEnabled(True)
 
 
     def startStopMeasurement(self):
@@ -180,60 +260,112 @@ class MainInterface(QDialog):
             return
         if not self.isRunning:
             if not self.createLogFile()[0]:
-                QMessageBox.critical(self, "Log File", "Issues in Log file creation or opening. Please,"\
-                                  "check the Log filename", QMessageBox.StandardButton.Ok)
+                QMessageBox.critical(self, "Inventory File", "Issues in inventory creation or opening. Please,"\
+                                  "check the inventory filename", QMessageBox.StandardButton.Ok)
                 return
             self.startMeasure_button.setText("Stop Measurements")
             self.filename.setEnabled(False)
+            self.batch.setEnabled(False)
             self.sensitivity.setEnabled(False)
             self.connect_button.setEnabled(False)
             for zero_button, store_button in zip(self.zero_buttons, self.store_buttons):
                 zero_button.setEnabled(True)
                 store_button.setEnabled(True)
+            self.streamRate.setEnabled(False)
+            self.autoCaptureBox.setEnabled(False)
+            self.captureThreshold.setEnabled(False)
+            res = self.serialObj.startAcquisition(self.streamRate.value())
+            if not res[0]:
+                QMessageBox.critical(self, "Acquisition", "Failed to start on some ports:\n"+res[1], QMessageBox.StandardButton.Ok)
             self.isRunning = True
             self.measurementJob = measurementJob.MeasurementJob(self.serialObj)
-            self.measurementJob.measAvailable.connect(self.updateMeasurementLabels)
+            self.measurementJob.error.connect(self.showStreamError)
+            if self.autoCaptureBox.isChecked():
+                # The zeros are shared with the capture, which keeps them up to date
+                self.autoCapture = autoCapture.AutoCapture(len(self.zeros), self.zeros,
+                                                           insert_threshold=self.captureThreshold.value())
+                self.zeros = self.autoCapture.zeros
+                self.measurementJob.autoCapture = self.autoCapture
+                self.measurementJob.captured.connect(self.storeCaptures)
+            self.measurementThread = QThread()
             self.measurementJob.moveToThread(self.measurementThread)
             self.measurementThread.started.connect(self.measurementJob.run)
             self.measurementThread.start()
+            # The display reads the stream at FRAME_RATE on its own
+            self.trace = rollingTrace.TraceHistory(FRAME_RATE * TRACE_SECONDS, len(self.zeros))
+            for trace_widget in self.trace_widgets:
+                trace_widget.history = self.trace
+            self.nextSample = self.serialObj.sampleBuffer().total
+            self.displayTimer.start()
         else:
             self.startMeasure_button.setText("Start Measurements")
             self.filename.setEnabled(True)
+            self.batch.setEnabled(True)
             self.sensitivity.setEnabled(True)
             self.connect_button.setEnabled(True)
             for zero_button, store_button in zip(self.zero_buttons, self.store_buttons):
                 zero_button.setEnabled(False)
                 store_button.setEnabled(False)
             self.isRunning = False
+            self.displayTimer.stop()
+            # The job returns within the wait timeout of the stream and the thread then leaves its event loop
             self.measurementJob.stopMeasuring = True
-            self.measurementThread.terminate()
+            self.measurementThread.quit()
             self.measurementThread.wait()
             self.measurementJob = None
+            self.measurementThread = None
+            self.serialObj.stopAcquisition()
+            self.streamRate.setEnabled(True)
+            self.autoCaptureBox.setEnabled(True)
+            self.captureThreshold.setEnabled(True)
+            self.autoCapture = None
             self.log.close()
 
-    def updateMeasurementLabels(self, measList):
-        self.lastMeasured = measList
-        for meas, label, zero in zip(measList, self.measResult_labels, self.zeros):
-            label.setText(f"{meas-zero:.2f} mT")
+    def refreshDisplay(self):
+        """Show the samples received since the last frame"""
+        buffer = self.serialObj.sampleBuffer()
+        total = buffer.total
+        _, _, values = buffer.read(self.nextSample, total)
+        self.nextSample = total
+        self.trace.addFrame(values)
+        mean, std = self.trace.statistics(FRAME_RATE * STATS_SECONDS)
+        self.lastMeasured = mean
+        for label, trace_widget, meas, sigma, zero in zip(self.measResult_labels, self.trace_widgets, mean, std, self.zeros):
+            if np.isnan(meas):
+                continue
+            label.setText(f"{meas-zero:.2f} \u00b1 {sigma:.2f} mT")
+            trace_widget.zero = zero
+            trace_widget.update()
+        if self.autoCapture is not None:
+            for label, count, rate in zip(self.count_labels, self.autoCapture.magnetCounts(), self.autoCapture.magnetsPerHour()):
+                label.setText(f"{count} magnets, {rate:.0f}/h")
+
+    def showStreamError(self, message):
+        QMessageBox.critical(self, "Acquisition", f"The stream stopped:\n{message}", QMessageBox.StandardButton.Ok)
 
     def setZero(self,n):
+        if self.lastMeasured is None or np.isnan(self.lastMeasured[n]):
+            return
         self.zeros[n] = self.lastMeasured[n]
 
     def storeResult(self,n):
-        currentDate = QDate.currentDate().toString()
-        currentTime = QTime.currentTime().toString()
-        self.log.write(f"{n}\t{currentDate}\t{currentTime}\t{(self.lastMeasured[n]-self.zeros[n]):.2f}\t{self.zeros[n]:.2f}\n")
-        self.log.flush()
-        
+        if self.lastMeasured is None or np.isnan(self.lastMeasured[n]):
+            return
+        self.storeMagnet(n, self.lastMeasured[n], self.zeros[n])
+
+    def storeCaptures(self, captures):
+        for n, timestamp, reading, zero in captures:
+            self.storeMagnet(n, reading, zero, timestamp)
+
+    def storeMagnet(self, n, reading, zero, timestamp=None):
+        batch = self.batch.text()
+        magnet_id = self.log.nextMagnetId(batch)
+        magnetization = self.log.addMeasurement(magnet_id, batch, n, float(reading), float(zero), timestamp)
+        self.store_buttons[n].setToolTip(f"Last stored: {magnet_id}, {magnetization:.0f} A/m")
+
     def createLogFile(self):
         try:
-            fileExists = False
-            if os.path.isfile(self.filename.text()): # The file already exist
-                fileExists = True
-            self.log = open(self.filename.text(), "a")
-            if not fileExists:
-                self.log.write("Station N.\tDate\tTime\tB (mT)\tZero (mT)\n")
-                self.log.flush()
+            self.log = magnetInventory.MagnetInventory(self.filename.text())
             return [True, None]
         except Exception as e:
             return [False, str(e)]
@@ -1,18 +1,41 @@
+import time
 from PyQt6.QtCore import QObject, pyqtSignal, QVariant
 
 class MeasurementJob(QObject):
 
-    measAvailable = pyqtSignal(QVariant)
     error = pyqtSignal(QVariant)
+    captured = pyqtSignal(QVariant)
 
     def __init__(self, serialObj):
         super(MeasurementJob, self).__init__()
         self.stopMeasuring = False
         self.serialObj = serialObj
+        self.autoCapture = None # autoCapture.AutoCapture fed with every sample, if set
+        self.chunkInterval = 0.02 # s, the stream is processed in chunks at most this often
 
     def run(self):
-        self.stopMeasuring = False
+        # stopMeasuring is not reset here, a stop requested before the thread starts still holds
+        self.runStream(self.serialObj.sampleBuffer())
+
+    def runStream(self, buffer):
+        """Feed the samples streamed to autoCapture, waiting on the ring buffer
+        instead of polling the port, and emit the magnets captured with captured.
+        The display reads the buffer at its own frame rate, so no signal is sent
+        per sample. The samples are taken in chunks every chunkInterval, as the
+        cost of a chunk hardly depends on its size. Returns within 0.1 s of
+        stopMeasuring being set
+        """
+        nextSample = buffer.total
         while(not self.stopMeasuring):
-            res = self.serialObj.startMeasure()
-            if res[0]:
-                self.measAvailable.emit(res[1])
+            total = buffer.waitFor(nextSample + 1, timeout=0.1)
+            if total > nextSample:
+                _, timestamps, values = buffer.read(nextSample, total)
+                nextSample = total
+                if self.autoCapture is not None:
+                    captures = self.autoCapture.process(timestamps, values)
+                    if captures:
+                        self.captured.emit(captures)
+                time.sleep(self.chunkInterval)
+            elif buffer.closed:
+                self.error.emit(self.serialObj.streamError())
+                return
@@ -0,0 +1,98 @@
+import numpy as np
+from PyQt6.QtWidgets import QWidget
+from PyQt6.QtGui import QPainter, QPen, QColor, QPolygonF
+from PyQt6.QtCore import Qt, QPointF, QSize
+
+class TraceHistory():
+    """Decimated history of all channels: the samples that arrive between two
+    display frames are reduced to one column of min, max, count, sum and sum of
+    squares per channel, kept for the last length frames. Rolling statistics
+    over any number of frames come from the sums, so the cost of a frame does
+    not depend on the sample rate
+    """
+
+    def __init__(self, length, n_channels):
+        self.length = length
+        self.n_channels = n_channels
+        self.minimum = np.full((length, n_channels), np.nan)
+        self.maximum = np.full((length, n_channels), np.nan)
+        self.count = np.zeros((length, n_channels))
+        self.sum = np.zeros((length, n_channels))
+        self.squares = np.zeros((length, n_channels))
+        self.frames = 0
+
+    def addFrame(self, values):
+        """Add the samples (k, n_channels) received during a frame, NaN samples
+        are ignored
+        """
+        i = self.frames % self.length
+        finite = np.isfinite(values)
+        data = np.where(finite, values, 0.)
+        self.count[i] = finite.sum(axis=0)
+        self.sum[i] = data.sum(axis=0)
+        self.squares[i] = (data * data).sum(axis=0)
+        empty = self.count[i] == 0
+        self.minimum[i] = np.where(empty, np.nan, np.where(finite, values, np.inf).min(axis=0, initial=np.inf))
+        self.maximum[i] = np.where(empty, np.nan, np.where(finite, values, -np.inf).max(axis=0, initial=-np.inf))
+        self.frames += 1
+
+    def last(self, n_frames):
+        """Index of the last n_frames frames, oldest first"""
+        n_frames = min(n_frames, self.frames, self.length)
+        return np.arange(self.frames - n_frames, self.frames) % self.length
+
+    def statistics(self, n_frames):
+        """Mean and standard deviation of every channel over the last n_frames"""
+        index = self.last(n_frames)
+        count = self.count[index].sum(axis=0)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            mean = self.sum[index].sum(axis=0) / count
+            variance = self.squares[index].sum(axis=0) / count - mean * mean
+            std = np.sqrt(np.maximum(variance * count / np.maximum(count - 1, 1), 0))
+        return mean, std
+
+class TraceWidget(QWidget):
+    """Rolling trace of one channel of a TraceHistory: the min-max envelope and
+    the mean of every frame, oldest on the left. zero is subtracted from the
+    values shown. Nothing is drawn until history is set
+    """
+
+    def __init__(self, history, channel, parent=None):
+        super(TraceWidget, self).__init__(parent)
+        self.history = history
+        self.channel = channel
+        self.zero = 0.
+        self.setMinimumSize(QSize(100, 40))
+
+    def sizeHint(self):
+        return QSize(160, 60)
+
+    def paintEvent(self, event):
+        painter = QPainter(self)
+        painter.fillRect(self.rect(), QColor(20, 20, 20))
+        if self.history is None:
+            return
+        index = self.history.last(self.history.length)
+        count = self.history.count[index, self.channel]
+        valid = count > 0
+        if not np.any(valid):
+            return
+        low = self.history.minimum[index, self.channel] - self.zero
+        high = self.history.maximum[index, self.channel] - self.zero
+        mean = self.history.sum[index, self.channel] / np.maximum(count, 1) - self.zero
+        bottom, top = np.min(low[valid]), np.max(high[valid])
+        span = max(top - bottom, 0.05) * 1.1
+        centre = (top + bottom) / 2.
+        width, height = self.width(), self.height()
+        x = width - (len(index) - np.arange(len(index))) * width / self.history.length
+        def y(v):
+            return height / 2. - (v - centre) / span * height
+
+        painter.setPen(QPen(QColor(80, 130, 200)))
+        for xi, lo, hi in zip(x[valid], y(low[valid]), y(high[valid])):
+            painter.drawLine(QPointF(xi, lo), QPointF(xi, hi))
+        painter.setPen(QPen(QColor(255, 200, 0), 1.5))
+        painter.drawPolyline(QPolygonF([QPointF(xi, yi) for xi, yi in zip(x[valid], y(mean[valid]))]))
+        painter.setPen(QPen(Qt.GlobalColor.lightGray))
+        painter.drawText(2, 12, f"{top:.2f}")
+        painter.drawText(2, height - 2, f"{bottom:.2f}")
@@ -0,0 +1,167 @@
+import threading
+import struct
+import numpy as np
+
+# Binary frames streamed by magnetTestStation.ino after STREAM:ON, little endian:
+#   0xA5 0x5A | n channels (uint8) | sequence (uint16) | timestamp in us (uint32) |
+#   n x ADC counts in 1/FRAME_SCALE counts (uint16) | Fletcher-16 of the bytes after the sync word (uint16)
+# Each frame holds the mean of the sample count set with MEAS:N: of each channel
+SYNC = b'\xa5\x5a'
+HEADER = struct.Struct('<BHI')
+HEADER_LENGTH = len(SYNC) + HEADER.size
+CHECKSUM_LENGTH = 2
+FRAME_SCALE = 16
+
+def fletcher16(data):
+    """Fletcher-16 checksum (sum2 << 8 | sum1) of a bytes-like object"""
+    data = np.frombuffer(bytes(data), dtype=np.uint8).astype(np.int64)
+    sum1 = np.sum(data) % 255
+    sum2 = np.sum(data * np.arange(len(data), 0, -1)) % 255
+    return int(sum2) << 8 | int(sum1)
+
+def encodeFrame(sequence, timestamp, counts):
+    """Frame as sent by the firmware, used by the simulator"""
+    body = HEADER.pack(len(counts), sequence & 0xFFFF, timestamp & 0xFFFFFFFF) + struct.pack(f'<{len(counts)}H', *counts)
+    return SYNC + body + struct.pack('<H', fletcher16(body))
+
+def countsToVolts(counts):
+    """Frame counts to the Hall sensor voltage, as runMeasurement in the firmware"""
+    return np.asarray(counts) / FRAME_SCALE * 5. / 1023. - 2.5
+
+class FrameParser():
+    """Splits a byte stream into frames, dropping bytes until the next sync word
+    after garbled data or a checksum failure
+
+    sequence and timestamp are unwrapped to keep increasing, so gaps in the
+    sequence count dropped frames
+    """
+
+    def __init__(self):
+        self.buffer = bytearray()
+        self.badFrames = 0
+        self.droppedFrames = 0
+        self.lastSequence = None
+        self.lastTimestamp = None
+        self.timestampOffset = 0
+
+    def feed(self, data):
+        """Add received bytes, returns (timestamps in s, counts) of the complete
+        frames as arrays of shape (k,) and (k, n channels)
+        """
+        self.buffer += data
+        timestamps = []
+        counts = []
+        while True:
+            start = self.buffer.find(SYNC)
+            if start < 0:
+                # Keep a last byte that may be the first half of a sync word
+                del self.buffer[:max(len(self.buffer) - 1, 0)]
+                break
+            del self.buffer[:start]
+            if len(self.buffer) < HEADER_LENGTH:
+                break
+            n_channels, sequence, timestamp = HEADER.unpack_from(self.buffer, len(SYNC))
+            length = HEADER_LENGTH + 2*n_channels + CHECKSUM_LENGTH
+            if len(self.buffer) < length:
+                break
+            body = bytes(self.buffer[len(SYNC):length - CHECKSUM_LENGTH])
+            if fletcher16(body) != struct.unpack_from('<H', self.buffer, length - CHECKSUM_LENGTH)[0]:
+                self.badFrames += 1
+                del self.buffer[:1]
+                continue
+            del self.buffer[:length]
+            if counts and n_channels != len(counts[-1]):
+                self.badFrames += 1
+                continue
+            if self.lastSequence is not None:
+                self.droppedFrames += (sequence - self.lastSequence - 1) % 0x10000
+            self.lastSequence = sequence
+            if self.lastTimestamp is not None and timestamp < self.lastTimestamp:
+                self.timestampOffset += 1 << 32
+            self.lastTimestamp = timestamp
+            timestamps.append((timestamp + self.timestampOffset) * 1e-6)
+            counts.append(struct.unpack_from(f'<{n_channels}H', body, HEADER.size))
+        if not counts:
+            return np.zeros(0), None
+        return np.array(timestamps), np.array(counts)
+
+class RingBuffer():
+    """Fixed size buffer of the last capacity samples of n channels, with their
+    timestamps. Samples are numbered from 0 as they are written; readers keep
+    the number of the next sample they want and wait for it without polling
+    """
+
+    def __init__(self, capacity, n_channels):
+        self.capacity = capacity
+        self.timestamps = np.zeros(capacity)
+        self.values = np.zeros((capacity, n_channels))
+        self.total = 0
+        self.closed = False
+        self.condition = threading.Condition()
+
+    def append(self, timestamps, values):
+        with self.condition:
+            k = min(len(timestamps), self.capacity)
+            index = (self.total + len(timestamps) - k + np.arange(k)) % self.capacity
+            self.timestamps[index] = timestamps[-k:]
+            self.values[index] = values[-k:]
+            self.total += len(timestamps)
+            self.condition.notify_all()
+
+    def close(self):
+        """Wake up the readers when no more samples will come"""
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+    def waitFor(self, count, timeout=None):
+        """Block until count samples have been written, the buffer is closed or
+        timeout (s) has passed. Returns the number of samples written
+        """
+        with self.condition:
+            self.condition.wait_for(lambda: self.total >= count or self.closed, timeout)
+            return self.total
+
+    def read(self, start, stop=None):
+        """Samples numbered start to stop, or to the last one written. Samples
+        that have been overwritten are skipped. Returns (first sample number,
+        timestamps, values)
+        """
+        with self.condition:
+            stop = self.total if stop is None else min(stop, self.total)
+            start = max(start, stop - self.capacity, 0)
+            index = np.arange(start, stop) % self.capacity
+            return start, self.timestamps[index], self.values[index]
+
+class StreamReader(threading.Thread):
+    """Thread that reads frames from a serial port into a RingBuffer of values
+    in mT until stop() is called
+    """
+
+    def __init__(self, ser, n_sensors, sensitivity, capacity=100000):
+        super(StreamReader, self).__init__(daemon=True)
+        self.ser = ser
+        self.sensitivity = sensitivity
+        self.parser = FrameParser()
+        self.buffer = RingBuffer(capacity, n_sensors)
+        self.stopEvent = threading.Event()
+        self.error = None
+
+    def run(self):
+        try:
+            while not self.stopEvent.is_set():
+                # read returns what has arrived after at most the port timeout
+                data = self.ser.read(max(self.ser.in_waiting, 1))
+                if not data:
+                    continue
+                timestamps, counts = self.parser.feed(data)
+                if len(timestamps):
+                    self.buffer.append(timestamps, countsToVolts(counts) * self.sensitivity)
+        except Exception as e:
+            self.error = str(e)
+        finally:
+            self.buffer.close()
+
+    def stop(self):
+        self.stopEvent.set()
+        self.join()
@@ -0,0 +1,216 @@
+import asyncio
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import a1324lua
+import sampleStream
+
+class PortWorker():
+    """Runs the commands for one Arduino in order from a queue
+
+    The blocking A1324LUA calls run in a thread of this port only, so a slow or
+    hung port does not hold up the others. A command that takes longer than
+    timeout (s) fails, and the commands after it wait until the port replies
+    """
+
+    def __init__(self, station, first_channel, timeout):
+        self.station = station
+        self.channels = slice(first_channel, first_channel + station.n_sensors)
+        self.timeout = timeout
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.queue = asyncio.Queue()
+        self.errors = 0
+
+    async def call(self, fn, *args):
+        """Queue fn(*args) and wait for its result. A1324LUA replies [False, message]
+        on failure, which raises an Exception
+        """
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((fn, args, future))
+        res = await future
+        if isinstance(res, list) and not res[0]:
+            raise Exception(f"{self.station.port}: {res[1]}")
+        return res
+
+    async def serve(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            fn, args, future = await self.queue.get()
+            try:
+                res = await asyncio.wait_for(loop.run_in_executor(self.executor, fn, *args), self.timeout)
+                if not future.done():
+                    future.set_result(res)
+            except asyncio.TimeoutError:
+                if not future.done():
+                    future.set_exception(Exception(f"{self.station.port}: no reply to {fn.__name__} within {self.timeout} s"))
+            except Exception as e:
+                if not future.done():
+                    future.set_exception(e)
+
+class StationDriver():
+    """Drives test stations on several serial ports at once, with an asyncio
+    event loop in a background thread
+
+    All channels are presented as one stream: every reading of any port is
+    written to self.buffer (a sampleStream.RingBuffer) as a row with NaN for
+    the channels of the other ports, timestamped with the time of the host
+    (time.time()). Channels are numbered in the order of the ports.
+    """
+
+    def __init__(self, ports, n_sensors, sensitivity, sample_count=1, timeout=5., capacity=100000):
+        """
+
+        Args:
+            ports (list of string): ports the Arduinos are connected to
+            n_sensors (list of int): number of sensors on each port
+            sensitivity (float): mT/V
+            sample_count (int): samples averaged on the Arduino per reading
+            timeout (float): s before a command to a port fails
+        """
+        self.sample_count = sample_count
+        self.n_channels = int(np.sum(n_sensors))
+        self.buffer = sampleStream.RingBuffer(capacity, self.n_channels)
+        self.lastStd = None
+        self.error = None
+        self.lock = threading.Lock()
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+        self.workers = []
+        self.tasks = []
+        self.acquisition = []
+        first_channel = 0
+        for port, n in zip(ports, n_sensors):
+            station = a1324lua.A1324LUA(port, n, sensitivity)
+            self.workers.append(self._run(self._createWorker(station, first_channel, timeout)))
+            first_channel += n
+
+    async def _createWorker(self, station, first_channel, timeout):
+        # The queue of a worker belongs to the loop it is created in
+        worker = PortWorker(station, first_channel, timeout)
+        self.tasks.append(asyncio.create_task(worker.serve()))
+        return worker
+
+    def _run(self, coroutine, timeout=None):
+        """Run a coroutine on the driver loop from another thread and wait for it"""
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result(timeout)
+
+    def sampleBuffer(self):
+        return self.buffer
+
+    def streamError(self):
+        return self.error
+
+    def initialiseSerialCOM(self):
+        """Connect to every port in parallel and set the sample count"""
+        async def connect(worker):
+            res = await worker.call(worker.station.initialiseSerialCOM)
+            await worker.call(worker.station.setSampleCount, self.sample_count)
+            return res[1]
+        async def connectAll():
+            return await asyncio.gather(*[connect(worker) for worker in self.workers], return_exceptions=True)
+        results = self._run(connectAll())
+        failures = [str(r) for r in results if isinstance(r, Exception)]
+        if failures:
+            return [False, "\n".join(failures)]
+        return [True, ", ".join(results)]
+
+    def _publish(self, worker, timestamps, values, stds=None):
+        """Write the readings of one port to the unified stream"""
+        with self.lock:
+            rows = np.full((len(timestamps), self.n_channels), np.nan)
+            rows[:, worker.channels] = values
+            if stds is not None:
+                if self.lastStd is None:
+                    self.lastStd = np.full(self.n_channels, np.nan)
+                self.lastStd[worker.channels] = stds
+            self.buffer.append(timestamps, rows)
+
+    async def _poll(self, worker):
+        """Read a port with MEAS:AVG as fast as it replies"""
+        while True:
+            try:
+                res = await worker.call(worker.station.measureStatistics)
+                self._publish(worker, np.array([time.time()]), res[1][None, :], res[2])
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                worker.errors += 1
+                self.error = str(e)
+
+    async def _follow(self, worker):
+        """Copy the frames a port streams into its own ring buffer to the unified stream"""
+        loop = asyncio.get_running_loop()
+        buffer = worker.station.sampleBuffer()
+        next_sample = buffer.total
+        offset = None
+        while True:
+            total = await loop.run_in_executor(None, buffer.waitFor, next_sample + 1, 0.5)
+            if total > next_sample:
+                _, timestamps, values = buffer.read(next_sample, total)
+                next_sample = total
+                # Device clock to host clock, with the smallest delay seen so far
+                now = time.time()
+                offset = now - timestamps[-1] if offset is None else min(offset, now - timestamps[-1])
+                self._publish(worker, timestamps + offset, values)
+            elif buffer.closed:
+                worker.errors += 1
+                self.error = f"{worker.station.port}: {worker.station.streamError()}"
+                return
+
+    def startAcquisition(self, stream_rate=0):
+        """Start reading every port, streaming at stream_rate (Hz) or polling if 0"""
+        self.lastStd = None
+        async def start():
+            if stream_rate == 0:
+                return [asyncio.create_task(self._poll(worker)) for worker in self.workers], []
+            results = await asyncio.gather(*[worker.call(worker.station.startStream, stream_rate) for worker in self.workers],
+                                           return_exceptions=True)
+            tasks = [asyncio.create_task(self._follow(worker)) for worker, r in zip(self.workers, results) if not isinstance(r, Exception)]
+            return tasks, [str(r) for r in results if isinstance(r, Exception)]
+        # Ports that fail to start are reported, the others keep running
+        self.acquisition, failures = self._run(start())
+        if failures:
+            return [False, "\n".join(failures)]
+        return [True, None]
+
+    def stopAcquisition(self):
+        """Stop reading, waiting for the commands in progress to finish"""
+        async def stop():
+            for task in self.acquisition:
+                task.cancel()
+            await asyncio.gather(*self.acquisition, return_exceptions=True)
+            await asyncio.gather(*[worker.call(worker.station.stopStream) for worker in self.workers
+                                   if worker.station.sampleBuffer() is not None], return_exceptions=True)
+        self._run(stop())
+        self.acquisition = []
+
+    def recordStream(self, fname, stop_event):
+        """Append the unified stream to a CSV file (time, one column per channel)
+        until stop_event is set. Run it in its own thread
+        """
+        next_sample = self.buffer.total
+        with open(fname, "a") as f:
+            while not stop_event.is_set():
+                total = self.buffer.waitFor(next_sample + 1, timeout=0.5)
+                if total > next_sample:
+                    _, timestamps, values = self.buffer.read(next_sample, total)
+                    next_sample = total
+                    np.savetxt(f, np.column_stack((timestamps, values)), delimiter=",", fmt="%.6f")
+
+    def close(self):
+        if self.acquisition:
+            self.stopAcquisition()
+        async def closeAll():
+            for worker in self.workers:
+                try:
+                    await worker.call(worker.station.close)
+                except Exception:
+                    pass
+            for task in self.tasks:
+                task.cancel()
+        self._run(closeAll())
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.buffer.close()
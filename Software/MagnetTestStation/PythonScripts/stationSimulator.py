@@ -0,0 +1,199 @@
+import os
+import pty
+import tty
+import select
+import threading
+import time
+import numpy as np
+import sampleStream
+
+class MagnetFeeder():
+    """Field of stations an operator loads with magnets, for the field argument
+    of StationSimulator
+
+    Every period s a magnet is put on each station (the stations staggered in
+    time) and taken off after dwell s. A magnet reads field V, varied by spread,
+    settling from an insertion overshoot with time constant tau. The empty
+    stations read zero V, with a slow drift
+    """
+
+    def __init__(self, period=4., dwell=2.5, field=0.8, spread=0.02, tau=0.1, zero=0.01, drift=1e-4, seed=1):
+        self.period = period
+        self.dwell = dwell
+        self.field = field
+        self.spread = spread
+        self.tau = tau
+        self.zero = zero
+        self.drift = drift
+        self.rng = np.random.default_rng(seed)
+        self.magnets = {}
+
+    def __call__(self, t, channel):
+        phase = t + channel * self.period / 7.
+        n = int(phase // self.period)
+        elapsed = phase - n * self.period
+        baseline = self.zero + self.drift * t
+        if elapsed >= self.dwell:
+            return baseline
+        if (channel, n) not in self.magnets:
+            self.magnets[(channel, n)] = self.field * (1 + self.spread * self.rng.standard_normal())
+        return baseline + self.magnets[(channel, n)] * (1 + 0.3 * np.exp(-elapsed / self.tau))
+
+class StationSimulator():
+    """Magnet Test Station on a pseudo-terminal, with the command set of
+    magnetTestStation.ino (CH:AVA?, CH:USE:, MEAS:ST, MEAS:N:, MEAS:AVG,
+    STREAM:RATE:, STREAM:ON, STREAM:OFF)
+
+    Open self.port with A1324LUA like the serial port of an Arduino. Replies are
+    paced at the byte rate of baudrate, and each reading takes adc_time per
+    sample and channel, as on the Arduino
+    """
+
+    def __init__(self, n_pins=4, field=None, noise=0.002, latency=0., drop=0., garble=0.,
+                 baudrate=115200, adc_time=112e-6, seed=0):
+        """
+
+        Args:
+            n_pins (int): number of Hall sensors
+            field (callable): field(t, channel) sensor voltage in V at time t (s),
+                0.1 V on every channel by default
+            noise (float): standard deviation of each ADC sample in V
+            latency (float): s before the reply to every command
+            drop (float): probability that a reply line or stream frame is lost
+            garble (float): probability that a byte of a reply line or frame is corrupted
+        """
+        self.n_pins = n_pins
+        self.field = field if field is not None else (lambda t, channel: 0.1)
+        self.noise = noise
+        self.latency = latency
+        self.drop = drop
+        self.garble = garble
+        self.byte_time = 10. / baudrate
+        self.adc_time = adc_time
+        self.rng = np.random.default_rng(seed)
+
+        self.used_channels = 0
+        self.sample_count = 1
+        self.stream_interval = 0.01
+        self.streaming = False
+        self.frame_sequence = 0
+        self.start_time = time.perf_counter()
+
+        self.master, self.slave = pty.openpty()
+        tty.setraw(self.slave)
+        self.port = os.ttyname(self.slave)
+        self.stopEvent = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.next_free = 0. # Time the simulated serial line is free to send again
+
+    def start(self):
+        self.thread.start()
+        return self.port
+
+    def stop(self):
+        self.stopEvent.set()
+        self.thread.join()
+        os.close(self.master)
+        os.close(self.slave)
+
+    def micros(self):
+        return int((time.perf_counter() - self.start_time) * 1e6)
+
+    def sampleCounts(self, channel):
+        """Mean and sample std of sample_count ADC readings of a channel, in counts"""
+        t = time.perf_counter() - self.start_time
+        volts = self.field(t, channel) + self.noise * self.rng.standard_normal(self.sample_count)
+        counts = np.clip(np.rint((volts + 2.5) * 1023. / 5.), 0, 1023)
+        return counts.mean(), counts.std(ddof=1) if self.sample_count > 1 else 0.
+
+    def send(self, data):
+        if self.rng.random() < self.drop:
+            return
+        data = bytearray(data)
+        if self.rng.random() < self.garble:
+            data[self.rng.integers(len(data))] ^= 1 << self.rng.integers(8)
+        # Pace the bytes at the baud rate, blocking like Serial.write with a full buffer
+        now = time.perf_counter()
+        self.next_free = max(self.next_free, now) + len(data) * self.byte_time
+        os.write(self.master, bytes(data))
+        if self.next_free > now:
+            time.sleep(self.next_free - now)
+
+    def println(self, text):
+        self.send(f"{text}\r\n".encode())
+
+    def handle(self, command):
+        if self.latency > 0:
+            time.sleep(self.latency)
+        if command == "CH:AVA?":
+            self.println(self.n_pins)
+        elif command.startswith("CH:USE:"):
+            self.used_channels = min(int(command[7:]), self.n_pins)
+            self.println(self.used_channels)
+        elif command == "MEAS:ST":
+            for i in range(self.used_channels):
+                time.sleep(self.sample_count * self.adc_time)
+                self.println(f"{chr(ord('A') + i)}{self.sampleCounts(i)[0] * 5. / 1023. - 2.5:.3f}")
+        elif command.startswith("MEAS:N:"):
+            self.sample_count = int(np.clip(int(command[7:]), 1, 1000))
+            self.println(self.sample_count)
+        elif command == "MEAS:AVG":
+            fields = []
+            for i in range(self.used_channels):
+                time.sleep(self.sample_count * self.adc_time)
+                mean, std = self.sampleCounts(i)
+                fields.append(f"{chr(ord('A') + i)}{mean * 5. / 1023. - 2.5:.5f},{std * 5. / 1023.:.5f}")
+            self.println(";".join(fields))
+        elif command.startswith("STREAM:RATE:"):
+            rate = min(int(command[12:]), int(1 / (self.byte_time * (9 + 2 * self.used_channels + 2))))
+            if rate > 0:
+                self.stream_interval = 1e-6 * (1000000 // rate)
+            self.println(int(round(1 / self.stream_interval)))
+        elif command == "STREAM:ON":
+            self.println("OK")
+            self.frame_sequence = 0
+            self.next_frame = time.perf_counter()
+            self.streaming = True
+        elif command == "STREAM:OFF":
+            self.streaming = False
+            self.println("OK")
+
+    def sendFrame(self):
+        timestamp = self.micros()
+        time.sleep(self.sample_count * self.adc_time * self.used_channels)
+        counts = [int(self.sampleCounts(i)[0] * sampleStream.FRAME_SCALE + 0.5) for i in range(self.used_channels)]
+        self.send(sampleStream.encodeFrame(self.frame_sequence, timestamp, counts))
+        self.frame_sequence += 1
+
+    def run(self):
+        received = b""
+        while not self.stopEvent.is_set():
+            timeout = 0.05
+            if self.streaming:
+                timeout = max(0., min(timeout, self.next_frame - time.perf_counter()))
+            readable, _, _ = select.select([self.master], [], [], timeout)
+            if readable:
+                try:
+                    received += os.read(self.master, 1024)
+                except OSError:
+                    # No client has the port open
+                    time.sleep(0.01)
+                while b"\n" in received:
+                    line, received = received.split(b"\n", 1)
+                    self.handle(line.decode(errors="replace").strip())
+            if self.streaming and time.perf_counter() >= self.next_frame:
+                self.next_frame += self.stream_interval
+                self.sendFrame()
+
+if __name__ == "__main__":
+    # Run a simulated station to connect mainInterface.py to:
+    #   python mainInterface.py <port>
+    # Set insertions to load the stations with magnets, to try automatic capture
+    insertions = False
+    simulator = StationSimulator(noise=0.005, field=MagnetFeeder() if insertions else None)
+    print(f"Simulated Magnet Test Station on {simulator.start()}, Ctrl+C to stop")
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        simulator.stop()
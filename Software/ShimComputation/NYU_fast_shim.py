@@ -4,8 +4,8 @@ than the genetic algorithm in NIST_shim.py
 
 Stephen Ogier - October 2024
 
-At present, this code only uses the Z-component of the shim output
-    It could be expanded to work with 3-axis b0 map data.
+By default, this code only uses the Z-component of the shim output.
+    With shim_field = 'magnitude' it shims |B| of 3-axis b0 map data.
 """
 
 import numpy as np
@@ -19,6 +19,12 @@ import logging
 
 import time
 
+import cuboid_field
+
+import shim_optimizer
+
+import ring_expansion
+
 # Specify files with input data
 mag_pos_fname = 'example_data/OSII_MINI_reduced.csv'
 b0_map_fname = 'example_data/shell_background_removed_2024_05_07_b0_sphere_100mm_5mm_increment.csv'
@@ -36,6 +42,11 @@ if cost_fn == 'std':
     metric = np.std
 elif cost_fn == 'ptp':
     metric = np.ptp
+
+# Choose shimmed field
+# z - Z-component of the shim field added to the B0 column of the map
+# magnitude - |B| of the shim field added to the Bx, By, Bz columns of a 3-axis map
+shim_field = 'z'
         
 # Configuration Options
 logging.basicConfig(format='%(levelname)s:%(message)s', level=logging.INFO)
@@ -51,8 +62,22 @@ cube_mag = (0,0,magnetization) # Magnetized in Z direction
 logging.info(f'Magnets are cubes with side length {s*1e3} mm')
 logging.info(f'Magnets have magnetization {cube_mag} A/m')
 
+# Field computation backend
+# numba - compiled cuboid kernel in cuboid_field.py, all magnets and sensors at once on all cores
+# magpylib - one magpylib object per magnet and per sensor
+field_backend = 'numba'
+
+# Field basis method
+# direct - field of every position computed with field_backend, exact
+# rings - one field expansion per ring of positions, rotated to every slot (ring_expansion.py),
+#         within about 5e-5 of direct, 3 to 5 times faster than direct on one core for the OSII MINI trays
+basis_method = 'direct'
+
 # Define optimization options
-n_passes = 3 # Number of passes through magnet optimization
+max_passes = 10 # Maximum number of passes through magnet optimization
+min_pass_improvement = 0.5 # Stop once a pass improves homogeneity by less than this (ppm)
+min_move_improvement = 0 # Smallest improvement (ppm) for a single placement to be accepted
+prune_positions = True # Skip positions that the field basis shows cannot improve the shim
 
 n_angles = 4 # Number of possible magnet orientations
 angles = list(np.linspace(0,2*np.pi,n_angles,endpoint=False))
@@ -91,7 +116,7 @@ def magnet_pos_import(magnet_pos_fname):
     logging.info(f'Successful import of magnet position+angle specification: {magnet_pos_fname}')
     return magnet_pos_df
 
-def b0_map_import(b0_map_fname, l_unit = 'mm', B_unit = 'T'):
+def b0_map_import(b0_map_fname, l_unit = 'mm', B_unit = 'T', three_axis = False):
     """Import B0 map CSV file.
     CSV has the following format:
     X   Y   Z   B0
@@ -99,9 +124,13 @@ def b0_map_import(b0_map_fname, l_unit = 'mm', B_unit = 'T'):
     x1  y1  z1  B0_1
     ...
 
-    All columns after B0 are ignored.
+    All columns after B0 are ignored, unless three_axis is True. 3-axis maps have the format
+    X   Y   Z   B0  Bx  By  Bz
     """
-    b0_map_df = pd.read_csv(b0_map_fname, header=0, usecols=[0,1,2,3], names=['X','Y','Z','B0'])
+    if three_axis:
+        b0_map_df = pd.read_csv(b0_map_fname, header=0, usecols=[0,1,2,3,4,5,6], names=['X','Y','Z','B0','Bx','By','Bz'])
+    else:
+        b0_map_df = pd.read_csv(b0_map_fname, header=0, usecols=[0,1,2,3], names=['X','Y','Z','B0'])
     logging.info(f'Successful import of B0 map: {b0_map_fname}')
     if l_unit == 'mm':
         b0_map_df['X'] = b0_map_df['X'].values*1e-3
@@ -110,6 +139,8 @@ def b0_map_import(b0_map_fname, l_unit = 'mm', B_unit = 'T'):
     
     if B_unit == 'G':
         b0_map_df['B0'] = b0_map_df['B0']/1e4
+        if three_axis:
+            b0_map_df[['Bx','By','Bz']] = b0_map_df[['Bx','By','Bz']]/1e4
 
     return b0_map_df
 
@@ -153,7 +184,11 @@ def compute_fields(mag_pos_angle, sensors):
         x0  y0  z0
         x1  y1  z1
         ...
+    For the numba backend, sensors is the sensor_pos array itself
     """
+    if field_backend == 'numba':
+        return cuboid_field.getB(mag_pos_angle[:,:3], cuboid_field.x_rotations(mag_pos_angle[:,3]), sensors, cube_dims, cube_mag)
+
     # Generate magnet position and rotation
     magnets = generate_magnets(mag_pos_angle)
     
@@ -167,11 +202,16 @@ def compute_cost(mag_pos_angle, sensors: magpy.Sensor, b0_map_vals, cost_fn = 's
     """
 
     if len(mag_pos_angle) == 0:
-        cost = metric(b0_map_vals)
+        B_combined = b0_map_vals
     else:
         B_shim = compute_fields(mag_pos_angle, sensors)
-        B_combined = B_shim[:,2]+b0_map_vals # Add Z-component of shim fields to mapped magnet
-        cost = metric(B_combined,0)
+        if shim_field == 'magnitude':
+            B_combined = B_shim.T+b0_map_vals # Add shim fields to 3-axis map
+        else:
+            B_combined = B_shim[:,2]+b0_map_vals # Add Z-component of shim fields to mapped magnet
+    if shim_field == 'magnitude':
+        B_combined = np.linalg.norm(B_combined, axis=0)
+    cost = metric(B_combined,0)
 
     cost = cost/B0_nom*1e6
     
@@ -192,13 +232,19 @@ def gen_sensors(b0_map_df):
     return sensors
 
 magnet_pos_df = magnet_pos_import(mag_pos_fname)
-b0_map_df = b0_map_import(b0_map_fname, B_unit='G')
+b0_map_df = b0_map_import(b0_map_fname, three_axis=(shim_field == 'magnitude'), B_unit='G')
 
-b0_map_vals = b0_map_df.to_numpy()[:,3]
-sensors = gen_sensors(b0_map_df)
+if shim_field == 'magnitude':
+    b0_map_vals = b0_map_df[['Bx','By','Bz']].to_numpy().T # 3 x M
+else:
+    b0_map_vals = b0_map_df.to_numpy()[:,3]
+if field_backend == 'numba':
+    sensors = b0_map_df.to_numpy()[:,:3]
+else:
+    sensors = gen_sensors(b0_map_df)
 
 if generate_shim:
-    unshimmed_homogeneity = metric(b0_map_df.to_numpy()[:,3])/B0_nom*1e6
+    unshimmed_homogeneity = compute_cost([], sensors, b0_map_vals)
     print(f'Unshimmed Homogeneity: {unshimmed_homogeneity:.0f} ppm')
 
     # The idea of this placement algorithm is that each potential shim magnet 
@@ -209,77 +255,29 @@ if generate_shim:
     # The magnets are checked from the center ring working outwards, and within
     # each ring, the order in which the positions are checked is randomized
 
+    # The field of every position at every angle is computed once, so each check
+    # only adds the Z-component of that field (or all three components when
+    # shimming |B|) to the present shimmed map
+
     magnet_pos = magnet_pos_df.to_numpy()[:,:3]
     n_magnets = magnet_pos.shape[0]
 
-    # Initialize empty arrays of magnets to place and angles to place at
-    best_placements = np.full(n_magnets,False)
-    best_angles = np.zeros(n_magnets)
-
-    # Generate center-out list of magnet offsets
-    Xs = magnet_pos_df['X'].unique()
-    Xs = sorted(Xs, key=abs)
-
-    best_cost = unshimmed_homogeneity
-
-    for p in range(n_passes):
-        for X in Xs:
-            print(f'X = {X}')
-            ring_pos = magnet_pos_df[magnet_pos_df['X'] == X]
-            # Shuffle magnets in ring
-            ring_pos = ring_pos.sample(frac=1)
-            
-            # Iterate over locations in ring
-            for index, row in ring_pos.iterrows():
-                if best_placements[index]: # If there's already a magnet placed in that location
-                    # Test all angles
-                    test_angle = np.copy(best_angles)
-                    angle_costs = np.zeros(n_angles)
-                    for j in range(n_angles):
-                        test_angle[index] = angles[j]
-                        mag_pos_angle = np.concatenate((magnet_pos[best_placements,:], test_angle[best_placements, None]),1)
-                        angle_costs[j] = compute_cost(mag_pos_angle, sensors, b0_map_vals)
-                        # print(f'{magnet_pos[index,:]} @ {angles[j]:.2f}: {angle_costs[j]}')
-                    lowest_cost_angle_index = np.argmin(angle_costs)
-                    lowest_cost_angle = angles[lowest_cost_angle_index]
-                    lowest_cost = angle_costs[lowest_cost_angle_index]
-
-                    # If lowest cost placement is better than present placement, update angle
-                    if lowest_cost < best_cost:
-                        best_angles[index] = lowest_cost_angle
-                        best_cost = lowest_cost
-                        print(f'New Best Shim: {best_cost}')
-                    # Test no placement
-                    test_placement = np.copy(best_placements)
-                    test_placement[index] = False
-                    mag_pos_angle = np.concatenate((magnet_pos[best_placements,:], test_angle[best_placements, None]),1)
-                    no_placement_cost =  compute_cost(mag_pos_angle, sensors, b0_map_vals)
-                    
-                    # if no placement is better than best placement, remove magnet
-                    if no_placement_cost < best_cost:
-                        best_placements[index] = False
-                        best_angles[index] = 0
-                        best_cost = no_placement_cost
-                        print(f'Magnet {index} removed from shim. New Best Shim: {best_cost}')
-
-                else:
-                    test_placement = np.copy(best_placements)
-                    test_placement[index] = True
-                    test_angle = np.copy(best_angles)
-                    angle_costs = np.zeros(n_angles)
-                    for j in range(n_angles):
-                        test_angle[index] = angles[j]
-                        mag_pos_angle = np.concatenate((magnet_pos[test_placement,:], test_angle[test_placement, None]),1)
-                        angle_costs[j] = compute_cost(mag_pos_angle, sensors, b0_map_vals)
-                        # print(f'{magnet_pos[index,:]} @ {angles[j]:.2f}: {angle_costs[j]}')
-                    lowest_cost_angle_index = np.argmin(angle_costs)
-                    lowest_cost_angle = angles[lowest_cost_angle_index]
-                    lowest_cost = angle_costs[lowest_cost_angle_index]
-                    if lowest_cost < best_cost:
-                        best_placements[index] = True
-                        best_angles[index] = lowest_cost_angle
-                        best_cost = lowest_cost
-                        print(f'New Best Shim: {best_cost}')
+    if basis_method == 'rings':
+        field_basis = ring_expansion.compute_field_basis_rings(magnet_pos, angles, b0_map_df.to_numpy()[:,:3], cube_dims, cube_mag)
+    else:
+        field_basis = shim_optimizer.compute_field_basis(magnet_pos, angles, b0_map_df.to_numpy()[:,:3], cube_dims, cube_mag, backend=field_backend)
+    rings = shim_optimizer.rings_center_out(magnet_pos)
+    if shim_field == 'magnitude':
+        shim_basis = np.moveaxis(field_basis, -1, -2) # N x n_angles x 3 x M
+    else:
+        shim_basis = field_basis[...,2]
+
+    best_placements, best_angle_indices, best_cost = shim_optimizer.greedy_shim(
+        shim_basis, b0_map_vals, rings, metric, B0_nom,
+        max_passes=max_passes, min_pass_improvement=min_pass_improvement,
+        min_move_improvement=min_move_improvement, prune=prune_positions)
+    best_angles = np.where(best_placements, np.array(angles)[best_angle_indices], 0)
+    print(f'Best Shim: {best_cost}')
 
     print("--- %s seconds ---" % (time.time() - start_time))
 
@@ -299,15 +297,21 @@ else:
     best_angles = shim['Angle'].to_numpy()
 
 # Analyze final shim
-b0_map = b0_map_df.to_numpy()[:,3]
+if shim_field == 'magnitude':
+    b0_map = np.linalg.norm(b0_map_vals, axis=0)
+else:
+    b0_map = b0_map_df.to_numpy()[:,3]
 unshimmed_homogeneity_std = np.std(b0_map)/B0_nom*1e6
 unshimmed_homogeneity_ptp = np.ptp(b0_map)/B0_nom*1e6
 
 mag_pos_angle = np.concatenate((magnet_pos[best_placements,:], best_angles[best_placements, None]),1)
 shim_map = compute_fields(mag_pos_angle, sensors)
-b0_shimmed_z = shim_map[:,2]+b0_map
-shimmed_homogeneity_std = np.std(b0_shimmed_z)/B0_nom*1e6
-shimmed_homogeneity_ptp = np.ptp(b0_shimmed_z)/B0_nom*1e6
+if shim_field == 'magnitude':
+    b0_shimmed = np.linalg.norm(shim_map.T+b0_map_vals, axis=0)
+else:
+    b0_shimmed = shim_map[:,2]+b0_map
+shimmed_homogeneity_std = np.std(b0_shimmed)/B0_nom*1e6
+shimmed_homogeneity_ptp = np.ptp(b0_shimmed)/B0_nom*1e6
 
 n_magnets_in_shim = best_placements.sum()
 print(f'Final shim with {n_magnets_in_shim} magnets')
@@ -321,12 +325,12 @@ print(f'Shimmed Homogeneity   - Peak-to-peak: {shimmed_homogeneity_ptp:.0f} ppm,
 # Zs = b0_map_df.to_numpy()[:,2]
 # ax[]
 # # ax[0].scatter(Xs, Ys, Zs, c=b0_map)
-# # ax[1].scatter(Xs, Ys, Zs, c=b0_shimmed_z)
+# # ax[1].scatter(Xs, Ys, Zs, c=b0_shimmed)
 
 magpy.show(generate_magnets(mag_pos_angle))
 
 f, ax = plt.subplots(1,1)
-ax.hist((b0_map, b0_shimmed_z), 20, label = ('Unshimmed', 'Shimmed'))
+ax.hist((b0_map, b0_shimmed), 20, label = ('Unshimmed', 'Shimmed'))
 ax.legend()
 ax.set_title('Reduced Set, Std Dev Minimized')
 plt.show()
\ No newline at end of file
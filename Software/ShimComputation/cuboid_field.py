@@ -0,0 +1,221 @@
+"""Batched B-field of homogeneously magnetized cuboids, compiled with Numba
+
+Takes flat arrays of magnet positions, rotations and magnetizations and
+evaluates every magnet at every sensor in parallel on all cores. This avoids
+building one magpylib object per magnet and per sensor.
+
+The field expressions are the same as magpylib's Cuboid (Yang 1990,
+Camacho 2013), evaluated in the bottQ4 octant to avoid indeterminate forms.
+Sensors on a cuboid edge get zero field, as in magpylib.
+
+Run this file to validate the kernel against magpylib.
+"""
+
+import numpy as np
+from numba import njit, prange
+from scipy.constants import mu_0 as MU0
+
+RTOL_SURFACE = 1e-15 # relative distance tolerance to be considered on surface
+
+@njit(cache=True)
+def _cuboid_B_local(x, y, z, a, b, c, jx, jy, jz):
+    """B-field of a cuboid with half side lengths (a,b,c) centered at the origin,
+    with polarization (jx,jy,jz) in T, at observer (x,y,z)
+    """
+    # Observers on an edge get no field
+    x_dist = abs(x)-a
+    y_dist = abs(y)-b
+    z_dist = abs(z)-c
+    surf_x = abs(x_dist) < RTOL_SURFACE*a
+    surf_y = abs(y_dist) < RTOL_SURFACE*b
+    surf_z = abs(z_dist) < RTOL_SURFACE*c
+    inside_x = x_dist < RTOL_SURFACE*a
+    inside_y = y_dist < RTOL_SURFACE*b
+    inside_z = z_dist < RTOL_SURFACE*c
+    if (surf_y and surf_z and inside_x) or (surf_x and surf_z and inside_y) or (surf_x and surf_y and inside_z):
+        return 0., 0., 0.
+
+    # Move observer to its bottQ4 counterpart and keep track of the sign flips
+    sx = 1.
+    sy = 1.
+    sz = 1.
+    if x < 0:
+        x = -x
+        sx = -1.
+    if y > 0:
+        y = -y
+        sy = -1.
+    if z > 0:
+        z = -z
+        sz = -1.
+
+    xma, xpa = x-a, x+a
+    ymb, ypb = y-b, y+b
+    zmc, zpc = z-c, z+c
+
+    xma2, xpa2 = xma*xma, xpa*xpa
+    ymb2, ypb2 = ymb*ymb, ypb*ypb
+    zmc2, zpc2 = zmc*zmc, zpc*zpc
+
+    mmm = np.sqrt(xma2+ymb2+zmc2)
+    pmp = np.sqrt(xpa2+ymb2+zpc2)
+    pmm = np.sqrt(xpa2+ymb2+zmc2)
+    mmp = np.sqrt(xma2+ymb2+zpc2)
+    mpm = np.sqrt(xma2+ypb2+zmc2)
+    ppp = np.sqrt(xpa2+ypb2+zpc2)
+    ppm = np.sqrt(xpa2+ypb2+zmc2)
+    mpp = np.sqrt(xma2+ypb2+zpc2)
+
+    ff2x = (np.log((xma+mmm)*(xpa+ppm)*(xpa+pmp)*(xma+mpp))
+            - np.log((xpa+pmm)*(xma+mpm)*(xma+mmp)*(xpa+ppp)))
+    ff2y = (np.log((-ymb+mmm)*(-ypb+ppm)*(-ymb+pmp)*(-ypb+mpp))
+            - np.log((-ymb+pmm)*(-ypb+mpm)*(ymb-mmp)*(ypb-ppp)))
+    ff2z = (np.log((-zmc+mmm)*(-zmc+ppm)*(-zpc+pmp)*(-zpc+mpp))
+            - np.log((-zmc+pmm)*(zmc-mpm)*(-zpc+mmp)*(zpc-ppp)))
+
+    ff1x = (np.arctan2(ymb*zmc, xma*mmm) - np.arctan2(ymb*zmc, xpa*pmm)
+            - np.arctan2(ypb*zmc, xma*mpm) + np.arctan2(ypb*zmc, xpa*ppm)
+            - np.arctan2(ymb*zpc, xma*mmp) + np.arctan2(ymb*zpc, xpa*pmp)
+            + np.arctan2(ypb*zpc, xma*mpp) - np.arctan2(ypb*zpc, xpa*ppp))
+    ff1y = (np.arctan2(xma*zmc, ymb*mmm) - np.arctan2(xpa*zmc, ymb*pmm)
+            - np.arctan2(xma*zmc, ypb*mpm) + np.arctan2(xpa*zmc, ypb*ppm)
+            - np.arctan2(xma*zpc, ymb*mmp) + np.arctan2(xpa*zpc, ymb*pmp)
+            + np.arctan2(xma*zpc, ypb*mpp) - np.arctan2(xpa*zpc, ypb*ppp))
+    ff1z = (np.arctan2(xma*ymb, zmc*mmm) - np.arctan2(xpa*ymb, zmc*pmm)
+            - np.arctan2(xma*ypb, zmc*mpm) + np.arctan2(xpa*ypb, zmc*ppm)
+            - np.arctan2(xma*ymb, zpc*mmp) + np.arctan2(xpa*ymb, zpc*pmp)
+            + np.arctan2(xma*ypb, zpc*mpp) - np.arctan2(xpa*ypb, zpc*ppp))
+
+    sxy = sx*sy
+    sxz = sx*sz
+    syz = sy*sz
+    bx = jx*ff1x + jy*ff2z*sxy + jz*ff2y*sxz
+    by = jx*ff2z*sxy + jy*ff1y - jz*ff2x*syz
+    bz = jx*ff2y*sxz - jy*ff2x*syz + jz*ff1z
+    return bx/(4*np.pi), by/(4*np.pi), bz/(4*np.pi)
+
+@njit(cache=True)
+def _cuboid_B(p, pos, rot, half_dim, pol):
+    """B-field of one rotated and translated cuboid at observer p"""
+    # Observer in the local frame of the magnet: rot.T @ (p - pos)
+    dx = p[0]-pos[0]
+    dy = p[1]-pos[1]
+    dz = p[2]-pos[2]
+    x = rot[0,0]*dx + rot[1,0]*dy + rot[2,0]*dz
+    y = rot[0,1]*dx + rot[1,1]*dy + rot[2,1]*dz
+    z = rot[0,2]*dx + rot[1,2]*dy + rot[2,2]*dz
+    bx, by, bz = _cuboid_B_local(x, y, z, half_dim[0], half_dim[1], half_dim[2], pol[0], pol[1], pol[2])
+    # Back to the global frame: rot @ B
+    return (rot[0,0]*bx + rot[0,1]*by + rot[0,2]*bz,
+            rot[1,0]*bx + rot[1,1]*by + rot[1,2]*bz,
+            rot[2,0]*bx + rot[2,1]*by + rot[2,2]*bz)
+
+@njit(parallel=True, cache=True)
+def _getB_sum(positions, rotations, half_dims, polarizations, sensor_pos):
+    n_sensors = sensor_pos.shape[0]
+    B = np.zeros((n_sensors, 3))
+    for k in prange(n_sensors):
+        for i in range(positions.shape[0]):
+            bx, by, bz = _cuboid_B(sensor_pos[k], positions[i], rotations[i], half_dims[i], polarizations[i])
+            B[k,0] += bx
+            B[k,1] += by
+            B[k,2] += bz
+    return B
+
+@njit(parallel=True, cache=True)
+def _getB_each(positions, rotations, half_dims, polarizations, sensor_pos):
+    n_magnets = positions.shape[0]
+    n_sensors = sensor_pos.shape[0]
+    B = np.zeros((n_magnets, n_sensors, 3))
+    for i in prange(n_magnets):
+        for k in range(n_sensors):
+            B[i,k,0], B[i,k,1], B[i,k,2] = _cuboid_B(sensor_pos[k], positions[i], rotations[i], half_dims[i], polarizations[i])
+    return B
+
+def x_rotations(angles):
+    """Rotation matrices for rotations about the X axis, as used for the shim
+    magnet angles. Same as Rotation.from_euler('x', angles).as_matrix()
+    """
+    angles = np.asarray(angles, dtype=float)
+    c = np.cos(angles)
+    s = np.sin(angles)
+    rotations = np.zeros(angles.shape+(3,3))
+    rotations[...,0,0] = 1
+    rotations[...,1,1] = c
+    rotations[...,1,2] = -s
+    rotations[...,2,1] = s
+    rotations[...,2,2] = c
+    return rotations
+
+def _prepare(positions, rotations, dimensions, magnetizations, sensor_pos):
+    """Broadcast inputs to flat contiguous float arrays, one row per magnet"""
+    positions = np.ascontiguousarray(np.reshape(positions, (-1,3)), dtype=float)
+    n_magnets = positions.shape[0]
+    rotations = np.ascontiguousarray(np.broadcast_to(rotations, (n_magnets,3,3)), dtype=float)
+    half_dims = np.ascontiguousarray(np.abs(np.broadcast_to(dimensions, (n_magnets,3)))/2, dtype=float)
+    polarizations = np.ascontiguousarray(np.broadcast_to(magnetizations, (n_magnets,3))*MU0, dtype=float)
+    sensor_pos = np.ascontiguousarray(np.reshape(sensor_pos, (-1,3)), dtype=float)
+    return positions, rotations, half_dims, polarizations, sensor_pos
+
+def getB(positions, rotations, sensor_pos, dimensions, magnetizations):
+    """Total B-field (in T) of a set of cuboid magnets at a set of sensors
+    positions is a Nx3 array of magnet centers in m
+    rotations is a Nx3x3 array of rotation matrices (or a single 3x3 matrix)
+    sensor_pos is a Mx3 array of sensor positions in m
+    dimensions are the cuboid side lengths in m, either (3,) or Nx3
+    magnetizations are in A/m in the magnet frame, either (3,) or Nx3
+
+    Returns a Mx3 array
+    """
+    return _getB_sum(*_prepare(positions, rotations, dimensions, magnetizations, sensor_pos))
+
+def getB_each(positions, rotations, sensor_pos, dimensions, magnetizations):
+    """B-field (in T) of every cuboid magnet separately at a set of sensors
+    Takes the same arguments as getB
+
+    Returns a NxMx3 array
+    """
+    return _getB_each(*_prepare(positions, rotations, dimensions, magnetizations, sensor_pos))
+
+if __name__ == "__main__":
+    import time
+    import magpylib as magpy
+    from scipy.spatial.transform import Rotation as R
+
+    rng = np.random.default_rng(0)
+    n_magnets = 500
+    n_sensors = 1000
+    positions = rng.uniform(-.1, .1, (n_magnets,3))
+    rotations = R.random(n_magnets, random_state=1)
+    dimensions = rng.uniform(.002, .012, (n_magnets,3))
+    magnetizations = rng.uniform(-1.2e6, 1.2e6, (n_magnets,3))
+    sensor_pos = rng.uniform(-.05, .05, (n_sensors,3))
+    # Include sensors on a face, near an edge and inside a magnet
+    half = dimensions[0]/2
+    local = np.array([[half[0], 0, 0], [1.01*half[0], 1.01*half[1], 0], [0, 0, 0]])
+    sensor_pos[:3] = rotations[0].apply(local)+positions[0]
+
+    start_time = time.time()
+    magnets = [magpy.magnet.Cuboid(position=positions[i], orientation=rotations[i],
+                                   dimension=dimensions[i], magnetization=magnetizations[i])
+               for i in range(n_magnets)]
+    B_magpy = magpy.getB(magnets, sensor_pos)
+    print(f'magpylib: {time.time()-start_time:.3f} s')
+
+    # Compile before timing
+    getB_each(positions[:1], rotations[:1].as_matrix(), sensor_pos[:1], dimensions[:1], magnetizations[:1])
+    getB(positions[:1], rotations[:1].as_matrix(), sensor_pos[:1], dimensions[:1], magnetizations[:1])
+    start_time = time.time()
+    B_each = getB_each(positions, rotations.as_matrix(), sensor_pos, dimensions, magnetizations)
+    print(f'getB_each: {time.time()-start_time:.3f} s')
+    start_time = time.time()
+    B_sum = getB(positions, rotations.as_matrix(), sensor_pos, dimensions, magnetizations)
+    print(f'getB: {time.time()-start_time:.3f} s')
+
+    scale = np.abs(B_magpy).max()
+    print(f'Max deviation from magpylib, per magnet: {np.abs(B_each-B_magpy).max()/scale:.2e} (relative to max field)')
+    print(f'Max deviation from magpylib, total:      {np.abs(B_sum-B_magpy.sum(0)).max()/scale:.2e} (relative to max field)')
+    assert np.allclose(B_each, B_magpy, rtol=1e-9, atol=1e-12*scale)
+    assert np.allclose(B_sum, B_magpy.sum(0), rtol=1e-9, atol=1e-12*scale*n_magnets)
+    assert np.allclose(x_rotations([.3, 2.]), R.from_euler('x', [.3, 2.]).as_matrix())
+    print('cuboid_field matches magpylib')
@@ -0,0 +1,293 @@
+"""Field of the main Halbach magnet array and placement of measured magnets in its slots
+
+The OSII MINI main magnet is 9 rings (R4 ... R0 ... R4R in Build/HalbachFrame/Rings)
+of 12 mm cubes around the X (bore) axis. read_ring_dxf reads the slots of a
+ring from its DXF: every slot is a square pocket with a notch on the side the
+magnetization points to. R1 ... R3 have 32 slots on a 96 mm radius, R4 has 25
+more on a 75 mm radius. The magnets are turned by about twice the slot angle,
+as in an ideal dipolar Halbach ring (ideal_ring), with offsets, mostly within
+20 degrees, that differ from ring to ring. The homogeneity depends on them:
+with all magnets at twice their slot angle the array is 5 times less
+homogeneous. The DXF of R0 is empty, so R0 is an ideal ring. The ring pitch, 27 mm, is that of the ring grooves of the
+locating bar (Build/HalbachFrame/Locating_Bar). With identical magnets the
+model gives a std and ptp of |B| in the DSV of the example map close to the
+measured ones.
+
+The field of every slot for a unit magnetization is computed once with the
+cuboid kernel of cuboid_field.py. The field of any assignment of magnets to
+slots is then a weighted sum of the slot fields, so the predicted B0 of an
+assignment costs one matrix-vector product.
+
+assign_magnets places measured magnets (e.g. the strength table exported by
+MagnetTestStation/PythonScripts/magnetInventory.py) in the slots with a
+swap-based local search. Swapping the magnets of two slots changes B0 by the
+difference of their magnetizations times the difference of the slot fields.
+For the std cost, the change of the variance of every candidate swap follows
+from the Gram matrix of the centred slot fields, and an accepted swap updates
+the residual in O(n_sensors). For the ptp cost every candidate is evaluated
+in O(n_sensors).
+
+Run this file for an example with a synthetic batch of magnets.
+"""
+import numpy as np
+import pandas as pd
+
+import logging
+import os
+
+import cuboid_field
+
+RING_SLOTS = 32 # Slots per ring
+RING_RADIUS = .096 # m, radius of the slot centres
+MAGNET_SIDE = .012 # m
+RING_SPACING = .027 # m, pitch of the ring grooves of the locating bar
+RING_DXF_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'Build', 'HalbachFrame', 'Rings',
+                            'DXF_Files')
+# R4 ... R1; the _180 DXFs of R1R ... R4R have the same slots, the DXF of R0 is empty
+OSII_MINI_DXFS = ('Ring_4_V3 v10.dxf', 'Ring_3_V3 v5.dxf', 'Ring_2_V3 v4.dxf', 'Ring_1_V3 v1.dxf')
+
+def osii_mini_ring_x(ring_spacing=RING_SPACING, n_rings=9):
+    """X offsets of the rings, centred on the isocenter"""
+    return (np.arange(n_rings)-(n_rings-1)/2)*ring_spacing
+
+def _dxf_arcs(fname):
+    """Centres (n, 2) and radii (n,) of the arcs and circles of a DXF file"""
+    with open(fname, errors='ignore') as f:
+        lines = [line.strip() for line in f]
+    arcs = []
+    arc = None
+    for code, value in zip(lines[0::2], lines[1::2]):
+        if code == '0':
+            arc = {} if value in ('ARC', 'CIRCLE') else None
+            if arc is not None:
+                arcs.append(arc)
+        elif arc is not None and code in ('10', '20', '40'):
+            arc.setdefault(code, float(value))
+    arcs = np.array([[arc['10'], arc['20'], arc['40']] for arc in arcs]).reshape(-1, 3)
+    return arcs[:,:2], arcs[:,2]
+
+def read_ring_dxf(fname, corner_radius=2.1, notch_radius=.75, unit=1e-3):
+    """Slots of a ring from its DXF in Build/HalbachFrame/Rings
+
+    Every slot is a square pocket with reliefs of corner_radius in its corners
+    and a notch of notch_radius in the middle of the side the magnetization
+    points to. The x and y axes of the DXF are the Z and -Y axes of
+    halbach_slots.
+
+    Returns the radius (m), angle theta and magnetization angle phi (rad) of
+    every slot, from Z towards -Y, the outer slots first
+    """
+    centres, radii = _dxf_arcs(fname)
+    corners = centres[np.isclose(radii, corner_radius, atol=1e-3)]
+    notches = centres[np.isclose(radii, notch_radius, atol=1e-3)]
+    if len(notches) == 0:
+        raise ValueError(f'No slots in {fname}')
+    # The two corners next to a notch are the ends of its side, the slot centre is half a side further in
+    nearest = np.argsort(np.linalg.norm(notches[:,None]-corners[None], axis=-1), axis=1)[:,:2]
+    ends = corners[nearest]
+    normal = notches-ends.mean(axis=1)
+    normal /= np.linalg.norm(normal, axis=1, keepdims=True)
+    slots = ends.mean(axis=1)-normal*np.linalg.norm(ends[:,0]-ends[:,1], axis=1, keepdims=True)/2
+    radius = np.linalg.norm(slots, axis=1)*unit
+    theta = np.round(np.arctan2(slots[:,1], slots[:,0]), 9) % (2*np.pi)
+    phi = np.arctan2(normal[:,1], normal[:,0])
+    order = np.lexsort((theta, -np.round(radius/unit, 1)))
+    return radius[order], theta[order], phi[order]
+
+def ideal_ring(ring_radius=RING_RADIUS, n_slots=RING_SLOTS):
+    """Slots of an ideal dipolar Halbach ring, as for read_ring_dxf"""
+    theta = 2*np.pi*np.arange(n_slots)/n_slots
+    return np.full(n_slots, float(ring_radius)), theta, 2*theta
+
+def osii_mini_rings(dxf_dir=RING_DXF_DIR):
+    """Slots of the rings R4 ... R0 ... R4R, R0 an ideal ring"""
+    rings = [read_ring_dxf(os.path.join(dxf_dir, fname)) for fname in OSII_MINI_DXFS]
+    return rings+[ideal_ring()]+rings[::-1]
+
+def halbach_slots(ring_x, rings=None, ring_radius=RING_RADIUS, n_slots=RING_SLOTS, ring_angle=0., ring_dx=0.):
+    """Slot positions and magnet orientations of a multi-ring Halbach array
+
+    ring_x are the nominal X offsets of the rings (m), rings the slots of
+    every ring as returned by read_ring_dxf or osii_mini_rings. Without rings,
+    every ring is an ideal_ring of ring_radius and n_slots. ring_radius,
+    n_slots, ring_angle (rotation of the whole ring about X, rad) and ring_dx
+    (shift of the ring along X, m) are scalars or one value per ring.
+
+    Returns positions (N,3), rotations (N,3,3) of the magnets, magnetized along
+    Z in their own frame, and the ring index of every slot (N,)
+    """
+    ring_x = np.atleast_1d(np.asarray(ring_x, dtype=float))
+    n_rings = len(ring_x)
+    if rings is None:
+        rings = [ideal_ring(radius, n) for radius, n in zip(np.broadcast_to(ring_radius, n_rings),
+                                                             np.broadcast_to(n_slots, n_rings))]
+    ring_angle = np.broadcast_to(ring_angle, n_rings)
+    ring_dx = np.broadcast_to(ring_dx, n_rings)
+
+    positions = []
+    rotations = []
+    ring_index = []
+    for i in range(n_rings):
+        radius, theta, phi = rings[i]
+        # Slot at angle theta from Z towards -Y, magnet turned by phi (2*theta in an ideal ring: uniform field along Z)
+        slot_rotations = cuboid_field.x_rotations(theta)
+        local = np.zeros((len(theta),3))
+        local[:,2] = radius
+        ring_rotation = cuboid_field.x_rotations(ring_angle[i])
+        positions.append((local[:,None,:] @ np.swapaxes(ring_rotation @ slot_rotations, 1, 2))[:,0,:]
+                         + [ring_x[i]+ring_dx[i], 0, 0])
+        rotations.append(ring_rotation @ cuboid_field.x_rotations(phi))
+        ring_index.append(np.full(len(theta), i))
+    return np.concatenate(positions), np.concatenate(rotations), np.concatenate(ring_index)
+
+def slot_fields(positions, rotations, sensor_pos, magnet_side=MAGNET_SIDE):
+    """Field (T) of every slot at every sensor for a magnetization of 1 A/m,
+    as a (N, M, 3) array
+    """
+    return cuboid_field.getB_each(positions, rotations, sensor_pos, (magnet_side,)*3, (0,0,1.))
+
+def predict_field(fields, magnetizations):
+    """Field (M,3) of the array with the given magnetization (A/m) in every slot"""
+    return np.einsum('n,nmk->mk', magnetizations, fields)
+
+def homogeneity(B, B0_nom=None):
+    """Mean |B| and the ptp and std of |B| in ppm of B0_nom (the mean by default)"""
+    B_abs = np.linalg.norm(B, axis=-1)
+    B0 = np.mean(B_abs) if B0_nom is None else B0_nom
+    return np.mean(B_abs), np.ptp(B_abs)/B0*1e6, np.std(B_abs)/B0*1e6
+
+def _b0_basis(fields):
+    """Component of the slot fields along the mean field direction. For a field
+    within a few thousand ppm of uniform this is |B| up to second order terms
+    """
+    direction = fields.sum(axis=0).mean(axis=0)
+    direction /= np.linalg.norm(direction)
+    return fields @ direction
+
+def assign_magnets(fields, magnetizations, cost_fn='std', initial=None, max_passes=20, min_improvement=1e-6, seed=0):
+    """Place magnets in the slots to minimize the inhomogeneity of B0
+
+    fields are the slot fields from slot_fields (N slots), magnetizations the
+    measured magnetizations (A/m) of at least N magnets. The magnets that are
+    not placed are kept as spares and can be swapped in. initial is an array
+    of the magnet index in every slot, a random assignment by default.
+
+    Every pass tries, for every slot, swapping its magnet with that of every
+    other slot and with every spare, and takes the best swap if it improves
+    the cost by more than min_improvement (relative). Stops after a pass
+    without improvement.
+
+    Returns the magnet index of every slot and the cost (std or ptp of the
+    B0 component, in T) after every pass
+    """
+    u = _b0_basis(fields)
+    n_slots, n_sensors = u.shape
+    n_magnets = len(magnetizations)
+    if n_magnets < n_slots:
+        raise ValueError(f'{n_magnets} magnets for {n_slots} slots')
+    rng = np.random.default_rng(seed)
+    order = rng.permutation(n_magnets) if initial is None else np.concatenate(
+        (initial, np.setdiff1d(np.arange(n_magnets), initial)))
+    # Spares sit in virtual slots with no field
+    u = np.concatenate((u, np.zeros((n_magnets-n_slots, n_sensors))))
+    m = np.asarray(magnetizations, dtype=float)[order]
+
+    b = m @ u
+    if cost_fn == 'std':
+        u_c = u-u.mean(axis=1, keepdims=True)
+        gram = u_c @ u_c.T
+        diag = np.diag(gram)
+        cost = lambda: np.std(b)
+    else:
+        cost = lambda: np.ptp(b)
+    costs = [cost()]
+    for _ in range(max_passes):
+        improved = False
+        if cost_fn == 'std':
+            # Drop the rounding errors of the incremental updates
+            p = u_c @ (b-b.mean())
+        for i in range(n_slots):
+            c = m-m[i] # Change of magnetization in slot i when swapping with slot j, opposite in slot j
+            if cost_fn == 'std':
+                # n_sensors*var after the swap, from b_c.(u_i-u_j) and |u_i-u_j|^2 of the centred fields
+                change = 2*c*(p[i]-p) + c*c*(diag[i]-2*gram[i]+diag)
+                j = np.argmin(change)
+                if change[j] >= -2*min_improvement*n_sensors*np.var(b):
+                    continue
+            else:
+                candidates = b+c[:,None]*(u[i]-u)
+                change = np.ptp(candidates, axis=1)-np.ptp(b)
+                j = np.argmin(change)
+                if change[j] >= -min_improvement*np.ptp(b):
+                    continue
+            delta = c[j]*(u[i]-u[j])
+            b += delta
+            if cost_fn == 'std':
+                p += c[j]*(gram[i]-gram[j])
+            m[i], m[j] = m[j], m[i]
+            order[i], order[j] = order[j], order[i]
+            improved = True
+        costs.append(cost())
+        logging.info(f'Pass {len(costs)-1}: {cost_fn} {costs[-1]*1e6:.2f} uT')
+        if not improved:
+            break
+    return order[:n_slots], np.array(costs)
+
+def read_strength_table(fname):
+    """Magnet IDs and magnetizations (A/m) of a strength table exported by
+    magnetInventory.py
+    """
+    table = pd.read_csv(fname)
+    return table['magnet_id'].to_numpy(), table['magnetization_A_per_m'].to_numpy()
+
+def write_assignment(fname, positions, ring_index, magnet_ids, magnetizations):
+    """CSV of the magnet to put in every slot"""
+    n_slots = len(positions)
+    slot = np.concatenate([np.arange(np.sum(ring_index == i)) for i in np.unique(ring_index)])
+    pd.DataFrame({'Ring': ring_index, 'Slot': slot, 'X': positions[:,0], 'Y': positions[:,1], 'Z': positions[:,2],
+                  'magnet_id': magnet_ids, 'magnetization_A_per_m': magnetizations}).to_csv(fname, index=False)
+    logging.info(f'Wrote the magnets of {n_slots} slots to {fname}')
+
+if __name__ == "__main__":
+    import time
+
+    logging.basicConfig(format='%(levelname)s:%(message)s', level=logging.INFO)
+
+    # Strength table from magnetInventory.py, or None for a synthetic batch
+    strength_fname = None
+    assignment_fname = 'halbach_assignment.csv'
+    sensor_fname = 'example_data/NIST_Smallbach_Swap_Smoothed_shell.csv' # DSV points in mm, and the measured B0 (T)
+    magnetization = 1.1e6 # A/m, mean of the synthetic batch
+    spread = .02 # relative std of the synthetic batch
+    n_spares = 30
+    cost_fn = 'std'
+
+    sensor_map = pd.read_csv(sensor_fname, header=0, usecols=[0,1,2,3]).to_numpy()
+    sensor_pos = sensor_map[:,:3]*1e-3
+    positions, rotations, ring_index = halbach_slots(osii_mini_ring_x(), osii_mini_rings())
+    n_slots = len(positions)
+    if strength_fname is None:
+        rng = np.random.default_rng(1)
+        magnetizations = magnetization*(1+spread*rng.standard_normal(n_slots+n_spares))
+        magnet_ids = np.array([f'S-{i+1:04d}' for i in range(len(magnetizations))])
+    else:
+        magnet_ids, magnetizations = read_strength_table(strength_fname)
+
+    start_time = time.time()
+    fields = slot_fields(positions, rotations, sensor_pos)
+    logging.info(f'Field of {n_slots} slots at {len(sensor_pos)} points: {time.time()-start_time:.2f} s')
+
+    B0, ptp, std = homogeneity(sensor_map[:,3,None])
+    print(f'Measured map:       B0 {B0*1e3:.3f} mT, ptp {ptp:.0f} ppm, std {std:.1f} ppm')
+    B0, ptp, std = homogeneity(predict_field(fields, np.full(n_slots, np.mean(magnetizations))))
+    print(f'Identical magnets:  B0 {B0*1e3:.3f} mT, ptp {ptp:.0f} ppm, std {std:.1f} ppm')
+    rng = np.random.default_rng(2)
+    random_order = rng.permutation(len(magnetizations))[:n_slots]
+    B0, ptp, std = homogeneity(predict_field(fields, magnetizations[random_order]))
+    print(f'Random placement:   B0 {B0*1e3:.3f} mT, ptp {ptp:.0f} ppm, std {std:.1f} ppm')
+
+    start_time = time.time()
+    order, costs = assign_magnets(fields, magnetizations, cost_fn=cost_fn, initial=random_order)
+    B0, ptp, std = homogeneity(predict_field(fields, magnetizations[order]))
+    print(f'Optimized ({time.time()-start_time:.2f} s): B0 {B0*1e3:.3f} mT, ptp {ptp:.0f} ppm, std {std:.1f} ppm')
+    write_assignment(assignment_fname, positions, ring_index, magnet_ids[order], magnetizations[order])
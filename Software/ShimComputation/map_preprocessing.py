@@ -0,0 +1,212 @@
+"""Preprocessing of B0 maps before fitting or shimming
+
+Raw maps from the mapping robot are in robot coordinates, may be in G or m, and
+contain noisy points. The stages below are each vectorized over a whole map
+(or a chunk of one), and preprocess_map chains them while reading and writing
+large maps in chunks:
+
+    coordinate transform and isocenter centering
+    background map subtraction, matching the nearest background point with a KD-tree
+    unit normalization to mm and T
+    outlier rejection against a local fit over neighbouring points
+    shell or region masking
+
+Maps are pandas DataFrames with X, Y, Z columns followed by the field columns,
+B0 and optionally Bx, By, Bz. Output maps are in mm and T, the format read by
+the shim scripts.
+"""
+
+import numpy as np
+import pandas as pd
+from scipy.spatial import cKDTree
+
+import logging
+
+LENGTH_TO_MM = {'mm': 1., 'cm': 10., 'm': 1e3}
+FIELD_TO_T = {'T': 1., 'mT': 1e-3, 'G': 1e-4}
+VECTOR_COLUMNS = ['Bx', 'By', 'Bz']
+
+def _standard_columns(columns):
+    """X, Y, Z for the first three columns, and B0 for a |B| column called Mag"""
+    columns = list(columns)
+    columns[:3] = ['X', 'Y', 'Z']
+    return ['B0' if name.strip() == 'Mag' else name.strip() for name in columns]
+
+def read_map(fname, chunksize=None):
+    """Read a map CSV with a header row. With chunksize, returns an iterator of
+    DataFrames of up to chunksize points
+    """
+    reader = pd.read_csv(fname, header=0, chunksize=chunksize)
+    if chunksize is None:
+        reader.columns = _standard_columns(reader.columns)
+        return reader
+    return (chunk.set_axis(_standard_columns(chunk.columns), axis=1) for chunk in reader)
+
+def field_columns(map_df):
+    return [name for name in map_df.columns if name not in ('X', 'Y', 'Z')]
+
+def normalize_units(map_df, l_unit='mm', B_unit='T'):
+    """Convert positions from l_unit ('mm', 'cm' or 'm') to mm and fields from
+    B_unit ('T', 'mT' or 'G') to T
+    """
+    map_df = map_df.copy()
+    map_df[['X','Y','Z']] *= LENGTH_TO_MM[l_unit]
+    map_df[field_columns(map_df)] *= FIELD_TO_T[B_unit]
+    return map_df
+
+def transform_coordinates(map_df, isocenter=(0,0,0), rotation=None):
+    """New coordinates p' = rotation @ (p - isocenter)
+    rotation is a 3x3 matrix, e.g. to go from robot to magnet axes. Bx, By, Bz
+    columns are rotated with the coordinates
+    """
+    map_df = map_df.copy()
+    points = map_df[['X','Y','Z']].to_numpy() - np.asarray(isocenter, dtype=float)
+    if rotation is not None:
+        rotation = np.asarray(rotation, dtype=float)
+        points = points @ rotation.T
+        if all(name in map_df.columns for name in VECTOR_COLUMNS):
+            map_df[VECTOR_COLUMNS] = map_df[VECTOR_COLUMNS].to_numpy() @ rotation.T
+    map_df[['X','Y','Z']] = points
+    return map_df
+
+def background_tree(background_df):
+    """KD-tree of background map positions, built once and reused for every chunk"""
+    return cKDTree(background_df[['X','Y','Z']].to_numpy())
+
+def subtract_background(map_df, background_df, tree=None, max_distance=np.inf):
+    """Subtract the field of the nearest background map point from every point
+    Only the field columns present in both maps are subtracted. Points with no
+    background point within max_distance (mm) are dropped
+    """
+    if tree is None:
+        tree = background_tree(background_df)
+    distance, nearest = tree.query(map_df[['X','Y','Z']].to_numpy(), distance_upper_bound=max_distance)
+    matched = np.isfinite(distance)
+    if not matched.all():
+        logging.info(f'Dropped {np.sum(~matched)} points with no background point within {max_distance} mm')
+    map_df = map_df[matched].copy()
+    columns = [name for name in field_columns(map_df) if name in background_df.columns]
+    map_df[columns] -= background_df[columns].to_numpy()[nearest[matched]]
+    return map_df
+
+def _local_fit_terms(offsets):
+    """Terms of a quadratic in the offsets (..., 3) from a point: 1, x, y, z,
+    then the six products, so that the first 1 and 4 terms are the constant
+    and linear fits
+    """
+    products = [offsets[...,i]*offsets[...,j] for i in range(3) for j in range(i, 3)]
+    return np.stack([np.ones(offsets.shape[:-1])]+[offsets[...,i] for i in range(3)]+products, axis=-1)
+
+def reject_outliers(map_df, column='B0', n_neighbours=18, threshold=8.):
+    """Drop points whose field differs from a local least squares fit over
+    their n_neighbours nearest points by more than threshold standard errors
+
+    The fit is a quadratic in the position, which follows the field gradient
+    and curvature on the surface of the map as well as inside it. Where the
+    neighbours do not determine a quadratic (e.g. at the poles of a map on a
+    grid, whose neighbours lie on two planes) a linear fit is used. The
+    standard error is the residual std of the fit, at least its median over
+    the map, scaled for the extrapolation to the point
+    """
+    points = map_df[['X','Y','Z']].to_numpy()
+    values = map_df[column].to_numpy()
+    _, neighbours = cKDTree(points).query(points, k=n_neighbours+1)
+    A = _local_fit_terms(points[neighbours[:,1:]]-points[:,None])
+    y = values[neighbours[:,1:]]
+
+    prediction = np.empty(len(points))
+    std = np.empty(len(points))
+    leverage = np.empty(len(points))
+    todo = np.ones(len(points), dtype=bool)
+    for n_terms in (10, 4, 1):
+        fit = todo & (np.linalg.matrix_rank(A[...,:n_terms]) == n_terms)
+        if not fit.any():
+            continue
+        A_fit = A[fit,:,:n_terms]
+        pseudo_inverse = np.linalg.pinv(A_fit)
+        coeffs = np.einsum('ptk,pk->pt', pseudo_inverse, y[fit])
+        # The constant term is the fit at the point, its first row of the pseudo-inverse gives the leverage
+        first_row = pseudo_inverse[:,0]
+        prediction[fit] = coeffs[:,0]
+        residual = np.einsum('pkt,pt->pk', A_fit, coeffs) - y[fit]
+        std[fit] = np.sqrt(np.sum(residual**2, axis=1)/max(n_neighbours-n_terms, 1))
+        leverage[fit] = np.sum(first_row**2, axis=1)
+        todo &= ~fit
+    error = (values-prediction)/(np.maximum(std, np.median(std))*np.sqrt(1+leverage))
+    keep = np.abs(error) <= threshold
+    logging.info(f'Rejected {np.sum(~keep)} outliers of {len(keep)} points')
+    return map_df[keep]
+
+def mask_region(map_df, r_min=None, r_max=np.inf, box=None):
+    """Keep points with r_min < r <= r_max from the origin, e.g. r_min = 45 for
+    the outer shell of a 100 mm DSV map, and inside box = ((x0,x1),(y0,y1),(z0,z1))
+    """
+    points = map_df[['X','Y','Z']].to_numpy()
+    r = np.linalg.norm(points, axis=-1)
+    keep = r <= r_max
+    if r_min is not None:
+        keep &= r > r_min
+    if box is not None:
+        for axis, (low, high) in enumerate(box):
+            keep &= (points[:,axis] >= low) & (points[:,axis] <= high)
+    return map_df[keep]
+
+def map_centroid(fname, l_unit='mm', chunksize=100000):
+    """Mean position of the points of a map in mm, read in chunks"""
+    total = np.zeros(3)
+    n_points = 0
+    for chunk in read_map(fname, chunksize):
+        total += chunk[['X','Y','Z']].to_numpy().sum(axis=0)
+        n_points += len(chunk)
+    return total/n_points*LENGTH_TO_MM[l_unit]
+
+def write_map(map_df, fname, mode='w'):
+    map_df.to_csv(fname, mode=mode, header=(mode == 'w'), index=False)
+
+def preprocess_map(fname, out_fname, l_unit='mm', B_unit='T', isocenter=(0,0,0), rotation=None,
+                   background_fname=None, max_background_distance=np.inf,
+                   outlier_column=None, n_neighbours=18, outlier_threshold=8.,
+                   r_min=None, r_max=np.inf, box=None, chunksize=100000):
+    """Run the preprocessing stages on the map in fname and write the result
+    to out_fname
+
+    isocenter is in mm in the coordinates of the map, or 'centroid' to center
+    the map on the mean of its points. The background map must already be in
+    mm, T and the output coordinates. Outlier rejection on outlier_column
+    needs the neighbours of every point, so it runs once on the masked map;
+    all other stages run chunk by chunk.
+
+    Returns the preprocessed map
+    """
+    if isinstance(isocenter, str) and isocenter == 'centroid':
+        isocenter = map_centroid(fname, l_unit, chunksize)
+        logging.info(f'Centering map on centroid {isocenter} mm')
+    if background_fname is not None:
+        background_df = read_map(background_fname)
+        tree = background_tree(background_df)
+
+    chunks = []
+    n_points = 0
+    for chunk in read_map(fname, chunksize):
+        n_points += len(chunk)
+        chunk = normalize_units(chunk, l_unit, B_unit)
+        chunk = transform_coordinates(chunk, isocenter, rotation)
+        if background_fname is not None:
+            chunk = subtract_background(chunk, background_df, tree, max_background_distance)
+        chunks.append(mask_region(chunk, r_min, r_max, box))
+    map_df = pd.concat(chunks, ignore_index=True)
+
+    if outlier_column is not None:
+        map_df = reject_outliers(map_df, outlier_column, n_neighbours, outlier_threshold)
+
+    write_map(map_df, out_fname)
+    logging.info(f'Preprocessed {fname}: {n_points} points in, {len(map_df)} points written to {out_fname}')
+    return map_df
+
+if __name__ == "__main__":
+    logging.basicConfig(format='%(levelname)s:%(message)s', level=logging.INFO)
+
+    # Raw robot map to a centered map, and its outer shell for shimming
+    centered = preprocess_map('example_data/20240924_Smallbach_swap.csv', 'Smallbach_swap_centered.csv',
+                              isocenter='centroid', outlier_column='B0')
+    shell = preprocess_map('Smallbach_swap_centered.csv', 'Smallbach_swap_centered_shell.csv', r_min=45)
@@ -0,0 +1,238 @@
+"""Field basis for rings of shim magnet positions from one field expansion per ring
+
+All positions in a ring of the shim trays have the same X offset and radius,
+and only differ by their azimuth about the X (bore) axis. Instead of computing
+the field of every position separately, the field of one reference magnet per
+ring is expanded in solid harmonics about the isocenter, with X as the polar
+axis. Rotating the magnet about X only changes the phase of each order m of
+the expansion, so the field of every other position in the ring follows from
+the same coefficients.
+
+The components are expanded as G = Bz + iBy and H = Bx. Under a rotation by
+theta about X, H is a scalar and G picks up an extra factor exp(-i*theta), so
+the coefficient of order m is multiplied by exp(i*m*theta) for H and by
+exp(i*(m-1)*theta) for G.
+
+The slots of a ring sit on an equally spaced grid of azimuths, so the sum over
+m for every slot is evaluated at once with an FFT over the grid. The sums over
+the degree n, for every order m, of all rings and sensors are one batched
+matrix product, so apart from the expansions the cost is that of writing the
+basis.
+
+The rotated reference cube keeps its faces aligned with the slot, while the
+shim cubes are only rotated by the shim angle. Outside a cube the two only
+differ in multipoles of order 4 and above, which for the OSII MINI trays and
+map changes the basis by around 5e-5 of the largest field value.
+
+Run this file to compare the ring expansion with direct field computation.
+"""
+
+import numpy as np
+
+import logging
+
+import cuboid_field
+
+def _legendre(x, order):
+    """Fully normalized associated Legendre functions (no Condon-Shortley phase)
+    P[n,m] for 0 <= m <= n <= order at the points x = cos(theta)
+    """
+    P = np.zeros((order+1, order+1)+np.shape(x))
+    sin_theta = np.sqrt(np.clip(1-x**2, 0, None))
+    P[0,0] = 1/np.sqrt(4*np.pi)
+    for m in range(order+1):
+        if m > 0:
+            P[m,m] = np.sqrt((2*m+1)/(2*m))*sin_theta*P[m-1,m-1]
+        if m < order:
+            P[m+1,m] = np.sqrt(2*m+3)*x*P[m,m]
+        for n in range(m+2, order+1):
+            a = np.sqrt((4*n**2-1)/(n**2-m**2))
+            b = np.sqrt(((n-1)**2-m**2)/(4*(n-1)**2-1))
+            P[n,m] = a*(x*P[n-1,m]-b*P[n-2,m])
+    return P
+
+def n_m_indices(order):
+    """Degree n and order m of each coefficient, ordered n = 0..order and m = -n..n"""
+    n = np.concatenate([np.full(2*k+1, k) for k in range(order+1)])
+    m = np.concatenate([np.arange(-k, k+1) for k in range(order+1)])
+    return n, m
+
+def solid_harmonics_x(points, order, r0):
+    """Complex regular solid harmonics (r/r0)^n P[n,|m|](cos theta) exp(i m psi)
+    with X as the polar axis and azimuth psi measured from +Z towards +Y,
+    matching the shim position convention Y = r sin(psi), Z = r cos(psi)
+
+    Returns a M x (order+1)^2 array
+    """
+    x, y, z = np.asarray(points, dtype=float).T
+    r = np.sqrt(x**2+y**2+z**2)
+    cos_theta = np.divide(x, r, out=np.ones_like(r), where=r>0)
+    psi = np.arctan2(y, z)
+
+    P = _legendre(cos_theta, order)
+    n, m = n_m_indices(order)
+    radial = (r/r0)[:,None]**np.arange(order+1)[None,:]
+    return radial[:,n]*P[n,np.abs(m)].T*np.exp(1j*m[None,:]*psi[:,None])
+
+def sphere_grid(order, radius):
+    """Gauss-Legendre in theta x uniform in psi grid on a sphere about the X axis,
+    fine enough to integrate products of all harmonics up to the given order
+
+    Returns the grid points and their quadrature weights on the unit sphere
+    """
+    cos_theta, w_theta = np.polynomial.legendre.leggauss(order+1)
+    n_psi = 2*order+2
+    psi = np.linspace(0, 2*np.pi, n_psi, endpoint=False)
+    cos_theta, psi = np.meshgrid(cos_theta, psi, indexing='ij')
+    sin_theta = np.sqrt(1-cos_theta**2)
+    points = radius*np.stack([cos_theta.ravel(), (sin_theta*np.sin(psi)).ravel(), (sin_theta*np.cos(psi)).ravel()], axis=-1)
+    weights = np.repeat(w_theta*2*np.pi/n_psi, n_psi)
+    return points, weights
+
+def _order_sums(S, coeffs, n, m):
+    """Sums over the degree n of S[:,k]*coeffs[k,c] for every order m, for all
+    columns c at once. The harmonics are laid out by order and degree so that
+    this is one batched matrix product, over the orders, of the sensors by
+    degrees block of S with the degrees by columns block of coeffs.
+
+    S is a M x K array of harmonics, coeffs a K x C array
+    Returns the orders m and a M x C x n_orders array
+    """
+    m_values = np.arange(m.min(), m.max()+1)
+    S_blocks = np.zeros((len(m_values), S.shape[0], n.max()+1), dtype=complex)
+    S_blocks[m-m_values[0],:,n] = S.T
+    coeff_blocks = np.zeros((len(m_values), n.max()+1, coeffs.shape[1]), dtype=complex)
+    coeff_blocks[m-m_values[0],n] = coeffs
+    return m_values, np.matmul(S_blocks, coeff_blocks).transpose(1, 2, 0)
+
+def _ring_sum_fft(D, m_values, shifts, psi0, n_slots):
+    """Evaluate sum over m of D[...,m]*exp(-i*(m-shift)*psi) at all n_slots
+    equally spaced azimuths psi = psi0 + 2*pi*p/n_slots at once, a discrete
+    Fourier transform of length n_slots.
+
+    D is a M x C x n_orders array of the sums of _order_sums, with one shift per column
+    Returns a M x C x n_slots array
+    """
+    n_fold = -(-len(m_values)//n_slots)
+    out = np.empty(D.shape[:2]+(n_slots,), dtype=complex)
+    for c, shift in enumerate(shifts):
+        D_c = D[:,c]*np.exp(-1j*(m_values-shift)*psi0)
+        # Orders that differ by n_slots have the same phase at every slot
+        D_c = np.pad(D_c, ((0,0), (0,n_fold*n_slots-len(m_values)))).reshape(-1, n_fold, n_slots).sum(axis=1)
+        out[:,c,:] = np.fft.fft(np.roll(D_c, m_values[0]-shift, axis=-1), axis=-1)
+    return out
+
+def group_rings(magnet_pos, decimals=9):
+    """Group magnet position indices into rings of equal X offset and radius
+    Returns a list of (X, radius, indices)
+    """
+    radius = np.round(np.sqrt(magnet_pos[:,1]**2+magnet_pos[:,2]**2), decimals)
+    X = np.round(magnet_pos[:,0], decimals)
+    rings = []
+    for X_ring, r_ring in sorted(set(zip(X, radius))):
+        rings.append((X_ring, r_ring, np.flatnonzero((X == X_ring) & (radius == r_ring))))
+    return rings
+
+def compute_field_basis_rings(magnet_pos, angles, sensor_pos, cube_dims, cube_mag, tol=1e-6, max_order=50):
+    """Compute field of a single magnet at every position and angle from one
+    field expansion per ring of positions. Same inputs and output as
+    shim_optimizer.compute_field_basis
+
+    The degree of the expansion of each ring is chosen so the truncation error
+    at the outermost sensor is around tol relative to the field, limited to
+    max_order. Rings further from the isocenter need fewer terms.
+    """
+    sensor_pos = np.asarray(sensor_pos, dtype=float)
+    magnet_pos = np.asarray(magnet_pos, dtype=float)
+    n_magnets = magnet_pos.shape[0]
+    n_angles = len(angles)
+    n_sensors = sensor_pos.shape[0]
+    rings = group_rings(magnet_pos)
+
+    # The expansion converges inside the sphere that touches the closest magnet
+    r_fit = np.max(np.linalg.norm(sensor_pos, axis=-1))
+    half_diag = np.linalg.norm(cube_dims)/2
+    r_source = np.array([np.hypot(X, r) for X, r, _ in rings])-half_diag
+    if r_fit >= r_source.min():
+        raise ValueError(f'Sensors up to {r_fit*1e3:.1f} mm from isocenter are too close to the '
+                         f'shim magnets at {r_source.min()*1e3:.1f} mm for a field expansion')
+    orders = np.minimum(np.ceil(np.log(tol)/np.log(r_fit/r_source)), max_order).astype(int)
+    order = orders.max()
+
+    # Only the unit magnetizations that contribute to cube_mag are needed.
+    # The reference magnets sit at azimuth 0, i.e. on the +Z axis
+    unit_mags = [e for e in range(3) if cube_mag[e] != 0 or (e > 0 and (cube_mag[1] != 0 or cube_mag[2] != 0))]
+    grid, weights = sphere_grid(order, r_fit)
+    rhs = []
+    for X, r, _ in rings:
+        B_ref = cuboid_field.getB_each(np.tile([X, 0., r], (len(unit_mags),1)), np.eye(3), grid, cube_dims, np.eye(3)[unit_mags])
+        for e in range(len(unit_mags)):
+            rhs.append(B_ref[e,:,2]+1j*B_ref[e,:,1]) # G
+            rhs.append(B_ref[e,:,0]+0j)              # H
+    # On the sphere the harmonics are orthonormal, so the coefficients follow by quadrature
+    A = solid_harmonics_x(grid, order, r_fit)
+    coeffs = (A.conj().T @ (weights[:,None]*np.stack(rhs, axis=-1))).reshape(-1, len(rings), len(unit_mags), 2)
+
+    n, m = n_m_indices(order)
+    S = solid_harmonics_x(sensor_pos, order, r_fit)
+    # Every ring uses the terms up to its own degree, the sums over degree of all rings are one product
+    coeffs = coeffs.reshape(len(n), len(rings), -1).copy()
+    coeffs[n[:,None] > orders[None,:]] = 0
+    m_values, D = _order_sums(S, coeffs.reshape(len(n), -1), n, m)
+    D = D.reshape(n_sensors, len(rings), -1, len(m_values))
+    shifts = np.tile([1,0], len(unit_mags))
+    basis = np.empty((n_magnets, n_angles, n_sensors, 3)) # Every position is in a ring
+    for k, (X, r, indices) in enumerate(rings):
+        psi = np.arctan2(magnet_pos[indices,1], magnet_pos[indices,2])
+        # Rotate the expansion to every slot in the ring: theta = -psi
+        # Slots usually sit on an equally spaced grid of azimuths, possibly with gaps
+        spacing = np.diff(np.sort(psi))
+        n_grid = int(round(2*np.pi/spacing.min())) if len(psi) > 1 and spacing.min() > 0 else 1
+        slot = (psi-psi[0])*n_grid/(2*np.pi)
+        if np.allclose(slot, np.round(slot), atol=1e-6):
+            p = np.round(slot).astype(int) % n_grid
+            GH = _ring_sum_fft(D[:,k], m_values, shifts, psi[0], n_grid)[...,p]
+        else:
+            GH = np.stack([D[:,k,c] @ np.exp(-1j*(m_values[:,None]-shift)*psi[None,:])
+                           for c, shift in enumerate(shifts)], axis=1)
+        GH = GH.reshape(n_sensors, len(unit_mags), 2, len(indices)).transpose(3, 1, 2, 0)
+        F = np.zeros((len(indices), 3, n_sensors, 3)) # slot, unit magnetization, sensor, B component
+        F[:,unit_mags] = np.stack((GH[:,:,1].real, GH[:,:,0].imag, GH[:,:,0].real), axis=-1)
+        # Magnetization of the reference magnet that rotates onto every slot and angle
+        beta = np.asarray(angles)[None,:]+psi[:,None]
+        mx, my, mz = cube_mag
+        weights = np.stack((np.full(beta.shape, float(mx)), my*np.cos(beta)-mz*np.sin(beta), my*np.sin(beta)+mz*np.cos(beta)), axis=-1)
+        basis[indices] = np.matmul(weights, F.reshape(len(indices), 3, -1)).reshape(len(indices), n_angles, n_sensors, 3)
+    logging.info(f'Computed field basis for {n_magnets} positions in {len(rings)} rings at {n_angles} angles '
+                 f'from expansions of order {orders.min()} to {order}')
+    return basis
+
+if __name__ == "__main__":
+    import time
+    import numba
+    import pandas as pd
+
+    magnet_pos = pd.read_csv('example_data/OSII_MINI.csv', header=0, names=['X','Y','Z']).to_numpy()
+    sensor_pos = pd.read_csv('example_data/NIST_Smallbach_Swap_Smoothed_shell.csv', header=0, usecols=[0,1,2]).to_numpy()*1e-3
+    angles = list(np.linspace(0,2*np.pi,4,endpoint=False))
+    cube_dims = (.003,.003,.003)
+    cube_mag = (0,0,1185704)
+
+    # Compile both calls of the kernel before timing
+    compute_field_basis_rings(magnet_pos[:1], angles, sensor_pos[:1], cube_dims, cube_mag)
+    cuboid_field.getB_each(magnet_pos[:1], np.eye(3), sensor_pos[:1], cube_dims, cube_mag)
+
+    start_time = time.time()
+    basis_rings = compute_field_basis_rings(magnet_pos, angles, sensor_pos, cube_dims, cube_mag)
+    rings_time = time.time()-start_time
+    print(f'Ring expansion: {rings_time:.2f} s')
+
+    start_time = time.time()
+    basis_direct = np.stack([cuboid_field.getB_each(magnet_pos, cuboid_field.x_rotations(angle), sensor_pos, cube_dims, cube_mag)
+                             for angle in angles], axis=1)
+    direct_time = time.time()-start_time
+    print(f'Direct:         {direct_time:.2f} s on {numba.get_num_threads()} threads, '
+          f'{direct_time/rings_time:.1f} times the ring expansion')
+
+    error = np.abs(basis_rings-basis_direct).max()/np.abs(basis_direct).max()
+    print(f'Max deviation: {error:.2e} (relative to max field)')
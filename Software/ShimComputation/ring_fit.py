@@ -0,0 +1,213 @@
+"""Fit of the as-built Halbach array to a measured B0 map
+
+The shim optimizers take the measured map as it is. When shimming goes wrong
+it helps to know whether a ring is weaker than the others (a bad magnet
+batch) or sits off its nominal position or angle. fit_rings fits a scale of
+the magnetization, an X offset and a rotation of every ring of the
+halbach_sim.py model to the |B| of a measured map.
+
+The field of every ring and its derivatives with respect to offset and
+rotation come from ring_tuning.ring_jacobian. Around that linearization the
+model is exact in the scales and linear in the geometry, so the nonlinear
+least squares fit of |B| runs on (M, 3, n_rings) arrays without evaluating
+any magnet. The linearization is then repeated at the fitted geometry, a few
+times at most, as the offsets of an as-built magnet are small.
+
+Every parameter has a tolerance, the deviation expected from the build
+(magnet grade spread, frame machining), and only a weak prior of several
+tolerances. The rings of halbach_sim.osii_mini_rings differ in their magnet
+angles, so every ring has its own field pattern and the |B| in the DSV
+separates the scale, offset and rotation of every ring. Rings that are all
+alike (ideal rings) do not: a shift of one looks much like a change of its
+scale or of the other rings. report_fit flags the parameters that are
+beyond their tolerance by several times their uncertainty after the fit,
+and marks those whose uncertainty is beyond their tolerance as not
+identifiable from the map. What the rings cannot explain (single bad
+magnets, mapping errors) is left in the residual, as far as it differs from
+the field of a ring. Inside a DSV well clear of the magnets the field of a
+single bad magnet is of low order too and partly aliases into the ring
+parameters, so compare the flagged parameters with their uncertainty, and
+set map_noise to the field the rings are not expected to explain.
+
+Run this file to fit a simulated as-built magnet on the points of the example
+map.
+"""
+
+import numpy as np
+from scipy.optimize import least_squares
+
+import logging
+
+import cuboid_field
+import ring_tuning
+
+PARAMETERS = ('scale', 'dx', 'angle') # Relative magnetization error, X offset (m), rotation (rad) of every ring
+TOLERANCES = (.02, 3e-4, np.radians(1.)) # Expected deviations of the as-built rings, the offsets set by the frame
+
+def _x_cross(v):
+    """Cross product of the X unit vector with the vectors v (..., 3)"""
+    return np.stack((np.zeros(v.shape[:-1]), -v[...,2], v[...,1]), axis=-1)
+
+def _linear_model(x, x_lin, B_rings, d_dx, d_spatial):
+    """Field (M, 3) for the parameters x (n_rings, 3) linearized at the geometry
+    x_lin, with the ring fields (n_rings, M, 3) rotated by the change of angle
+    and before rotating them, also returned
+    """
+    step = x[:,1:]-x_lin[:,1:]
+    unrotated = B_rings+d_dx*step[:,0,None,None]+d_spatial*step[:,1,None,None]
+    rotation = cuboid_field.x_rotations(step[:,1])
+    rings = np.einsum('rij,rmj->rmi', rotation, unrotated)
+    return np.einsum('r,rmk->mk', 1+x[:,0], rings), rings, rotation
+
+def _map_jacobian(params, x_lin, B_rings, d_dx, d_spatial):
+    """Derivatives (M, n_rings*3) of the |B| of the linear model"""
+    B, rings, rotation = _linear_model(params, x_lin, B_rings, d_dx, d_spatial)
+    direction = B/np.linalg.norm(B, axis=1, keepdims=True)
+    d_map = np.empty((len(B), len(params), len(PARAMETERS)))
+    d_map[:,:,0] = np.einsum('mk,rmk->mr', direction, rings)
+    d_map[:,:,1] = np.einsum('mk,rki,rmi->mr', direction, rotation, d_dx)
+    d_map[:,:,2] = np.einsum('mk,rmk->mr', direction, _x_cross(rings)+np.einsum('rki,rmi->rmk', rotation, d_spatial))
+    d_map[:,:,1:] *= (1+params[:,0])[None,:,None]
+    return d_map.reshape(len(B), -1)
+
+def fit_rings(ring_x, sensor_pos, B0_measured, magnetizations, tolerances=TOLERANCES, map_noise=1e-6,
+              n_linearizations=3, x0=None, prior_width=10., **kwargs):
+    """Fit the scale, X offset and rotation of every ring to a measured |B|
+
+    ring_x are the nominal X offsets of the rings (m), sensor_pos (M, 3) the
+    map points (m), B0_measured (M,) the measured |B| (T) and magnetizations
+    (A/m) the nominal magnetization, a scalar or one value per slot.
+    tolerances are the expected deviations of the parameters. map_noise (T)
+    is what the rings are not expected to explain: the map accuracy and the
+    field of single bad magnets and unmodelled parts. Too small a value bends
+    the ring parameters to explain it.
+
+    Every parameter gets a weak prior of prior_width tolerances, so that a
+    ring that is really off is not pulled back towards its nominal value.
+    Parameters the map does not determine stay close to that prior, with an
+    uncertainty of the order of prior_width tolerances.
+
+    The linearization is repeated until the geometry moves by less than 10%
+    of its tolerances, at most n_linearizations times. The derivatives are
+    computed once. kwargs (magnet_side, rings, ring_radius, n_slots) go to
+    ring_tuning.ring_fields.
+
+    Returns the parameters (n_rings, 3) as in PARAMETERS, the fitted |B| (M,)
+    and the standard deviation (n_rings, 3) of the parameters after the fit.
+    """
+    n_rings = len(np.atleast_1d(ring_x))
+    tolerances = np.broadcast_to(tolerances, (n_rings, len(PARAMETERS))).astype(float).ravel()
+    x = np.zeros((n_rings, len(PARAMETERS))) if x0 is None else np.array(x0, dtype=float)
+    prior = np.diag(1/(prior_width*tolerances))
+
+    for linearization in range(n_linearizations):
+        if linearization == 0:
+            B_rings, jacobian = ring_tuning.ring_jacobian(ring_x, sensor_pos, magnetizations, ring_dx=x[:,1],
+                                                          ring_angle=x[:,2], **kwargs)
+            d_dx, d_angle = jacobian.transpose(3, 2, 0, 1)
+            # A turn of a ring turns its field vectors, which is kept exact, and moves the field
+            # pattern, which is linearized
+            d_spatial = d_angle-_x_cross(B_rings)
+        else:
+            # The derivatives change little, only the ring fields are computed again
+            B_rings = ring_tuning.ring_fields(ring_x, sensor_pos, magnetizations, ring_dx=x[:,1], ring_angle=x[:,2],
+                                              **kwargs)
+        model = (x.copy(), B_rings, d_dx, d_spatial)
+
+        def residuals(params):
+            B, _, _ = _linear_model(params.reshape(x.shape), *model)
+            return np.concatenate(((np.linalg.norm(B, axis=1)-B0_measured)/map_noise, prior @ params))
+
+        def residual_jacobian(params):
+            return np.vstack((_map_jacobian(params.reshape(x.shape), *model)/map_noise, prior))
+
+        result = least_squares(residuals, x.ravel(), jac=residual_jacobian, x_scale=tolerances, method='lm')
+        step = result.x.reshape(x.shape)-x
+        x = result.x.reshape(x.shape)
+        rms = np.sqrt(np.mean(result.fun[:len(B0_measured)]**2))*map_noise
+        logging.info(f'Linearization {linearization+1}: rms residual {rms*1e6:.2f} uT, {result.nfev} evaluations')
+        if np.all(np.abs(step[:,1:]) < .1*tolerances.reshape(x.shape)[:,1:]):
+            break
+
+    B, _, _ = _linear_model(x, *model)
+    uncertainty = np.sqrt(np.diag(np.linalg.inv(result.jac.T @ result.jac))).reshape(x.shape)
+    return x, np.linalg.norm(B, axis=1), uncertainty
+
+def report_fit(x, uncertainty, B0_fit, B0_measured, tolerances=TOLERANCES, ring_names=None, threshold=3.):
+    """Print the fitted parameters of every ring with their uncertainty,
+    marking with * those that are off: beyond their tolerance by more than
+    threshold times their uncertainty, and with ? those that the map does not
+    identify: with an uncertainty beyond their tolerance. Then the residual
+    of the map the rings do not explain. Returns the list of (ring name,
+    parameter) that are off
+    """
+    n_rings = len(x)
+    tolerances = np.broadcast_to(tolerances, x.shape)
+    ring_names = [str(i) for i in range(n_rings)] if ring_names is None else ring_names
+    identified = uncertainty < tolerances
+    off = identified & (np.abs(x)-tolerances > threshold*uncertainty)
+    units = (100., 1e3, 180/np.pi)
+    print(f'{"Ring":>6} {"scale (%)":>17} {"dx (mm)":>17} {"angle (deg)":>17}')
+    for i in range(n_rings):
+        values = [f'{x[i,p]*units[p]:+7.2f} +- {uncertainty[i,p]*units[p]:5.2f}'+('*' if off[i,p] else
+                                                                                    ' ' if identified[i,p] else '?')
+                  for p in range(len(PARAMETERS))]
+        print(f'{ring_names[i]:>6} '+' '.join(values))
+    if not np.all(identified):
+        print('? not identifiable from the map, the uncertainty is beyond the tolerance')
+
+    B0 = np.mean(B0_measured)
+    residual = B0_measured-B0_fit
+    measured = B0_measured-B0
+    print(f'Measured:   ptp {np.ptp(measured)/B0*1e6:.0f} ppm, std {np.std(measured)/B0*1e6:.0f} ppm')
+    print(f'Unexplained: ptp {np.ptp(residual)/B0*1e6:.0f} ppm, std {np.std(residual)/B0*1e6:.0f} ppm, '
+          f'mean {np.mean(residual)/B0*1e6:+.0f} ppm')
+    return [(ring_names[i], PARAMETERS[p]) for i, p in zip(*np.nonzero(off))]
+
+if __name__ == "__main__":
+    import time
+
+    import halbach_sim
+    import map_preprocessing
+
+    logging.basicConfig(format='%(levelname)s:%(message)s', level=logging.INFO)
+
+    # Points of the example map, with the |B| of a simulated as-built magnet
+    map_fname = 'example_data/NIST_Smallbach_Swap_Smoothed.csv' # mm, bore along X
+    magnetization = 1.1e6 # A/m, nominal
+    ring_x = halbach_sim.osii_mini_ring_x()
+    rings = halbach_sim.osii_mini_rings()
+    ring_names = ['R4', 'R3', 'R2', 'R1', 'R0', 'R1R', 'R2R', 'R3R', 'R4R']
+    tolerances = TOLERANCES
+    map_noise = 2e-6 # T
+    bad_rings = {'R2R': ('scale', -.06), 'R1': ('dx', 2e-3)} # Errors well outside the tolerances
+    n_bad_magnets = 0 # Single magnets at 90%, which the ring model cannot explain
+
+    map_df = map_preprocessing.read_map(map_fname)
+    sensor_pos = map_df[['X','Y','Z']].to_numpy()*1e-3
+
+    rng = np.random.default_rng(0)
+    x_true = rng.normal(0, .5, (len(ring_x), len(PARAMETERS)))*tolerances
+    x_true[:,2] -= x_true[ring_names.index('R0'),2] # |B| does not change when all rings turn together
+    for ring, (parameter, value) in bad_rings.items():
+        x_true[ring_names.index(ring), PARAMETERS.index(parameter)] = value
+    _, _, ring_index = halbach_sim.halbach_slots(ring_x, rings)
+    slot_magnetizations = magnetization*(1+x_true[ring_index,0])
+    slot_magnetizations[rng.choice(len(ring_index), n_bad_magnets, replace=False)] *= .9
+    B = ring_tuning.ring_fields(ring_x, sensor_pos, slot_magnetizations, x_true[:,1], x_true[:,2],
+                               rings=rings).sum(axis=0)
+    B0_measured = np.linalg.norm(B, axis=1)+rng.normal(0, map_noise, len(sensor_pos))
+
+    start_time = time.time()
+    x, B0_fit, uncertainty = fit_rings(ring_x, sensor_pos, B0_measured, magnetization, tolerances=tolerances,
+                                       map_noise=map_noise, rings=rings)
+    logging.info(f'Fit of {len(ring_x)} rings to {len(sensor_pos)} points: {time.time()-start_time:.1f} s')
+    off = report_fit(x, uncertainty, B0_fit, B0_measured, tolerances=tolerances, ring_names=ring_names)
+    print('Off: '+(', '.join(f'{ring} {parameter}' for ring, parameter in off) or 'none'))
+    error = np.abs(x-x_true)/tolerances
+    print('Largest fit error in tolerances: '+', '.join(f'{p} {e:.2f}' for p, e in zip(PARAMETERS, error.max(axis=0))))
+    missed = [(ring, parameter) for ring, (parameter, _) in bad_rings.items() if (ring, parameter) not in off]
+    assert not missed, f'Planted errors not found: {missed}'
+    spurious = [(ring, parameter) for ring, parameter in off
+                if abs(x_true[ring_names.index(ring), PARAMETERS.index(parameter)]) <= tolerances[PARAMETERS.index(parameter)]]
+    assert not spurious, f'Parameters within their tolerance found off: {spurious}'
@@ -0,0 +1,263 @@
+"""Ring-level tuning of the Halbach array: X offset and rotation of every ring
+
+Before passive shimming, the low-order inhomogeneity of the main magnet can
+be reduced by moving whole rings along the bore (X) or turning them about it.
+
+ring_jacobian gives the field of every ring and the derivatives of the DSV
+field with respect to the X offset and the rotation of every ring, by central
+differences. The field of each ring is summed separately, so all rings are
+perturbed at once and the four perturbed arrays plus the current one are
+evaluated in a single call of the cuboid kernel, whatever the number of rings.
+
+tune_rings solves the linearized problem for the offsets and rotations,
+within bounds, that minimize the std (bounded linear least squares) or ptp
+(linear program) of the B0 component, in milliseconds. The Jacobian changes
+slowly with the adjustment, so one Jacobian serves many configurations: the
+bounds, the rings that are tuned or a measured map in place of the model
+field. Far from the linearization point the prediction can be well off, so
+tune_rings_exact tunes again from a Jacobian computed at the tuned geometry
+until the adjustment converges.
+
+Run this file to tune the rings of halbach_sim.py for ring spacings around
+that of the frame.
+"""
+
+import numpy as np
+from scipy.optimize import lsq_linear, linprog
+
+import logging
+
+import cuboid_field
+import halbach_sim
+
+PARAMETERS = ('dx', 'angle') # Adjustments of every ring, in m and rad
+
+def _ring_sums(ring_x, sensor_pos, magnetizations, geometries, magnet_side, slot_args):
+    """Field of every ring for every (ring_dx, ring_angle) in geometries, all
+    evaluated in one call of the cuboid kernel, as (n_geometries, n_rings, M, 3)
+    """
+    n_rings = len(np.atleast_1d(ring_x))
+    positions, rotations, ring_index = zip(*[halbach_sim.halbach_slots(ring_x, ring_dx=dx, ring_angle=angle, **slot_args)
+                                             for dx, angle in geometries])
+    m = np.broadcast_to(magnetizations, len(positions[0]))
+    B = cuboid_field.getB_each(np.concatenate(positions), np.concatenate(rotations), sensor_pos,
+                               (magnet_side,)*3, np.tile(m, len(geometries))[:,None]*[0, 0, 1.])
+    # The slots of every ring are contiguous, so the rings of all geometries are summed in one go
+    labels = np.concatenate([index+k*n_rings for k, index in enumerate(ring_index)])
+    starts = np.flatnonzero(np.diff(labels, prepend=-1))
+    return np.add.reduceat(B, starts, axis=0).reshape(len(geometries), n_rings, -1, 3)
+
+def ring_fields(ring_x, sensor_pos, magnetizations, ring_dx=0., ring_angle=0., magnet_side=halbach_sim.MAGNET_SIDE,
+                **slot_args):
+    """Field (n_rings, M, 3) in T of every ring
+
+    ring_x, ring_dx, ring_angle and slot_args (rings, ring_radius, n_slots) are as for
+    halbach_sim.halbach_slots. magnetizations (A/m) is a scalar or one value per
+    slot.
+    """
+    return _ring_sums(ring_x, sensor_pos, magnetizations, [(ring_dx, ring_angle)], magnet_side, slot_args)[0]
+
+def ring_jacobian(ring_x, sensor_pos, magnetizations, ring_dx=0., ring_angle=0., step_dx=1e-4, step_angle=1e-3,
+                  magnet_side=halbach_sim.MAGNET_SIDE, **slot_args):
+    """Field of every ring and its derivatives with respect to the ring X offset
+    and rotation, by central differences. Takes the same arguments as
+    ring_fields.
+
+    Returns the ring fields (n_rings, M, 3) in T and the Jacobian
+    (M, 3, n_rings, 2) in T/m and T/rad, the last axis as in PARAMETERS
+    """
+    n_rings = len(np.atleast_1d(ring_x))
+    ring_dx = np.broadcast_to(np.asarray(ring_dx, dtype=float), n_rings)
+    ring_angle = np.broadcast_to(np.asarray(ring_angle, dtype=float), n_rings)
+    geometries = [(ring_dx, ring_angle),
+                  (ring_dx+step_dx, ring_angle), (ring_dx-step_dx, ring_angle),
+                  (ring_dx, ring_angle+step_angle), (ring_dx, ring_angle-step_angle)]
+    B_rings = _ring_sums(ring_x, sensor_pos, magnetizations, geometries, magnet_side, slot_args)
+    jacobian = np.stack(((B_rings[1]-B_rings[2])/(2*step_dx), (B_rings[3]-B_rings[4])/(2*step_angle)), axis=-1)
+    return B_rings[0], jacobian.transpose(1, 2, 0, 3)
+
+def linear_field(B, jacobian, ring_dx=0., ring_angle=0.):
+    """Field (M, 3) predicted from the field B (M, 3) at the linearization point
+    for a change ring_dx (m) and ring_angle (rad) of every ring
+    """
+    n_rings = jacobian.shape[2]
+    step = np.stack((np.broadcast_to(ring_dx, n_rings), np.broadcast_to(ring_angle, n_rings)), axis=-1)
+    return B+np.einsum('mkrp,rp->mk', jacobian, step)
+
+def _solve_linear(b, A, lower, upper, cost_fn):
+    """Step x within bounds that minimizes the std or ptp of b + A x"""
+    if cost_fn == 'std':
+        b_c = b-b.mean()
+        A_c = A-A.mean(axis=0)
+        return lsq_linear(A_c, -b_c, bounds=(lower, upper)).x
+    # min u - l with l <= b + A x <= u
+    n = A.shape[1]
+    ones = np.ones((len(b), 1))
+    A_ub = np.block([[A, -ones, np.zeros_like(ones)], [-A, np.zeros_like(ones), ones]])
+    c = np.concatenate((np.zeros(n), [1., -1.]))
+    bounds = list(zip(lower, upper))+[(None, None)]*2
+    result = linprog(c, A_ub=A_ub, b_ub=np.concatenate((-b, b)), bounds=bounds, method='highs')
+    if not result.success:
+        raise RuntimeError(f'Ring tuning linear program failed: {result.message}')
+    return result.x[:n]
+
+def tune_rings(B, jacobian, cost_fn='std', max_dx=1e-3, max_angle=np.radians(1.), tune_dx=True, tune_angle=True,
+               fixed_rings=(), ring_dx=0., ring_angle=0.):
+    """Ring X offsets and rotations that minimize the std or ptp of B0
+
+    B (M, 3) is the field at the current adjustment ring_dx (m), ring_angle
+    (rad) of the rings, from the model or a measured map, and jacobian comes
+    from ring_jacobian. max_dx and max_angle (scalars or one value per ring)
+    bound the total adjustment of every ring. tune_dx and tune_angle select
+    the adjustments, fixed_rings keep their current one. Moving or turning all rings together only moves the DSV
+    relative to the magnet, so fixing one ring (e.g. the centre one) removes
+    that freedom. For rings that are symmetric about the bore axis, a rotation
+    changes B0 only to second order and its columns of the Jacobian are close
+    to zero; rotations are worth tuning against a measured map.
+
+    Returns ring_dx, ring_angle and the predicted field (M, 3)
+    """
+    n_rings = jacobian.shape[2]
+    x = np.stack((np.broadcast_to(ring_dx, n_rings), np.broadcast_to(ring_angle, n_rings)), axis=-1).astype(float)
+    free = np.zeros_like(x, dtype=bool)
+    free[:,0] = tune_dx
+    free[:,1] = tune_angle
+    free[list(fixed_rings)] = False
+    limit = np.stack((np.broadcast_to(max_dx, n_rings), np.broadcast_to(max_angle, n_rings)), axis=-1)
+
+    direction = B.mean(axis=0)/np.linalg.norm(B.mean(axis=0))
+    b = B @ direction
+    A = np.einsum('mkrp,k->mrp', jacobian, direction)[:,free]
+    step = np.zeros_like(x)
+    step[free] = _solve_linear(b, A, -limit[free]-x[free], limit[free]-x[free], cost_fn)
+    return x[:,0]+step[:,0], x[:,1]+step[:,1], linear_field(B, jacobian, step[:,0], step[:,1])
+
+def _cost(B, cost_fn):
+    """std or ptp of |B|"""
+    B_abs = np.linalg.norm(B, axis=-1)
+    return np.std(B_abs) if cost_fn == 'std' else np.ptp(B_abs)
+
+def tune_rings_exact(ring_x, sensor_pos, magnetizations, cost_fn='std', max_dx=1e-3, max_angle=np.radians(1.),
+                     tune_dx=True, tune_angle=True, fixed_rings=(), ring_dx=0., ring_angle=0., min_step_dx=1e-5,
+                     min_step_angle=np.radians(.01), min_improvement=1e-4, max_iterations=10, max_halvings=5,
+                     **kwargs):
+    """tune_rings, linearized again at the tuned geometry until it converges
+
+    Every iteration computes the Jacobian at the current geometry and tunes
+    from there. A step that makes the exact std or ptp worse is halved, at
+    most max_halvings times. Stops when no ring moves by more than
+    min_step_dx (m) and min_step_angle (rad), or the std or ptp improves by
+    less than min_improvement (relative): along a flat valley of the cost the
+    rings can keep moving without improving B0. Warns when it did not
+    converge in max_iterations or when adjustments end at their bounds: then
+    the optimum lies beyond them. The other arguments are as for tune_rings
+    and ring_jacobian.
+
+    Returns ring_dx, ring_angle, the exact field (M, 3) and the number of
+    iterations, or None if it did not converge
+    """
+    n_rings = len(np.atleast_1d(ring_x))
+    ring_dx = np.array(np.broadcast_to(ring_dx, n_rings), dtype=float)
+    ring_angle = np.array(np.broadcast_to(ring_angle, n_rings), dtype=float)
+    tune_args = dict(cost_fn=cost_fn, max_dx=max_dx, max_angle=max_angle, tune_dx=tune_dx, tune_angle=tune_angle,
+                     fixed_rings=fixed_rings)
+    B_rings, jacobian = ring_jacobian(ring_x, sensor_pos, magnetizations, ring_dx, ring_angle, **kwargs)
+    B = B_rings.sum(axis=0)
+    cost = _cost(B, cost_fn)
+    iterations = None
+    for iteration in range(max_iterations):
+        new_dx, new_angle, _ = tune_rings(B, jacobian, ring_dx=ring_dx, ring_angle=ring_angle, **tune_args)
+        step_dx, step_angle = new_dx-ring_dx, new_angle-ring_angle
+        for _ in range(max_halvings):
+            B_new = ring_fields(ring_x, sensor_pos, magnetizations, ring_dx+step_dx, ring_angle+step_angle,
+                                **kwargs).sum(axis=0)
+            if _cost(B_new, cost_fn) <= cost:
+                break
+            step_dx, step_angle = step_dx/2, step_angle/2
+        else:
+            iterations = iteration+1
+            break
+        ring_dx, ring_angle, B = ring_dx+step_dx, ring_angle+step_angle, B_new
+        improvement = 1-_cost(B, cost_fn)/cost
+        cost = _cost(B, cost_fn)
+        logging.info(f'Iteration {iteration+1}: {cost_fn} {cost*1e6:.2f} uT, step up to '
+                     f'{np.max(np.abs(step_dx))*1e3:.3f} mm, {np.degrees(np.max(np.abs(step_angle))):.3f} deg')
+        if (np.all(np.abs(step_dx) < min_step_dx) and np.all(np.abs(step_angle) < min_step_angle)
+                or improvement < min_improvement):
+            iterations = iteration+1
+            break
+        _, jacobian = ring_jacobian(ring_x, sensor_pos, magnetizations, ring_dx, ring_angle, **kwargs)
+    if iterations is None:
+        logging.warning(f'Ring tuning did not converge in {max_iterations} iterations')
+
+    at_bound = []
+    for name, tuned, value, limit, step in (('dx', tune_dx, ring_dx, max_dx, min_step_dx),
+                                            ('angle', tune_angle, ring_angle, max_angle, min_step_angle)):
+        if tuned:
+            bound = np.abs(value) > np.broadcast_to(limit, n_rings)-step
+            bound[list(fixed_rings)] = False
+            at_bound += [f'{name} of ring {i}' for i in np.flatnonzero(bound)]
+    if at_bound:
+        logging.warning('At their bounds: '+', '.join(at_bound))
+    return ring_dx, ring_angle, B, iterations
+
+if __name__ == "__main__":
+    import time
+    import pandas as pd
+
+    logging.basicConfig(format='%(levelname)s:%(message)s', level=logging.INFO)
+
+    sensor_fname = 'example_data/NIST_Smallbach_Swap_Smoothed_shell.csv' # DSV points in mm
+    magnetization = 1.1e6 # A/m
+    ring_spacing = halbach_sim.RING_SPACING # m, spacing of the frame
+    spacings = np.arange(23e-3, 30.5e-3, 1e-3) # m, configurations to explore, the best one should be inside
+    cost_fn = 'std'
+    max_dx = 2e-3 # m, on top of the spacing
+    max_angle = np.radians(2.)
+    # Turning the rings of the model gains a few percent at most, so it is left out here; with a
+    # measured map (B in tune_rings) the rotations are worth tuning as well
+    tune_angle = False
+    fixed_rings = [4] # Centre ring R0
+
+    sensor_pos = pd.read_csv(sensor_fname, header=0, usecols=[0,1,2]).to_numpy()*1e-3
+    rings = halbach_sim.osii_mini_rings()
+    tune_args = dict(cost_fn=cost_fn, max_dx=max_dx, max_angle=max_angle, tune_angle=tune_angle, fixed_rings=fixed_rings)
+    ring_x = halbach_sim.osii_mini_ring_x(ring_spacing)
+    ring_fields(ring_x[:1], sensor_pos[:1], magnetization) # Compile before timing
+    start_time = time.time()
+    B_rings, jacobian = ring_jacobian(ring_x, sensor_pos, magnetization, rings=rings)
+    logging.info(f'Jacobian of {len(ring_x)} rings at {len(sensor_pos)} points: {time.time()-start_time:.2f} s')
+
+    # One linear tuning at the frame spacing, against the exact field at the tuned geometry
+    start_time = time.time()
+    ring_dx, ring_angle, B_predicted = tune_rings(B_rings.sum(axis=0), jacobian, **tune_args)
+    logging.info(f'Linear tuning: {time.time()-start_time:.3f} s')
+    B_exact = ring_fields(ring_x, sensor_pos, magnetization, ring_dx, ring_angle, rings=rings).sum(axis=0)
+    B0, _, std = halbach_sim.homogeneity(B_exact)
+    error = np.max(np.abs(np.linalg.norm(B_exact, axis=1)-np.linalg.norm(B_predicted, axis=1)))/B0*1e6
+    print(f'Spacing {ring_spacing*1e3:.1f} mm, one linear tuning: std {std:.0f} ppm '
+          f'(predicted {halbach_sim.homogeneity(B_predicted)[2]:.0f}), linearization error up to {error:.0f} ppm')
+
+    # Every spacing tuned until the linearization converges
+    results = []
+    start_time = time.time()
+    for spacing in spacings:
+        ring_x = halbach_sim.osii_mini_ring_x(spacing)
+        B = ring_fields(ring_x, sensor_pos, magnetization, rings=rings).sum(axis=0)
+        ring_dx, ring_angle, B_tuned, iterations = tune_rings_exact(ring_x, sensor_pos, magnetization, rings=rings,
+                                                                    **tune_args)
+        _, _, std = halbach_sim.homogeneity(B)
+        _, _, std_tuned = halbach_sim.homogeneity(B_tuned)
+        results.append((std_tuned, spacing, ring_dx, ring_angle, B_tuned))
+        print(f'Spacing {spacing*1e3:.1f} mm: std {std:.0f} -> {std_tuned:.0f} ppm, '
+              +(f'converged in {iterations} iterations' if iterations else 'not converged'))
+    logging.info(f'Tuned {len(spacings)} spacings: {time.time()-start_time:.1f} s')
+
+    best = int(np.argmin([result[0] for result in results]))
+    _, spacing, ring_dx, ring_angle, B_tuned = results[best]
+    if best in (0, len(spacings)-1):
+        logging.warning('The best spacing is at the end of the explored ones, the optimum may lie beyond')
+    B0, ptp, std = halbach_sim.homogeneity(B_tuned)
+    print(f'Best spacing {spacing*1e3:.1f} mm: B0 {B0*1e3:.2f} mT, ptp {ptp:.0f} ppm, std {std:.0f} ppm')
+    print('  dx (mm):    '+' '.join(f'{v:6.2f}' for v in ring_dx*1e3))
+    print('  angle (deg):'+' '.join(f'{v:6.2f}' for v in np.degrees(ring_angle)))
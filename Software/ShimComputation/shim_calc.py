@@ -19,6 +19,8 @@ import logging
 
 import time
 
+import cuboid_field
+
 # Specify files with input data
 shim_fname = 'NYU_Shim_reduced_ptp_3.csv'
 b0_map_fname = 'example_data/background_removed_2024_05_07_b0_sphere_100mm_5mm_increment.csv'
@@ -51,6 +53,11 @@ cube_mag = (0,0,magnetization) # Magnetized in Z direction
 logging.info(f'Magnets are cubes with side length {s*1e3} mm')
 logging.info(f'Magnets have magnetization {cube_mag} A/m')
 
+# Field computation backend
+# numba - compiled cuboid kernel in cuboid_field.py, all magnets and sensors at once on all cores
+# magpylib - one magpylib object per magnet and per sensor
+field_backend = 'numba'
+
 def magnet_pos_angle_import(magnet_pos_fname):
     """Import CSV file of magnet positions.
     CSV has following format:
@@ -119,7 +126,11 @@ def compute_fields(mag_pos_angle, sensors):
         x0  y0  z0
         x1  y1  z1
         ...
+    For the numba backend, sensors is the sensor_pos array itself
     """
+    if field_backend == 'numba':
+        return cuboid_field.getB(mag_pos_angle[:,:3], cuboid_field.x_rotations(mag_pos_angle[:,3]), sensors, cube_dims, cube_mag)
+
     # Generate magnet position and rotation
     magnets = generate_magnets(mag_pos_angle)
     B_shim = magnets.getB(sensors)
@@ -143,7 +154,10 @@ b0_map_df = b0_map_import(b0_map_fname, B_unit='G')
 
 b0_map_XYZ = b0_map_df.to_numpy()[:,:3]
 b0_map_vals = b0_map_df.to_numpy()[:,3]
-sensors = gen_sensors(b0_map_df)
+if field_backend == 'numba':
+    sensors = b0_map_df.to_numpy()[:,:3]
+else:
+    sensors = gen_sensors(b0_map_df)
 
 # Load shim
 shim = pd.read_csv(shim_fname, header=0)
@@ -0,0 +1,191 @@
+"""Magnet-wise shim optimization shared by NIST_fast_shim.py and NYU_fast_shim.py
+
+The field of every candidate magnet position is computed once for every allowed
+angle (the field basis). Testing a placement then only requires adding a basis
+vector to the present residual field and evaluating the cost metric, instead of
+rebuilding every magnet with magpylib.
+
+The cost metrics (std and ptp) are seminorms, so the change in cost caused by a
+move can never exceed the metric of the field that move adds. When shimming
+|B| of a three-axis map, |B| at each sensor changes by at most the magnitude
+of the added field, which gives a similar bound. This bound is used
+to skip positions that cannot improve the shim, and the optimizer stops once a
+full pass no longer improves the shim by more than a threshold.
+"""
+
+import numpy as np
+import magpylib as magpy
+from scipy.spatial.transform import Rotation as R
+
+import logging
+
+import cuboid_field
+
+def compute_field_basis(magnet_pos, angles, sensor_pos, cube_dims, cube_mag, chunk_size=64, backend='magpylib'):
+    """Compute field of a single magnet at every position and angle
+    magnet_pos is a Nx3 array of possible magnet positions
+    angles is a list of possible rotations about the X axis
+    sensor_pos is a Mx3 array of positions where the field is evaluated
+    backend is 'magpylib', or 'numba' for the compiled kernel in cuboid_field.py
+
+    Returns a N x n_angles x M x 3 array of B fields in T
+    """
+    n_magnets = magnet_pos.shape[0]
+    n_angles = len(angles)
+    n_sensors = sensor_pos.shape[0]
+    polarization = np.array(cube_mag, dtype=float)*magpy.mu_0
+
+    basis = np.zeros((n_magnets, n_angles, n_sensors, 3))
+    for j, angle in enumerate(angles):
+        if backend == 'numba':
+            basis[:,j,:,:] = cuboid_field.getB_each(magnet_pos, cuboid_field.x_rotations(angle), sensor_pos, cube_dims, cube_mag)
+            continue
+        for start in range(0, n_magnets, chunk_size):
+            stop = min(start+chunk_size, n_magnets)
+            n_chunk = stop-start
+            # Pair every magnet in the chunk with every sensor
+            B = magpy.getB('Cuboid',
+                           np.tile(sensor_pos, (n_chunk,1)),
+                           position=np.repeat(magnet_pos[start:stop,:], n_sensors, axis=0),
+                           orientation=R.from_euler('x', np.full(n_chunk*n_sensors, angle)),
+                           dimension=np.array([cube_dims]),
+                           polarization=polarization[None,:])
+            basis[start:stop,j,:,:] = B.reshape(n_chunk, n_sensors, 3)
+    logging.info(f'Computed field basis for {n_magnets} positions at {n_angles} angles')
+    return basis
+
+def rings_center_out(magnet_pos):
+    """Group magnet position indices into rings of equal X, ordered from the
+    center ring working outwards
+    """
+    Xs = sorted(np.unique(magnet_pos[:,0]), key=abs)
+    return [np.flatnonzero(magnet_pos[:,0] == X) for X in Xs]
+
+def vector_cost(metric):
+    """Cost and cost bound functions for shimming |B| of 3 x M vector fields
+    cost(B) is metric of |B| over the sensors
+    bound(delta) bounds the change of cost(B) when delta is added to B.
+    |B| changes by at most |delta| at every sensor, so the change is at most the
+    RMS of |delta| for np.std, and twice the maximum of |delta| for np.ptp
+
+    Both work on the last axis like metric(..., axis=-1), with the components
+    on the axis before it
+    """
+    def cost(B, axis=-1):
+        return metric(np.sqrt(np.einsum('...ij,...ij->...j', B, B)), axis=axis)
+    def bound(delta, axis=-1):
+        if metric is np.std:
+            return np.sqrt(np.einsum('...ij,...ij->...', delta, delta)/delta.shape[-1])
+        return 2*np.sqrt(np.max(np.einsum('...ij,...ij->...j', delta, delta), axis=axis))
+    return cost, bound
+
+def greedy_shim(field_basis, b0_map_vals, rings, metric, B0_nom, max_passes=10,
+                min_pass_improvement=.1, min_move_improvement=0., prune=True, rng=None):
+    """Magnet-wise optimization of the shim
+
+    Each potential shim magnet position is checked at every possible rotation.
+    Empty positions get a magnet if the best rotation improves the homogeneity.
+    Occupied positions are rotated or emptied if that improves the homogeneity.
+    The rings are checked in the order given, and within each ring the order
+    in which the positions are checked is randomized.
+
+    field_basis is a N x n_angles x M array of the field component being shimmed
+    b0_map_vals is the same component of the B0 map at the M sensor positions
+    To shim |B|, field_basis is a N x n_angles x 3 x M array of all three
+    components and b0_map_vals is the 3 x M array of Bx, By and Bz
+    rings is a list of arrays of position indices, e.g. from rings_center_out
+    metric is np.std or np.ptp. Costs are reported in ppm of B0_nom
+
+    Passes stop after max_passes, or once a pass improves the cost by less than
+    min_pass_improvement ppm. Moves must improve the cost by more than
+    min_move_improvement ppm to be accepted.
+
+    If prune is True, a position is only evaluated if the cost bound derived
+    from the field basis says one of its moves could be accepted. With
+    min_move_improvement = 0 the pruning is exact: skipped positions could
+    not have been changed.
+
+    Returns (placements, angle_indices, cost)
+    """
+    if rng is None:
+        rng = np.random.default_rng()
+    n_magnets = field_basis.shape[0]
+    to_ppm = 1e6/B0_nom
+
+    placements = np.full(n_magnets, False)
+    angle_indices = np.zeros(n_magnets, dtype=int)
+    residual = np.array(b0_map_vals, dtype=float)
+    cost, bound = vector_cost(metric) if residual.ndim == 2 else (metric, metric)
+    best_cost = cost(residual)*to_ppm
+
+    # Largest change in cost that adding a magnet at each position and angle could cause
+    add_bounds = bound(field_basis, axis=-1)*to_ppm
+    # Best improvement found at the last evaluation of each position and the
+    # residual field at that time. A change of the residual can raise the
+    # possible improvement at a position by at most twice the metric of that
+    # change, so a position only needs re-checking once enough has changed.
+    # The metric of the change is bounded by the sum of the metrics of the
+    # accepted moves, which is checked first as it costs nothing to compute.
+    last_gain = np.full(n_magnets, np.inf)
+    residual_at_eval = np.zeros((n_magnets,)+residual.shape) if prune else None
+    moved_at_eval = np.zeros(n_magnets)
+    moved = 0.
+
+    n_evaluated = 0
+    n_skipped = 0
+    for p in range(max_passes):
+        pass_start_cost = best_cost
+        for ring in rings:
+            for index in rng.permutation(ring):
+                if placements[index]:
+                    current = field_basis[index, angle_indices[index]]
+                    # Moves are every other angle, or removing the magnet
+                    deltas = np.concatenate((field_basis[index]-current, -current[None,...]))
+                    static_bound = add_bounds[index, angle_indices[index]]+np.max(add_bounds[index])
+                else:
+                    deltas = field_basis[index]
+                    static_bound = np.max(add_bounds[index])
+
+                if prune:
+                    if static_bound <= min_move_improvement:
+                        n_skipped += 1
+                        continue
+                    if np.isfinite(last_gain[index]):
+                        if (last_gain[index]+2*(moved-moved_at_eval[index]) <= min_move_improvement or
+                            last_gain[index]+2*bound(residual-residual_at_eval[index])*to_ppm <= min_move_improvement):
+                            n_skipped += 1
+                            continue
+
+                costs = cost(residual[None,...]+deltas, axis=-1)*to_ppm
+                n_evaluated += 1
+                move = np.argmin(costs)
+                gain = best_cost-costs[move]
+                last_gain[index] = gain
+                if prune:
+                    residual_at_eval[index] = residual
+                    moved_at_eval[index] = moved
+
+                if gain > min_move_improvement:
+                    residual += deltas[move]
+                    moved += bound(deltas[move])*to_ppm
+                    best_cost = costs[move]
+                    if placements[index] and move == len(deltas)-1:
+                        placements[index] = False
+                        angle_indices[index] = 0
+                        logging.debug(f'Magnet {index} removed from shim. New Best Shim: {best_cost}')
+                    else:
+                        placements[index] = True
+                        angle_indices[index] = move
+                        logging.debug(f'New Best Shim: {best_cost}')
+                    # The position has to be re-checked from its new state
+                    last_gain[index] = np.inf
+
+        pass_improvement = pass_start_cost-best_cost
+        logging.info(f'Pass {p+1}: cost {best_cost:.1f} ppm, improved by {pass_improvement:.1f} ppm, '
+                     f'{placements.sum()} magnets placed')
+        if pass_improvement < min_pass_improvement:
+            logging.info(f'Converged after {p+1} passes')
+            break
+
+    logging.info(f'Evaluated {n_evaluated} positions, skipped {n_skipped}')
+    return placements, angle_indices, best_cost
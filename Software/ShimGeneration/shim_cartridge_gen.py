@@ -5,98 +5,144 @@ the A cartridge is centered on the +Z axis, B along +Y, C along -Z, and D along
 # indicates the number of slot, moving from -X to +X. If a reduced set of slots is
 being used, unused slots are NOT counted
 
+Every cartridge is cut with all its magnet holes at once: the hole for every
+magnet angle is built once, the holes of a cartridge are only moved into
+place and collected in one compound, and that compound is cut from the
+blank in a single boolean. The cartridges are generated in parallel, one per
+process. With show_cartridges, they are generated one at a time and shown
+in VS Code (ocp_vscode) before they are exported.
+
 Note: The shim definition files are in m, while the CAD is all in mm.
 """
+import time
+from concurrent.futures import ProcessPoolExecutor
 import pandas as pd
 import cadquery as cq
-from ocp_vscode import show, show_object, reset_show, set_port, set_defaults, get_defaults
-# set_port(3939)
 import numpy as np
 
 # Files that need to be defined
 shim_file = '../ShimComputation/NIST_Shim_reduced_ptp_3.csv'
 cartridge_template_file = 'shim_cartridge_V3.stp'
 cartridge_prefix = 'reduced_ptp_3_'
+n_workers = None # Processes generating cartridges, None for one per core
+show_cartridges = False # Show every cartridge and wait for Enter before exporting it
 
-cartridge_blank = cq.importers.importStep(cartridge_template_file)
-
-# Rotate cartridge_blank to optimal position to add text
-cartridge_blank = cartridge_blank.rotate((0,0,0),(0,1,0),90).rotate((0,0,0),(0,1,0),180)
-
-# Define magnet hole, with notch in +Z direction
-s = 1.55 # Magnet side half-length
-magnet_hole = (
-    cq.Workplane('YZ')
-    .sketch()
-    .segment((s,s),(s,.75))
-    .segment((s+.75,0))
-    .segment((s,-.75))
-    .segment((s,-1*s))
-    .segment((-1*s,-1*s))
-    .segment((-1*s,1*s))
-    .close()
-    .assemble(tag="face")
-    .finalize()
-    .extrude(-3)
-    .rotate((0,0,0),(1,0,0),90)
-    )
-
-def gen_cartridge(magnet_row_df, row, sector):
-    """Generate a shim cartridge for a given row and sector
+# Rotation about X (degrees) of the cartridge of every sector
+SECTOR_ROTATIONS = {'A': -45, 'B': -135, 'C': 135, 'D': 45}
+
+def load_cartridge_blank(fname):
+    """Cartridge template, rotated to the optimal position to add text"""
+    cartridge_blank = cq.importers.importStep(fname)
+    return cartridge_blank.rotate((0,0,0),(0,1,0),90).rotate((0,0,0),(0,1,0),180)
+
+def make_magnet_hole():
+    """Define magnet hole, with notch in +Z direction"""
+    s = 1.55 # Magnet side half-length
+    return (
+        cq.Workplane('YZ')
+        .sketch()
+        .segment((s,s),(s,.75))
+        .segment((s+.75,0))
+        .segment((s,-.75))
+        .segment((s,-1*s))
+        .segment((-1*s,-1*s))
+        .segment((-1*s,1*s))
+        .close()
+        .assemble(tag="face")
+        .finalize()
+        .extrude(-3)
+        .rotate((0,0,0),(1,0,0),90)
+        )
+
+def angle_key(angle):
+    """Hole angle in degrees for a shim angle in rad, rounded so that equal
+    angles from the shim file share a hole
     """
-    if len(magnet_row_df) == 0:
-        return
-    
-    cartridge = cartridge_blank
+    return round(float(angle)*180/np.pi, 6)
 
+def make_magnet_holes(angles):
+    """Hole solid at the origin for every distinct shim angle (rad)"""
+    magnet_hole = make_magnet_hole()
+    return {angle_key(angle): magnet_hole.rotate((0,0,0),(1,0,0),angle_key(angle)).val()
+            for angle in np.unique(angles)}
+
+def gen_cartridge(magnets, row, sector, cartridge_blank, magnet_holes):
+    """Generate a shim cartridge for a given row and sector
+    magnets is a Nx3 array of the Y, Z (m) and angle (rad) of its magnets
+    """
     # Add embossed label text to cartridge
-    cartridge = (cartridge
+    cartridge = (cartridge_blank
                 .faces("<X")
                 .workplane()
                 .center((77)*np.sin(85*np.pi/180),(77)*np.cos(85*np.pi/180))
                 .text(f"{sector}{row}",3,-.5, kind='bold')
                 )
-    
-    if sector == 'A':
-        cartridge = cartridge.rotate((0,0,0),(1,0,0),-45)
-    elif sector == 'B':
-        cartridge = cartridge.rotate((0,0,0),(1,0,0),-135)
-    elif sector == 'C':
-        cartridge = cartridge.rotate((0,0,0),(1,0,0),135)
+    cartridge = cartridge.rotate((0,0,0),(1,0,0),SECTOR_ROTATIONS[sector])
+
+    # Holes are only moved, not copied, and are all cut in one boolean
+    holes = cq.Compound.makeCompound([magnet_holes[angle_key(angle)].moved(cq.Location(cq.Vector(0, Y*1e3, Z*1e3)))
+                                      for Y, Z, angle in magnets])
+    return cartridge.cut(holes)
+
+# Template and holes of a worker process, loaded once by _init_worker
+_cartridge_blank = None
+_magnet_holes = None
+
+def _init_worker(template_file, angles):
+    global _cartridge_blank, _magnet_holes
+    _cartridge_blank = load_cartridge_blank(template_file)
+    _magnet_holes = make_magnet_holes(angles)
+
+def export_cartridge(magnets, row, sector):
+    """Generate a cartridge with the template and holes of the process and
+    export it, returns the file name
+    """
+    fname = f'{cartridge_prefix}{sector}{row}.stl'
+    gen_cartridge(magnets, row, sector, _cartridge_blank, _magnet_holes).export(fname)
+    return fname
+
+def cartridge_jobs(shim_df):
+    """(magnets, row, sector) of every cartridge with at least one magnet"""
+    # Add column for location angle
+    shim_df = shim_df.assign(**{'Loc Angle': np.arctan2(shim_df['Y'], shim_df['Z'])*180/np.pi})
+
+    # Get unique offsets
+    Xs = shim_df['X'].unique()
+
+    # Filter only populated positions
+    shim_df = shim_df[shim_df['Place']]
+
+    jobs = []
+    for row, X in enumerate(Xs):
+        row_df = shim_df[shim_df['X'] == X]
+        sectors = {'A': row_df[(row_df['Loc Angle'] > -45) & (row_df['Loc Angle']  < 45)],
+                   'B': row_df[(row_df['Loc Angle'] > 45) & (row_df['Loc Angle']  < 135)],
+                   'C': row_df[(row_df['Loc Angle'] > 135) | (row_df['Loc Angle']  < -135)],
+                   'D': row_df[(row_df['Loc Angle'] < -45) & (row_df['Loc Angle']  > -135)]}
+        for sector, magnet_row_df in sectors.items():
+            if len(magnet_row_df) > 0:
+                jobs.append((magnet_row_df[['Y','Z','Angle']].to_numpy(), row, sector))
+    return jobs
+
+if __name__ == "__main__":
+    shim_df = pd.read_csv(shim_file)
+    jobs = cartridge_jobs(shim_df)
+    angles = shim_df.loc[shim_df['Place'], 'Angle'].to_numpy()
+
+    start_time = time.time()
+    if show_cartridges:
+        # Only needed to look at the cartridges
+        from ocp_vscode import show, set_port
+        # set_port(3939)
+        _init_worker(cartridge_template_file, angles)
+        for magnets, row, sector in jobs:
+            cartridge = gen_cartridge(magnets, row, sector, _cartridge_blank, _magnet_holes)
+            show(cartridge)
+            input(f'{sector}{row}: {len(magnets)} magnets, press Enter to export')
+            cartridge.export(f'{cartridge_prefix}{sector}{row}.stl')
     else:
-        cartridge = cartridge.rotate((0,0,0),(1,0,0),45)
-    
-    for index, magnet in magnet_row_df.iterrows():
-        Y = magnet['Y']*1e3 # Convert to mm
-        Z = magnet['Z']*1e3 # Convert to mm
-        angle = magnet['Angle']*180/np.pi
-        print(f'Magnet at {Y:.3f},{Z:.3f} aka {magnet["Loc Angle"]:.0f}')
-        magnet_sub = magnet_hole.rotate((0,0,0),(1,0,0),angle).translate((0,Y,Z))
-        cartridge = cartridge - magnet_sub
-    # show(cartridge)
-    # input()
-    cartridge.export(f'{cartridge_prefix}{sector}{row}.stl')
-        
-
-shim_df = pd.read_csv(shim_file)
-# Add column for location angle
-shim_df['Loc Angle'] = np.arctan2(shim_df['Y'], shim_df['Z'])*180/np.pi
-
-# Get unique offsets
-Xs = shim_df['X'].unique()
-
-# Filter only populated positions
-shim_df = shim_df[shim_df['Place']]
-
-# Iterate over rows in shim tray, generating cartridges
-for row, X in enumerate(Xs):
-    row_df = shim_df[shim_df['X'] == X]
-    row_A_df = row_df[(row_df['Loc Angle'] > -45) & (row_df['Loc Angle']  < 45)]
-    row_B_df = row_df[(row_df['Loc Angle'] > 45) & (row_df['Loc Angle']  < 135)]
-    row_D_df = row_df[(row_df['Loc Angle'] < -45) & (row_df['Loc Angle']  > -135)]
-    row_C_df = row_df[(row_df['Loc Angle'] > 135) | (row_df['Loc Angle']  < -135)]
-    gen_cartridge(row_A_df,row,'A')
-    gen_cartridge(row_B_df,row,'B')
-    gen_cartridge(row_C_df,row,'C')
-    gen_cartridge(row_D_df,row,'D')
-    
\ No newline at end of file
+        with ProcessPoolExecutor(max_workers=n_workers, initializer=_init_worker,
+                                 initargs=(cartridge_template_file, angles)) as pool:
+            for (magnets, _, _), fname in zip(jobs, pool.map(export_cartridge, *zip(*jobs))):
+                print(f'{fname}: {len(magnets)} magnets')
+    print(f'Generated {len(jobs)} cartridges in {time.time()-start_time:.1f} s')
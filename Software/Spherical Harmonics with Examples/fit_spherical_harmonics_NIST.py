@@ -9,43 +9,44 @@ Modified for NIST use by Stephen Ogier September 2024
 
 import numpy as np
 import matplotlib.pyplot as plt
-from scipy.special import sph_harm
-from scipy.linalg import lstsq
-import csv
+import os
+
+from spherical_harmonics import cartToSpher, getRealSphericalHarmonics, crossValidateSphericalHarmonics, fitMaps, SphericalHarmonicModel, sphereGrid, fitScalarPotential
 
 b0_map_fname = r'NIST_Smallbach_Swap_Centered.csv'
 
 #The highest order spherical harmonic to fit
 maxOrder = 15
 
-def cartToSpher(coords):
-    r = np.sqrt(np.sum(np.square(coords),axis = -1))    
-    #remove r = 0 to avoid divide by zero
-    r[r==0] = np.nan
-    
-    phi = np.arctan2(coords[...,1], coords[...,0]) + np.pi
-    theta = np.arccos(coords[...,2]/r)
-    return np.stack([r,theta, phi], axis = -1)
-
-def getRealSphericalHarmonics(coords, maxOrder):
-    r0          = np.nanmean(coords[...,0])       #Get the mean radius for normalisation
-    print(r0)
-    spherHarm   = np.zeros((np.shape(coords[...,0]) + ((maxOrder + 1)**2,)))
-    idx         = 0
-    for n in range(maxOrder+1):
-        for m in range(-n,n+1):
-            if m < 0:
-                spherHarm[...,idx] = ((1j/np.sqrt(2))*(np.divide(coords[...,0],r0)**n)*(sph_harm(m,n,coords[...,2], coords[...,1])-((-1)**m)*sph_harm(-m,n,coords[...,2], coords[...,1]))).real
-            elif m > 0:
-                spherHarm[...,idx] = ((1/np.sqrt(2))*(np.divide(coords[...,0],r0)**n)*(sph_harm(-m,n,coords[...,2], coords[...,1])+((-1)**m)*sph_harm(m,n,coords[...,2], coords[...,1]))).real
-            elif m == 0:
-                spherHarm[...,idx] = np.multiply(sph_harm(m,n,coords[...,2], coords[...,1]),np.divide(coords[...,0],r0)**n).real
-            else:
-                print("That wasnt suppoosed to happen!")
-            idx += 1
-    return spherHarm
-
-rawData = np.genfromtxt(b0_map_fname, dtype = float, delimiter = ',', skip_header = 1)[:,:4]
+#Candidate orders and regularization strengths, picked by k-fold cross-validation
+fitOrders = range(2, maxOrder + 1)
+regularizations = [0, 1e-8, 1e-7, 1e-6, 1e-5, 1e-4]
+nFolds = 5
+
+#Factorizations of the basis are kept here for each measurement grid, so maps
+#on the same grid are re-fitted with a matrix product. Kept next to this script, None disables the cache
+solverCacheDir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'sh_solver_cache')
+if solverCacheDir is not None:
+    os.makedirs(solverCacheDir, exist_ok = True)
+
+#Optionally also evaluate the fit on a dense DSV grid (diameter and step in mm)
+denseMapFname = None
+denseDiameter = 100
+denseStep = 1
+
+#Re-center the fit on the isocenter that minimizes the std dev of B0 over a DSV
+#of this diameter (mm). None keeps the origin of the map
+isocenterDSV = None
+
+#Fit Bx, By, Bz of a 3-axis map together as the gradient of one scalar potential,
+#and write |B| as B0 in the smoothed map. It is not cross-validated itself, it
+#takes the order and regularization picked for B0
+jointPotentialFit = False
+
+#All field columns (B0, and Bx, By, Bz for 3-axis maps) are fitted
+rawData = np.genfromtxt(b0_map_fname, dtype = float, delimiter = ',', skip_header = 1)
+with open(b0_map_fname) as f:
+    fieldNames = f.readline().strip().split(',')[3:]
 
 radius = np.sqrt(np.mean(np.square(rawData[:,0]) + np.square(rawData[:,1]) + np.square(rawData[:,2])))
 fieldAxis = 3
@@ -73,12 +74,20 @@ spherHarm = getRealSphericalHarmonics(spher_coords, maxOrder)
 
 initialGuess = np.zeros((np.size(spherHarm,-1)))
 
-np.savetxt('spherHarm.csv', spherHarm, delimiter=',')
-
 plt.figure()
 plt.plot(rawData[:,fieldAxis])
-lsqFit = lstsq(spherHarm, rawData[:,fieldAxis])
-spherHarmCoeff = lsqFit[0]
+#Every field column gets its own order and regularization, the residuals are in ppm of B0
+spherHarmCoeffs = np.zeros((np.size(spherHarm,-1), len(fieldNames)))
+fitOrder, regularization = {}, {}
+for k, name in enumerate(fieldNames):
+    fitOrder[name], regularization[name], heldOutRms, heldOutMax = crossValidateSphericalHarmonics(spherHarm, rawData[:,3+k], fitOrders, regularizations, nFolds)
+    best = np.unravel_index(np.argmin(heldOutRms), heldOutRms.shape)
+    scale = abs(np.mean(rawData[:,3+k])/np.mean(rawData[:,fieldAxis]))
+    print(f'{name}: order {fitOrder[name]}, regularization {regularization[name]}: held-out residual RMS {heldOutRms[best]*scale:.1f} ppm, max {heldOutMax[best]*scale:.1f} ppm')
+    coeffs = fitMaps(shifted_data[:,:3], rawData[:,3+k], fitOrder[name], regularization[name], solverCacheDir)
+    spherHarmCoeffs[:len(coeffs),k] = coeffs
+spherHarmCoeffs = spherHarmCoeffs[:(max(fitOrder.values()) + 1)**2]
+spherHarmCoeff = spherHarmCoeffs[:,fieldAxis-3]
 
 relative = np.max(np.abs(spherHarmCoeff[1:]))/spherHarmCoeff[0]
 print(f'Relative strength of strongest non-B0 Spherical Harmonic: {relative}')
@@ -87,7 +96,7 @@ plt.figure()
 plt.plot(spherHarmCoeff[1:])
 plt.title("Spherical harmonic coefficients")
 
-fittedData = np.matmul(spherHarm, spherHarmCoeff)
+fittedData = np.matmul(spherHarm[:,:np.size(spherHarmCoeff)], spherHarmCoeffs)
 print(f'spherHarm:      {spherHarm.shape}')
 print(f'spherHarmCoeff: {spherHarmCoeff.shape}')
 print(f'fittedData:     {fittedData.shape}')
@@ -96,21 +105,38 @@ print(f'shifted_data:   {shifted_data.shape}')
 
 fig = plt.figure()
 ax = fig.add_subplot(projection='3d')
-ax.scatter(shifted_data[:,0], shifted_data[:,1], shifted_data[:,2], c = fittedData, cmap = 'viridis')
+ax.scatter(shifted_data[:,0], shifted_data[:,1], shifted_data[:,2], c = fittedData[:,fieldAxis-3], cmap = 'viridis')
 ax.set_xlabel("X [mm] Bore direction")
 ax.set_ylabel("Y [mm] (up down)")
 ax.set_zlabel("Z [mm] (B0)")
 fig.suptitle('Fitted data')
 # plt.show()
 
-spherical_harm_fname = r'NIST_spherical_harmonic_coefficients'
-np.save(spherical_harm_fname, spherHarmCoeff)
+# Save coefficients of every field column with their r0 and order
+if jointPotentialFit:
+    components = [3 + fieldNames.index(name) for name in ('Bx', 'By', 'Bz')]
+    model, potentialCoeffs = fitScalarPotential(shifted_data[:,:3], rawData[:,components], fitOrder[fieldNames[fieldAxis-3]], regularization[fieldNames[fieldAxis-3]])
+    residual = model.evaluate(shifted_data[:,:3]) - rawData[:,components]
+    print(f'Scalar potential fit residual RMS (Bx, By, Bz): {np.sqrt(np.mean(np.square(residual), axis = 0))/np.mean(rawData[:,fieldAxis])*1e6} ppm')
+    #The isocenter is found on the component along the main field
+    isocenterColumn = int(np.argmax(np.abs(model.coeffs[0])))
+else:
+    model = SphericalHarmonicModel(spherHarmCoeffs, np.nanmean(spher_coords[...,0]), fieldNames)
+    isocenterColumn = fieldAxis-3
+if isocenterDSV is not None:
+    isocenter = model.findIsocenter(isocenterDSV, column = isocenterColumn)
+    print(f'Isocenter offset {isocenter} mm: {model.homogeneity(isocenterDSV, column = isocenterColumn)[0]:.1f} ppm -> '
+          f'{model.homogeneity(isocenterDSV, isocenter, column = isocenterColumn)[0]:.1f} ppm std dev over {isocenterDSV} mm DSV')
+    model = model.transformed(offset = isocenter)
+    shifted_data[:,:3] -= isocenter
+spherical_harm_fname = r'NIST_spherical_harmonic_coefficients.npz'
+model.save(spherical_harm_fname)
 
 # Save smoothed pherical harmonics
 smoothed_map_fname = r'NIST_Smallbach_Swap_Smoothed.csv'
-with open(smoothed_map_fname, 'w', newline='') as f:
-    print(smoothed_map_fname)
-    writer = csv.writer(f, dialect='excel')
-    writer.writerow(['X', 'Y', 'Z', 'B0'])
-    for i in range(len(fittedData)):
-        writer.writerow([*shifted_data[i,:3], fittedData[i]])
+print(smoothed_map_fname)
+model.writeMap(smoothed_map_fname, shifted_data[:,:3], magnitude = jointPotentialFit)
+
+if denseMapFname is not None:
+    print(denseMapFname)
+    model.writeMap(denseMapFname, sphereGrid(denseDiameter, denseStep), workers = None, magnitude = jointPotentialFit)
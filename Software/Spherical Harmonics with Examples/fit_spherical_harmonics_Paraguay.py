@@ -7,35 +7,9 @@ Created on Fri May 31 14:10:27 2024
 
 import numpy as np
 import matplotlib.pyplot as plt
-from scipy.special import sph_harm
-from scipy.linalg import lstsq
-
-def cartToSpher(coords):
-    r = np.sqrt(np.sum(np.square(coords),axis = -1))    
-    #remove r = 0 to avoid divide by zero
-    r[r==0] = np.nan
-    
-    phi = np.arctan2(coords[...,1], coords[...,0]) + np.pi
-    theta = np.arccos(coords[...,2]/r)
-    return np.stack([r,theta, phi], axis = -1)
-
-def getRealSphericalHarmonics(coords, maxOrder):
-    r0          = np.nanmean(coords[...,0])       #Get the mean radius for normalisation
-    spherHarm   = np.zeros((np.shape(coords[...,0]) + ((maxOrder + 1)**2,)))
-    idx         = 0
-    for n in range(maxOrder+1):
-        for m in range(-n,n+1):
-            if m < 0:
-                spherHarm[...,idx] = ((1j/np.sqrt(2))*(np.divide(coords[...,0],r0)**n)*(sph_harm(m,n,coords[...,2], coords[...,1])-((-1)**m)*sph_harm(-m,n,coords[...,2], coords[...,1]))).real
-            elif m > 0:
-                spherHarm[...,idx] = ((1/np.sqrt(2))*(np.divide(coords[...,0],r0)**n)*(sph_harm(-m,n,coords[...,2], coords[...,1])+((-1)**m)*sph_harm(m,n,coords[...,2], coords[...,1]))).real
-            elif m == 0:
-                spherHarm[...,idx] = np.multiply(sph_harm(m,n,coords[...,2], coords[...,1]),np.divide(coords[...,0],r0)**n).real
-            else:
-                print("That wasnt suppoosed to happen!")
-            idx += 1
-    return spherHarm
+import os
 
+from spherical_harmonics import cartToSpher, getRealSphericalHarmonics, crossValidateSphericalHarmonics, fitMaps, SphericalHarmonicModel
 
 # def fitSphericalHarmonics(fitVector, args):
 #     return np.square(maskedFieldShell - np.matmul(spherHarm, fitVector))
@@ -82,19 +56,29 @@ shifted_data[:,1] *= -1 #invert y axis
 #The highest order spherical harmonic to fit
 maxOrder = 15
 
+#Candidate orders and regularization strengths, picked by k-fold cross-validation
+fitOrders = range(2, maxOrder + 1)
+regularizations = [0, 1e-8, 1e-7, 1e-6, 1e-5, 1e-4]
+nFolds = 5
+
+#Factorizations of the basis are kept here for each measurement grid, next to this script. None disables the cache
+solverCacheDir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'sh_solver_cache')
+if solverCacheDir is not None:
+    os.makedirs(solverCacheDir, exist_ok = True)
+
 
 spher_coords = cartToSpher(shifted_data[:,:3])
 spherHarm = getRealSphericalHarmonics(spher_coords, maxOrder)
 
 initialGuess = np.zeros((np.size(spherHarm,-1)))
 
-np.savetxt('spherHarm_PY.csv', spherHarm, delimiter=',')
-
 plt.figure()
 plt.plot(rawData[:,fieldAxis])
 
-lsqFit = lstsq(spherHarm, rawData[:,fieldAxis])
-spherHarmCoeff = lsqFit[0]
+fitOrder, regularization, heldOutRms, heldOutMax = crossValidateSphericalHarmonics(spherHarm, rawData[:,fieldAxis], fitOrders, regularizations, nFolds)
+best = np.unravel_index(np.argmin(heldOutRms), heldOutRms.shape)
+print(f'Order {fitOrder}, regularization {regularization}: held-out residual RMS {heldOutRms[best]:.1f} ppm, max {heldOutMax[best]:.1f} ppm')
+spherHarmCoeff = fitMaps(shifted_data[:,:3], rawData[:,fieldAxis], fitOrder, regularization, solverCacheDir)
 
 relative = np.max(np.abs(spherHarmCoeff[1:]))/spherHarmCoeff[0]
 print(f'Relative strength of strongest non-B0 Spherical Harmonic: {relative}')
@@ -103,7 +87,7 @@ plt.figure()
 plt.plot(spherHarmCoeff[1:])
 plt.title("Spherical harmonic coefficients")
 
-fittedData = np.matmul(spherHarm, spherHarmCoeff)
+fittedData = np.matmul(spherHarm[:,:np.size(spherHarmCoeff)], spherHarmCoeff)
 
 fig = plt.figure()
 ax = fig.add_subplot(projection='3d')
@@ -113,10 +97,10 @@ ax.set_ylabel("Y [mm] (up down)")
 ax.set_zlabel("Z [mm] (B0)")
 fig.suptitle('Fitted data')
 plt.show()
-filename = r'RDPY_Shim check - Shims 1 to 6 - Interp.npy'
+filename = r'RDPY_Shim check - Shims 1 to 6 - Interp.npz'
 
 print(spherHarmCoeff)
-np.save(filename, spherHarmCoeff)
+SphericalHarmonicModel(spherHarmCoeff, np.nanmean(spher_coords[...,0])).save(filename)
 
 # filename = r'/Users/tom/Dropbox/Low field data/OSII One/Field maps/Paraguay/Initial map - Interp - 5 mm res, 250mm DSV.npy'
 
@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+"""
+Fit spherical harmonics while a map is being acquired
+
+Replays a measured map in batches, as the mapping robot would produce it, into
+a recursive least squares fit, and reports the homogeneity estimate and the
+point at which the fit has converged, after which mapping could stop and the
+shim computation start.
+"""
+
+import numpy as np
+import matplotlib.pyplot as plt
+
+from spherical_harmonics import RecursiveSphericalHarmonicFit
+
+b0_map_fname = r'NIST_Smallbach_Swap_Centered.csv'
+
+#Order of the fit, and the radius and DSV diameter (mm) of the planned map
+maxOrder = 9
+r0 = 50
+dsvDiameter = 100
+
+#The fit has converged once the standard error of the fitted field over the
+#DSV is below this (ppm), and mapping stops there if stopWhenConverged
+tolerance = 50
+stopWhenConverged = True
+
+#Points added per update, and the order they are measured in. 'file' replays
+#the map as it was acquired, layer by layer, 'random' spreads the points over
+#the whole DSV from the start, which lets the fit converge with fewer points
+batchSize = 20
+acquisitionOrder = 'random'
+
+rawData = np.genfromtxt(b0_map_fname, dtype = float, delimiter = ',', skip_header = 1)
+if acquisitionOrder == 'random':
+    rawData = rawData[np.random.default_rng(0).permutation(len(rawData))]
+
+liveFit = RecursiveSphericalHarmonicFit(maxOrder, r0, dsvDiameter, tolerance)
+history = []
+for start in range(0, len(rawData), batchSize):
+    liveFit.update(rawData[start:start + batchSize,:3], rawData[start:start + batchSize,3])
+    uncertainty = liveFit.fieldUncertainty()
+    if uncertainty is None:
+        print(f'{liveFit.nPoints} points: collecting')
+        continue
+    std, ptp = liveFit.homogeneity()
+    history.append((liveFit.nPoints, std, ptp, uncertainty))
+    print(f'{liveFit.nPoints} points: {std:.1f} ppm std dev, {ptp:.1f} ppm peak-to-peak, field uncertainty {uncertainty:.1f} ppm')
+    if stopWhenConverged and liveFit.convergedAt is not None:
+        break
+
+if liveFit.convergedAt is not None:
+    print(f'Converged after {liveFit.convergedAt} of {len(rawData)} points')
+else:
+    print(f'Not converged to {tolerance} ppm after {liveFit.nPoints} points')
+
+history = np.array(history)
+fig, ax = plt.subplots(2, 1, sharex = True)
+ax[0].plot(history[:,0], history[:,1], label = 'std dev')
+ax[0].plot(history[:,0], history[:,2], label = 'peak-to-peak')
+ax[0].set_ylabel('Homogeneity [ppm]')
+ax[0].legend()
+ax[1].semilogy(history[:,0], history[:,3])
+ax[1].axhline(tolerance, color = 'k', linestyle = '--')
+ax[1].set_ylabel('Field uncertainty [ppm]')
+ax[1].set_xlabel('Points measured')
+fig.suptitle('Live spherical harmonic fit')
+plt.show()
+
+liveFit.model().save(r'NIST_live_spherical_harmonic_coefficients.npz')
@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+"""
+Plan B0 map measurement points for a spherical harmonic fit
+
+A fit up to maxOrder has (maxOrder+1)**2 coefficients, far fewer than the
+points of a dense grid. planMeasurementPoints picks points from a candidate
+grid one at a time, each time the candidate where the present design predicts
+the field worst: the one with the largest h^T (H^T H)^-1 h, where h is the
+basis at the candidate and H the basis at the points picked so far. Adding that
+point gives the largest increase of det(H^T H) (greedy D-optimal design) and
+the largest reduction of the variance of the fit there. The inverse is updated
+with Sherman-Morrison, so each pick costs one matrix-vector product over the
+candidates.
+
+orderPath orders the points to shorten the probe travel (nearest neighbour,
+improved by 2-opt), and writePathFile writes the X%dY%dZ%d path file of the
+mapping robot.
+
+Run this file to plan a map of the NIST magnet and compare the fit on the
+planned points with the fit on the full map.
+"""
+
+import numpy as np
+from scipy.spatial.distance import cdist
+
+from spherical_harmonics import basisAt, sphereGrid
+
+def planMeasurementPoints(candidates, maxOrder, nPoints, r0 = None, measured = None):
+    """Pick nPoints of the candidates (M x 3) that make a well conditioned fit up to maxOrder
+
+    r0 is the normalisation radius, by default the largest candidate radius.
+    measured are points already in the map (K x 3), which the new points
+    complement. Returns the indices of the picked candidates, in the order they
+    were picked
+    """
+    candidates = np.asarray(candidates, dtype = float)
+    if r0 is None:
+        r0 = np.max(np.linalg.norm(candidates, axis = -1))
+    H = basisAt(candidates, maxOrder, r0)
+    nTerms = np.size(H, 1)
+
+    # Start from a weak prior, small compared with the information of one point
+    prior = 1e-6*np.mean(np.sum(np.square(H), axis = -1))
+    P = np.eye(nTerms)/prior
+    if measured is not None and len(measured) > 0:
+        Hm = basisAt(measured, maxOrder, r0)
+        P = np.linalg.inv(Hm.T @ Hm + prior*np.eye(nTerms))
+    variance = np.einsum('ij,jk,ik->i', H, P, H)
+
+    picked = []
+    available = np.ones(len(candidates), dtype = bool)
+    for _ in range(min(nPoints, len(candidates))):
+        k = np.argmax(np.where(available, variance, -np.inf))
+        picked.append(k)
+        available[k] = False
+        u = P @ H[k]
+        denominator = 1 + H[k] @ u
+        P -= np.outer(u, u)/denominator
+        variance -= np.square(H @ u)/denominator
+    return np.array(picked)
+
+def pathLength(points, metric = 'euclidean'):
+    return np.sum(np.diag(cdist(points[:-1], points[1:], metric)))
+
+def orderPath(points, start = None, metric = 'euclidean', maxPasses = 50):
+    """Order points to shorten the travel of the probe
+
+    start is the position of the probe before the first point, by default the
+    first point. metric is the travel distance between points, 'euclidean' for
+    a probe moving in straight lines or 'chebyshev' for one with independently
+    driven axes, whose move time is set by the longest axis move.
+    Returns the indices of the points in travel order
+    """
+    points = np.asarray(points, dtype = float)
+    nodes = points if start is None else np.concatenate((np.atleast_2d(start), points))
+    distance = cdist(nodes, nodes, metric)
+
+    # Nearest neighbour tour from the start
+    order = [0]
+    visited = np.zeros(len(nodes), dtype = bool)
+    visited[0] = True
+    for _ in range(len(nodes) - 1):
+        k = np.argmin(np.where(visited, np.inf, distance[order[-1]]))
+        order.append(k)
+        visited[k] = True
+    order = np.array(order)
+
+    # 2-opt: reverse order[i+1..j] when that shortens the path, keeping the start fixed
+    for _ in range(maxPasses):
+        improved = False
+        for i in range(len(order) - 2):
+            a, b = order[i], order[i+1]
+            c = order[i+2:]
+            d = np.append(order[i+3:], -1)
+            gain = distance[a,b] + np.where(d >= 0, distance[c,d], 0) - distance[a,c] - np.where(d >= 0, distance[b,d], 0)
+            j = np.argmax(gain)
+            if gain[j] > 1e-9:
+                order[i+1:i+j+3] = order[i+1:i+j+3][::-1]
+                improved = True
+        if not improved:
+            break
+    return order if start is None else order[1:] - 1
+
+def writePathFile(fname, points):
+    """Write the robot path file, one X%dY%dZ%d line per point in mm"""
+    with open(fname, 'w') as file:
+        for x, y, z in np.rint(points).astype(int):
+            file.write("X%dY%dZ%d\n"%(x, y, z))
+
+if __name__ == "__main__":
+    import time
+    from spherical_harmonics import cartToSpher, fitMaps, SphericalHarmonicModel
+
+    def fitModel(points, values):
+        # fitMaps normalises with the mean radius of the points
+        return SphericalHarmonicModel(fitMaps(points, values[:,None], maxOrder), np.nanmean(cartToSpher(points)[:,0]))
+
+    # The full 5 mm map of the NIST magnet stands in for the candidate grid,
+    # sphereGrid(100, 5) gives the same grid for planning a new map
+    rawData = np.genfromtxt('NIST_Smallbach_Swap_Centered.csv', dtype = float, delimiter = ',', skip_header = 1)[:,:4]
+    maxOrder = 15
+    r0 = 50
+    print(f'{len(sphereGrid(100, 5))} candidates on a 5 mm grid, {len(rawData)} in the map')
+
+    # A harmonic field with the fitted coefficients plus noise at the level of
+    # the fit residual, so the fits on subsets can be compared with the truth
+    full = fitModel(rawData[:,:3], rawData[:,3])
+    truth = full.evaluate(rawData[:,:3])[:,0]
+    noise = np.std(rawData[:,3] - truth)
+    measured = truth + np.random.default_rng(0).normal(0, noise, len(truth))
+    model = fitModel(rawData[:,:3], measured)
+    error = model.evaluate(rawData[:,:3])[:,0] - truth
+    print(f'Noise {noise/np.mean(truth)*1e6:.1f} ppm, RMS error of the fit to all {len(rawData)} points '
+          f'{np.sqrt(np.mean(np.square(error)))/np.mean(truth)*1e6:.1f} ppm')
+    for nPoints in ((maxOrder + 1)**2, 2*(maxOrder + 1)**2, 3*(maxOrder + 1)**2):
+        start_time = time.time()
+        picked = planMeasurementPoints(rawData[:,:3], maxOrder, nPoints, r0)
+        plan_time = time.time() - start_time
+        random = np.random.default_rng(0).choice(len(rawData), nPoints, replace = False)
+        for name, subset in (('planned', picked), ('random', random)):
+            model = fitModel(rawData[subset,:3], measured[subset])
+            error = model.evaluate(rawData[:,:3])[:,0] - truth
+            print(f'{nPoints} {name} points: RMS error of the fit over the map '
+                  f'{np.sqrt(np.mean(np.square(error)))/np.mean(truth)*1e6:.1f} ppm')
+        start_time = time.time()
+        order = orderPath(rawData[picked,:3], start = np.zeros(3))
+        print(f'Planned in {plan_time:.2f} s, path from {pathLength(rawData[picked,:3]):.0f} mm '
+              f'to {pathLength(rawData[picked[order],:3]):.0f} mm in {time.time() - start_time:.2f} s')
@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+"""
+Write a robot path file with the points to measure for a spherical harmonic fit
+"""
+
+import numpy as np
+
+from measurement_planner import planMeasurementPoints, orderPath, pathLength, writePathFile
+from spherical_harmonics import sphereGrid
+
+outputFile = r'Planned map.path'
+
+#DSV diameter and the grid step of the robot (mm) from which points are picked
+dsvDiameter = 100
+gridStep = 5
+
+#Order of the planned fit, and the number of points: twice the number of terms
+#fits about as well as the full grid
+maxOrder = 15
+nPoints = 2*(maxOrder + 1)**2
+
+#Travel distance between points, 'euclidean' or 'chebyshev' for independently driven axes
+travelMetric = 'euclidean'
+
+candidates = sphereGrid(dsvDiameter, gridStep)
+picked = candidates[planMeasurementPoints(candidates, maxOrder, nPoints, dsvDiameter/2)]
+path = picked[orderPath(picked, start = np.zeros(3), metric = travelMetric)]
+print(f'{len(path)} of {len(candidates)} grid points, path length {pathLength(path, travelMetric):.0f} mm')
+writePathFile(outputFile, path)
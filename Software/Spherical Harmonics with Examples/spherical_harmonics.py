@@ -0,0 +1,802 @@
+"""Real spherical harmonic basis shared by the spherical harmonic fitting scripts
+
+The basis is identical to the one the scripts used to build term by term with
+scipy.special.sph_harm: terms are ordered n = 0..maxOrder and m = -n..n, and
+
+    m > 0:  sqrt(2) * (r/r0)^n * N(n,m) * P(n,m)(cos(theta)) * cos(m*phi)
+    m < 0:  sqrt(2) * (r/r0)^n * N(n,|m|) * P(n,|m|)(cos(theta)) * sin(|m|*phi)
+    m = 0:  (r/r0)^n * N(n,0) * P(n,0)(cos(theta))
+
+where N(n,m)*P(n,m) are the orthonormal associated Legendre functions without
+the Condon-Shortley phase. These are computed for all orders at once with the
+standard stable recurrences, and cos/sin(m*phi) by angle addition, all on real
+arrays.
+
+fitSphericalHarmonics and fitMaps fit coefficients to measured maps, with
+quadratureTransform for maps on a sphereQuadrature grid and
+RecursiveSphericalHarmonicFit for maps still being acquired.
+fitScalarPotential fits Bx, By and Bz of a 3-axis map together, and
+SphericalHarmonicModel evaluates, moves and saves the fitted coefficients.
+
+Run this file to check the basis against scipy.special.sph_harm, and the
+convergence of live fits against the batch fit.
+"""
+
+import numpy as np
+from scipy.linalg import lstsq, solve, svd, LinAlgError
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import os
+
+def cartToSpher(coords):
+    r = np.sqrt(np.sum(np.square(coords),axis = -1))
+    #remove r = 0 to avoid divide by zero
+    r[r==0] = np.nan
+
+    phi = np.arctan2(coords[...,1], coords[...,0]) + np.pi
+    theta = np.arccos(coords[...,2]/r)
+    return np.stack([r,theta, phi], axis = -1)
+
+def getRealSphericalHarmonics(coords, maxOrder, r0 = None):
+    """Real spherical harmonics up to maxOrder at the points coords, which are
+    (r, theta, phi) as returned by cartToSpher
+
+    r0 is the radius used for normalisation, by default the mean radius
+    Returns an array of shape coords.shape[:-1] + ((maxOrder+1)**2,)
+    """
+    if r0 is None:
+        r0 = np.nanmean(coords[...,0])       #Get the mean radius for normalisation
+    rn      = np.divide(coords[...,0], r0)
+    x       = np.cos(coords[...,1])
+    sinTheta = np.sin(coords[...,1])
+    cosPhi  = np.cos(coords[...,2])
+    sinPhi  = np.sin(coords[...,2])
+
+    spherHarm = np.empty(np.shape(x) + ((maxOrder + 1)**2,))
+
+    # (r/r0)^n for every degree
+    radial = np.empty((maxOrder + 1,) + np.shape(x))
+    radial[0] = 1
+    for n in range(1, maxOrder + 1):
+        radial[n] = radial[n-1]*rn
+
+    Pmm  = np.full(np.shape(x), 1/np.sqrt(4*np.pi))    # P(m,m), updated for every order m
+    cosM = np.ones(np.shape(x))                         # cos(m*phi)
+    sinM = np.zeros(np.shape(x))                        # sin(m*phi)
+    for m in range(maxOrder + 1):
+        if m > 0:
+            Pmm = np.sqrt((2*m + 1)/(2*m))*sinTheta*Pmm
+            cosM, sinM = cosM*cosPhi - sinM*sinPhi, sinM*cosPhi + cosM*sinPhi
+        # Recurrence in degree n for fixed order m
+        Pprev = None
+        Pn = Pmm
+        for n in range(m, maxOrder + 1):
+            if n == m + 1:
+                Pprev, Pn = Pn, np.sqrt(2*m + 3)*x*Pn
+            elif n > m + 1:
+                a = np.sqrt((4*n**2 - 1)/(n**2 - m**2))
+                b = np.sqrt(((n - 1)**2 - m**2)/(4*(n - 1)**2 - 1))
+                Pprev, Pn = Pn, a*(x*Pn - b*Pprev)
+            term = radial[n]*Pn
+            idx = n*n + n
+            if m == 0:
+                spherHarm[...,idx] = term
+            else:
+                spherHarm[...,idx + m] = np.sqrt(2)*term*cosM
+                spherHarm[...,idx - m] = np.sqrt(2)*term*sinM
+    return spherHarm
+
+def degreeOfTerms(nTerms):
+    """Degree n of each of the first nTerms basis columns"""
+    return np.floor(np.sqrt(np.arange(nTerms))).astype(int)
+
+def _regularizedSolve(gram, rhs, regularization, maxOrder):
+    """Solve (gram + lambda*W) c = rhs for the terms up to maxOrder, where
+    W = n(n+1) and lambda is relative to the mean diagonal of gram
+    """
+    nTerms = (maxOrder + 1)**2
+    gram = gram[:nTerms,:nTerms]
+    n = degreeOfTerms(nTerms)
+    penalty = regularization*np.mean(np.diag(gram))*n*(n + 1)
+    try:
+        return solve(gram + np.diag(penalty), rhs[:nTerms], assume_a = 'pos')
+    except LinAlgError:
+        return lstsq(gram + np.diag(penalty), rhs[:nTerms])[0]
+
+def fitSphericalHarmonics(spherHarm, data, maxOrder = None, regularization = 0):
+    """Fit spherical harmonic coefficients to data
+
+    spherHarm is the basis from getRealSphericalHarmonics, of order maxOrder or higher
+    regularization is the strength of the Tikhonov penalty n(n+1)*c^2, the
+    roughness of each term on the sphere, relative to the mean diagonal of
+    spherHarm^T spherHarm. 0 is a plain least squares fit
+    Returns the (maxOrder+1)**2 coefficients
+    """
+    if maxOrder is None:
+        maxOrder = int(np.sqrt(np.size(spherHarm, -1))) - 1
+    nTerms = (maxOrder + 1)**2
+    if regularization == 0:
+        return lstsq(spherHarm[:,:nTerms], data)[0]
+    return _regularizedSolve(spherHarm.T @ spherHarm, spherHarm.T @ data, regularization, maxOrder)
+
+def crossValidateSphericalHarmonics(spherHarm, data, orders, regularizations, nFolds = 5, seed = 0, workers = None):
+    """Pick the order and regularization of fitSphericalHarmonics by k-fold cross-validation
+
+    spherHarm is the basis up to the highest of orders. For each fold the basis
+    columns are reduced to one Gram matrix, whose leading blocks serve every
+    lower order. The folds and orders are evaluated in parallel threads.
+
+    Returns (bestOrder, bestRegularization, heldOutRms, heldOutMax), where the
+    last two are len(orders) x len(regularizations) arrays of the held-out
+    residuals in ppm of the mean of data
+    """
+    orders = list(orders)
+    regularizations = list(regularizations)
+    nTerms = (max(orders) + 1)**2
+    spherHarm = spherHarm[:,:nTerms]
+    folds = np.array_split(np.random.default_rng(seed).permutation(len(data)), nFolds)
+
+    def foldGram(k):
+        train = np.ones(len(data), dtype = bool)
+        train[folds[k]] = False
+        return spherHarm[train].T @ spherHarm[train], spherHarm[train].T @ data[train]
+
+    def heldOutResiduals(k, i):
+        gram, rhs = grams[k]
+        test = folds[k]
+        residuals = []
+        for j, regularization in enumerate(regularizations):
+            coeffs = _regularizedSolve(gram, rhs, regularization, orders[i])
+            residuals.append(data[test] - spherHarm[test,:len(coeffs)] @ coeffs)
+        return k, i, residuals
+
+    with ThreadPoolExecutor(max_workers = workers) as executor:
+        grams = list(executor.map(foldGram, range(nFolds)))
+        tasks = [(k, i) for k in range(nFolds) for i in range(len(orders))]
+        results = list(executor.map(lambda task: heldOutResiduals(*task), tasks))
+
+    sumSquares = np.zeros((len(orders), len(regularizations)))
+    heldOutMax = np.zeros((len(orders), len(regularizations)))
+    for k, i, residuals in results:
+        for j, residual in enumerate(residuals):
+            sumSquares[i,j] += np.sum(np.square(residual))
+            heldOutMax[i,j] = max(heldOutMax[i,j], np.max(np.abs(residual)))
+    toPpm = 1e6/np.abs(np.mean(data))
+    heldOutRms = np.sqrt(sumSquares/len(data))*toPpm
+    heldOutMax = heldOutMax*toPpm
+
+    i, j = np.unravel_index(np.argmin(heldOutRms), heldOutRms.shape)
+    return orders[i], regularizations[j], heldOutRms, heldOutMax
+
+_solverCache = {}
+
+def gridKey(points, maxOrder, regularization = 0):
+    """Hash identifying a measurement grid and fit settings"""
+    digest = hashlib.sha1(np.ascontiguousarray(points, dtype = float).tobytes()).hexdigest()
+    return f'{digest[:16]}_order{maxOrder}_reg{regularization:g}'
+
+def sphericalHarmonicSolver(points, maxOrder, regularization = 0, cacheDir = None):
+    """Matrix that maps field values at points (M x 3, cartesian) to the
+    (maxOrder+1)**2 coefficients of fitSphericalHarmonics
+
+    Without regularization it is the pseudo-inverse of the basis from its SVD,
+    otherwise (A^T A + lambda*W)^-1 A^T. Points where the basis is undefined
+    (the origin) get zero weight. The matrix is kept in memory, and in cacheDir
+    if given, under gridKey so the next fit on the same grid skips the
+    factorization.
+    """
+    key = gridKey(points, maxOrder, regularization)
+    if key in _solverCache:
+        return _solverCache[key]
+    cacheFile = None if cacheDir is None else os.path.join(cacheDir, key + '.npy')
+    if cacheFile is not None and os.path.exists(cacheFile):
+        _solverCache[key] = np.load(cacheFile)
+        return _solverCache[key]
+
+    spherHarm = getRealSphericalHarmonics(cartToSpher(np.array(points, dtype = float)), maxOrder)
+    valid = ~np.any(np.isnan(spherHarm), axis = -1)
+    A = spherHarm[valid]
+    if regularization == 0:
+        U, s, Vt = svd(A, full_matrices = False)
+        s_inv = np.divide(1, s, out = np.zeros_like(s), where = s > s[0]*np.finfo(float).eps*max(A.shape))
+        solverValid = (Vt.T*s_inv) @ U.T
+    else:
+        gram = A.T @ A
+        n = degreeOfTerms(np.size(A, -1))
+        solverValid = solve(gram + np.diag(regularization*np.mean(np.diag(gram))*n*(n + 1)), A.T, assume_a = 'pos')
+    solver = np.zeros((np.size(A, -1), len(valid)))
+    solver[:,valid] = solverValid
+
+    _solverCache[key] = solver
+    if cacheFile is not None:
+        np.save(cacheFile, solver)
+    return solver
+
+def fitMaps(points, fields, maxOrder, regularization = 0, cacheDir = None):
+    """Fit spherical harmonic coefficients to many field columns on one grid
+    fields is a M x k array, e.g. B0, Bx, By, Bz of several maps side by side
+    Returns the (maxOrder+1)**2 x k coefficients
+    """
+    fields = np.asarray(fields, dtype = float)
+    return sphericalHarmonicSolver(points, maxOrder, regularization, cacheDir) @ fields
+
+def fitMapFiles(fnames, maxOrder, regularization = 0, cacheDir = None):
+    """Fit every field column of a campaign of map CSVs (X, Y, Z, fields...)
+    Maps on the same grid are solved together
+    Returns a dict of fname: (maxOrder+1)**2 x n_fields coefficients
+    """
+    grids = {}
+    for fname in fnames:
+        data = np.genfromtxt(fname, dtype = float, delimiter = ',', skip_header = 1)
+        key = gridKey(data[:,:3], maxOrder, regularization)
+        grids.setdefault(key, (data[:,:3], []))[1].append((fname, data[:,3:]))
+
+    coeffs = {}
+    for points, maps in grids.values():
+        allCoeffs = fitMaps(points, np.concatenate([fields for _, fields in maps], axis = 1), maxOrder, regularization, cacheDir)
+        columns = np.cumsum([0] + [np.size(fields, 1) for _, fields in maps])
+        for k, (fname, _) in enumerate(maps):
+            coeffs[fname] = allCoeffs[:,columns[k]:columns[k+1]]
+    return coeffs
+
+def sphereGrid(diameter, step):
+    """Points of a cubic grid with spacing step inside a sphere (DSV) of the given diameter"""
+    axis = np.arange(-(diameter/2 // step)*step, diameter/2 + step/2, step)
+    points = np.stack(np.meshgrid(axis, axis, axis, indexing = 'ij'), axis = -1).reshape(-1, 3)
+    return points[np.sum(np.square(points), axis = -1) <= (diameter/2)**2]
+
+def sphereQuadrature(order, radius):
+    """Gauss-Legendre in cos(theta) x uniform in phi points on a sphere, with
+    weights that integrate products of harmonics up to the given order exactly
+    over the solid angle (the weights sum to 4*pi)
+    Returns (points, weights)
+    """
+    cosTheta, wTheta = np.polynomial.legendre.leggauss(order + 1)
+    nPhi = 2*order + 2
+    phi = np.arange(nPhi)*2*np.pi/nPhi
+    cosTheta, phi = np.meshgrid(cosTheta, phi, indexing = 'ij')
+    sinTheta = np.sqrt(1 - cosTheta**2)
+    points = radius*np.stack([(sinTheta*np.cos(phi)).ravel(), (sinTheta*np.sin(phi)).ravel(), cosTheta.ravel()], axis = -1)
+    return points, np.repeat(wTheta*2*np.pi/nPhi, nPhi)
+
+def _ringLegendre(maxOrder, radius, r0):
+    """Basis factors of each degree and order on the theta rings of
+    sphereQuadrature(maxOrder, radius): the basis at phi = 0, where the cos
+    terms hold the Legendre part of both the cos and the sin terms
+    Returns an array nTheta x (maxOrder+1)**2
+    """
+    cosTheta = np.polynomial.legendre.leggauss(maxOrder + 1)[0]
+    coords = np.stack([np.full_like(cosTheta, radius), np.arccos(cosTheta), np.zeros_like(cosTheta)], axis = -1)
+    return getRealSphericalHarmonics(coords, maxOrder, r0)
+
+def _termIndices(maxOrder):
+    """Index of the cos (m >= 0) and sin (m > 0) basis term of every (n, m)"""
+    n, m = np.meshgrid(np.arange(maxOrder + 1), np.arange(maxOrder + 1), indexing = 'ij')
+    valid = m <= n
+    return n[valid], m[valid], (n*n + n + m)[valid], (n*n + n - m)[valid]
+
+def quadratureTransform(values, maxOrder, radius, r0 = None):
+    """Coefficients of field values on the points of sphereQuadrature(maxOrder, radius)
+
+    values is an array of nPoints or nPoints x k values in the order of the
+    points. Each theta ring is Fourier transformed along phi with an FFT and
+    the Fourier terms are projected onto the Legendre functions of the ring
+    with the Gauss-Legendre weights. This is exact for a field of degree up to
+    maxOrder. r0 is the normalisation radius, by default radius
+    Returns (maxOrder+1)**2 or (maxOrder+1)**2 x k coefficients
+    """
+    r0 = radius if r0 is None else r0
+    nTheta, nPhi = maxOrder + 1, 2*maxOrder + 2
+    values = np.asarray(values, dtype = float)
+    rings = values.reshape((nTheta, nPhi) + values.shape[1:])
+    wTheta = np.polynomial.legendre.leggauss(nTheta)[1]
+    # The basis uses phi + pi, which turns the phase of order m into (-1)^m
+    fourier = np.fft.rfft(rings, axis = 1)[:,:maxOrder + 1]*2*np.pi/nPhi
+    fourier *= ((-1.)**np.arange(maxOrder + 1)).reshape((1, -1) + (1,)*(values.ndim - 1))
+    legendre = _ringLegendre(maxOrder, radius, r0)*wTheta[:,None]
+
+    n, m, cosIdx, sinIdx = _termIndices(maxOrder)
+    scale = (r0/radius)**(2*n)
+    weighted = legendre[:,cosIdx].reshape((nTheta, -1) + (1,)*(values.ndim - 1))
+    coeffs = np.empty(((maxOrder + 1)**2,) + values.shape[1:])
+    coeffs[cosIdx] = np.sum(weighted*fourier.real[:,m], axis = 0)*scale.reshape((-1,) + (1,)*(values.ndim - 1))
+    sin = m > 0
+    coeffs[sinIdx[sin]] = -np.sum(weighted[:,sin]*fourier.imag[:,m[sin]], axis = 0)*scale[sin].reshape((-1,) + (1,)*(values.ndim - 1))
+    return coeffs
+
+def inverseQuadratureTransform(coeffs, radius, r0 = None):
+    """Field values on the points of sphereQuadrature(maxOrder, radius) from
+    (maxOrder+1)**2 (x k) coefficients, with an inverse FFT along phi
+    """
+    coeffs = np.asarray(coeffs, dtype = float)
+    maxOrder = int(np.sqrt(np.size(coeffs, 0))) - 1
+    r0 = radius if r0 is None else r0
+    nTheta, nPhi = maxOrder + 1, 2*maxOrder + 2
+    legendre = _ringLegendre(maxOrder, radius, r0)
+    n, m, cosIdx, sinIdx = _termIndices(maxOrder)
+    extra = (1,)*(coeffs.ndim - 1)
+
+    # Sum over degree for every order m on every ring: A_m cos(m phi) + B_m sin(m phi)
+    fourier = np.zeros((nTheta, nPhi//2 + 1) + coeffs.shape[1:], dtype = complex)
+    sin = m > 0
+    cosTerms = legendre[:,cosIdx].reshape((nTheta, -1) + extra)*coeffs[cosIdx]
+    sinTerms = legendre[:,cosIdx[sin]].reshape((nTheta, -1) + extra)*coeffs[sinIdx[sin]]
+    np.add.at(fourier, (slice(None), m), cosTerms)
+    np.add.at(fourier, (slice(None), m[sin]), -1j*sinTerms)
+    fourier *= ((-1.)**np.arange(nPhi//2 + 1)).reshape((1, -1) + extra)
+    fourier[:,1:] /= 2
+    rings = np.fft.irfft(fourier*nPhi, n = nPhi, axis = 1)
+    return rings.reshape((nTheta*nPhi,) + coeffs.shape[1:])
+
+def matchQuadratureGrid(points, maxOrder, tolerance = 1e-6):
+    """Radius and ordering of points that form the sphereQuadrature grid of
+    maxOrder centered on the origin, or None if they do not
+    Returns (radius, index) such that points[index] is in the grid order
+    """
+    from scipy.spatial import cKDTree
+    points = np.asarray(points, dtype = float)
+    if len(points) != (maxOrder + 1)*(2*maxOrder + 2):
+        return None
+    radius = np.mean(np.linalg.norm(points, axis = -1))
+    grid = sphereQuadrature(maxOrder, radius)[0]
+    distance, index = cKDTree(points).query(grid, distance_upper_bound = tolerance*radius)
+    if not np.all(np.isfinite(distance)) or len(np.unique(index)) != len(points):
+        return None
+    return radius, index
+
+def sphericalHarmonicTransform(points, values, maxOrder, r0 = None):
+    """Fit spherical harmonic coefficients to values at points (M x 3)
+
+    If the points are the sphereQuadrature grid of maxOrder (in any order) the
+    coefficients are computed by quadratureTransform, otherwise by the least
+    squares fit of fitMaps. r0 is the normalisation radius, by default the
+    mean radius of the points as in fitMaps
+    Returns (coeffs, usedQuadrature)
+    """
+    values = np.asarray(values, dtype = float)
+    match = matchQuadratureGrid(points, maxOrder)
+    if match is None:
+        if r0 is not None:
+            raise ValueError('r0 can only be chosen for maps on a quadrature grid')
+        return fitMaps(points, values if values.ndim > 1 else values[:,None], maxOrder)[...,0 if values.ndim == 1 else slice(None)], False
+    radius, index = match
+    return quadratureTransform(values[index], maxOrder, radius, r0), True
+
+def aliasingDiagnostics(values, maxOrder, radius):
+    """Check whether a map on the sphereQuadrature grid of maxOrder holds field
+    of higher degree, which the transform folds into the lower degree terms
+
+    Returns a dict of
+        residual: RMS difference between values and the transformed field on
+            the grid, in ppm of the mean field. Zero for a field of degree up
+            to maxOrder
+        nyquist: RMS of the phi Fourier term at the Nyquist order maxOrder+1,
+            which no term of the fit can hold, in ppm
+        degreePower: RMS field of each degree n over the sphere, in ppm
+        topDegreeFraction: share of the non-constant power in the highest
+            degree; a spectrum that has not decayed by maxOrder is a sign of
+            aliasing
+    """
+    values = np.asarray(values, dtype = float)
+    coeffs = quadratureTransform(values, maxOrder, radius)
+    mean = abs(coeffs[0])/np.sqrt(4*np.pi)
+    residual = values - inverseQuadratureTransform(coeffs, radius)
+    rings = values.reshape(maxOrder + 1, 2*maxOrder + 2)
+    nyquist = np.fft.rfft(rings, axis = 1)[:,-1].real/(2*maxOrder + 2)
+    wTheta = np.polynomial.legendre.leggauss(maxOrder + 1)[1]
+    degreePower = np.sqrt(np.bincount(degreeOfTerms(len(coeffs)), np.square(coeffs))/(4*np.pi))/mean*1e6
+    return {'residual': np.sqrt(np.mean(np.square(residual)))/mean*1e6,
+            'nyquist': np.sqrt(np.sum(wTheta*np.square(nyquist))/2)/mean*1e6,
+            'degreePower': degreePower,
+            'topDegreeFraction': degreePower[-1]**2/np.sum(np.square(degreePower[1:]))}
+
+def planeGrid(normalAxis, position, extent, step):
+    """Points of a square slice plane normal to axis normalAxis (0, 1 or 2) at
+    the given position, covering -extent/2..extent/2 with spacing step
+    """
+    axis = np.arange(-(extent/2 // step)*step, extent/2 + step/2, step)
+    u, v = np.meshgrid(axis, axis, indexing = 'ij')
+    inPlane = [i for i in range(3) if i != normalAxis]
+    points = np.empty((u.size, 3))
+    points[:,normalAxis] = position
+    points[:,inPlane[0]] = u.ravel()
+    points[:,inPlane[1]] = v.ravel()
+    return points
+
+def gradientMatrices(maxOrder, r0):
+    """Matrices (Dx, Dy, Dz) of shape (maxOrder+1)**2 x (maxOrder+2)**2 that take
+    coefficients of a potential up to degree maxOrder+1 to the coefficients of
+    its derivatives along X, Y and Z
+
+    The gradient of a degree n harmonic is a harmonic of degree n-1. The
+    derivatives are exact polynomial differentiation along each axis, projected
+    onto the basis with sphereQuadrature
+    """
+    potential = SphericalHarmonicModel(np.zeros((maxOrder + 2)**2), r0)
+    field = SphericalHarmonicModel(np.zeros((maxOrder + 1)**2), r0)
+    points, weights = sphereQuadrature(maxOrder, r0)
+    projection = (field._basis(points)*weights[:,None]).T
+
+    # Along a line the potential is a polynomial of degree maxOrder+1, so the
+    # derivative from Chebyshev-Lobatto samples, with a node at 0, is exact
+    nNodes = maxOrder + 2 + (maxOrder + 1) % 2
+    nodes = r0*np.cos(np.pi*np.arange(nNodes)/(nNodes - 1))
+    nodes[(nNodes - 1)//2] = 0
+    barycentric = np.array([1/np.prod(nodes[k] - np.delete(nodes, k)) for k in range(nNodes)])
+    center = (nNodes - 1)//2
+    others = np.arange(nNodes) != center
+    derivative = np.zeros(nNodes)
+    derivative[others] = barycentric[others]/barycentric[center]/(0 - nodes[others])
+    derivative[center] = -np.sum(derivative[others])
+
+    matrices = []
+    for axis in range(3):
+        step = np.zeros(3)
+        step[axis] = 1
+        gradient = sum(w*potential._basis(points + node*step) for w, node in zip(derivative, nodes) if w != 0)
+        matrices.append(projection @ gradient)
+    return tuple(matrices)
+
+def fitScalarPotential(points, fields, maxOrder, regularization = 0, r0 = None):
+    """Fit one scalar potential to the three field components of a 3-axis map
+
+    In a current-free region Bx, By and Bz are the gradient of one potential,
+    so a single set of potential coefficients is fitted to all three
+
+    points is M x 3, fields the M x 3 array of Bx, By, Bz
+    The field components are expanded up to maxOrder, from a potential up to
+    degree maxOrder+1: 3M values for (maxOrder+2)**2 - 1 unknowns
+    Returns (model, potentialCoeffs) where model gives Bx, By and Bz
+    """
+    points = np.array(points, dtype = float)
+    fields = np.asarray(fields, dtype = float)
+    if r0 is None:
+        r0 = np.nanmean(cartToSpher(points)[...,0])
+    field = SphericalHarmonicModel(np.zeros((maxOrder + 1)**2), r0)
+    spherHarm = field._basis(points)
+    gradients = gradientMatrices(maxOrder, r0)
+    # The constant term of the potential has no field, so it is left out
+    A = np.concatenate([spherHarm @ D[:,1:] for D in gradients])
+    b = np.concatenate([fields[:,k] for k in range(3)])
+    potentialCoeffs = np.zeros((maxOrder + 2)**2)
+    if regularization == 0:
+        potentialCoeffs[1:] = lstsq(A, b)[0]
+    else:
+        gram = A.T @ A
+        n = degreeOfTerms((maxOrder + 2)**2)[1:]
+        potentialCoeffs[1:] = solve(gram + np.diag(regularization*np.mean(np.diag(gram))*n*(n + 1)), A.T @ b, assume_a = 'pos')
+    coeffs = np.stack([D @ potentialCoeffs for D in gradients], axis = -1)
+    return SphericalHarmonicModel(coeffs, r0, ['Bx', 'By', 'Bz']), potentialCoeffs
+
+def basisAt(points, maxOrder, r0):
+    """Basis of getRealSphericalHarmonics at cartesian points (M x 3), defined
+    at the origin as well
+    """
+    coords = cartToSpher(np.array(points, dtype = float))
+    spherHarm = getRealSphericalHarmonics(coords, maxOrder, r0)
+    # Only the constant term is non-zero at the origin
+    origin = np.isnan(coords[:,0])
+    spherHarm[origin] = 0
+    spherHarm[origin,0] = 1/np.sqrt(4*np.pi)
+    return spherHarm
+
+class SphericalHarmonicModel:
+    """Fitted spherical harmonic coefficients of one or more field columns
+
+    coeffs is a (maxOrder+1)**2 array, or (maxOrder+1)**2 x n_fields
+    r0 is the normalisation radius used for the fit, in the units of the points
+    The model is evaluated in chunks of bounded memory, streamed to map CSVs
+    with writeMap, and saved to and loaded from .npz files
+    """
+    def __init__(self, coeffs, r0, fieldNames = None):
+        self.coeffs = np.asarray(coeffs, dtype = float)
+        if self.coeffs.ndim == 1:
+            self.coeffs = self.coeffs[:,None]
+        self.maxOrder = int(np.sqrt(np.size(self.coeffs, 0))) - 1
+        if (self.maxOrder + 1)**2 != np.size(self.coeffs, 0):
+            raise ValueError(f'{np.size(self.coeffs, 0)} coefficients do not make up a complete order')
+        self.r0 = float(r0)
+        if fieldNames is None:
+            fieldNames = ['B0'] if np.size(self.coeffs, 1) == 1 else [f'B{k}' for k in range(np.size(self.coeffs, 1))]
+        self.fieldNames = list(fieldNames)
+
+    def save(self, fname):
+        """Save coefficients, r0, order and field names to a .npz file"""
+        np.savez(fname, coeffs = self.coeffs, r0 = self.r0, maxOrder = self.maxOrder, fieldNames = np.array(self.fieldNames))
+
+    @classmethod
+    def load(cls, fname):
+        data = np.load(fname)
+        return cls(data['coeffs'], data['r0'], [str(name) for name in data['fieldNames']])
+
+    def _basis(self, points):
+        return basisAt(points, self.maxOrder, self.r0)
+
+    def _evaluateChunk(self, points):
+        return self._basis(points) @ self.coeffs
+
+    def _chunks(self, points, chunkSize, workers):
+        """Fields of consecutive chunks of points, in order, with at most
+        workers chunks in memory at a time. workers = None uses every core
+        """
+        starts = range(0, len(points), chunkSize)
+        if workers == 1:
+            for start in starts:
+                yield start, self._evaluateChunk(points[start:start + chunkSize])
+            return
+        window = workers if workers is not None else (os.cpu_count() or 1)
+        with ThreadPoolExecutor(max_workers = window) as executor:
+            pending = []
+            for start in starts:
+                pending.append((start, executor.submit(self._evaluateChunk, points[start:start + chunkSize])))
+                if len(pending) >= window:
+                    start, future = pending.pop(0)
+                    yield start, future.result()
+            for start, future in pending:
+                yield start, future.result()
+
+    def evaluate(self, points, chunkSize = 20000, workers = 1):
+        """Fields at points (M x 3) as a M x n_fields array, computing the basis
+        for chunkSize points at a time, in workers parallel threads
+        """
+        fields = np.empty((len(points), np.size(self.coeffs, 1)))
+        for start, chunk in self._chunks(points, chunkSize, workers):
+            fields[start:start + len(chunk)] = chunk
+        return fields
+
+    def magnitude(self, points, chunkSize = 20000, workers = 1):
+        """|B| at points from the Bx, By and Bz columns"""
+        components = [self.fieldNames.index(name) for name in ('Bx', 'By', 'Bz')]
+        return np.linalg.norm(self.evaluate(points, chunkSize, workers)[:,components], axis = -1)
+
+    def writeMap(self, fname, points, chunkSize = 20000, workers = 1, magnitude = False):
+        """Evaluate the model at points and stream X, Y, Z and the fields to a
+        map CSV chunk by chunk
+        With magnitude = True a B0 column with |B| is written before the fields,
+        giving the 3-axis map format X, Y, Z, B0, Bx, By, Bz
+        """
+        if magnitude:
+            components = [self.fieldNames.index(name) for name in ('Bx', 'By', 'Bz')]
+        with open(fname, 'w') as f:
+            f.write(','.join(['X', 'Y', 'Z', *(['B0'] if magnitude else []), *self.fieldNames]) + '\n')
+            for start, chunk in self._chunks(points, chunkSize, workers):
+                if magnitude:
+                    chunk = np.concatenate((np.linalg.norm(chunk[:,components], axis = -1)[:,None], chunk), axis = 1)
+                np.savetxt(f, np.concatenate((points[start:start + len(chunk)], chunk), axis = 1), delimiter = ',', fmt = '%.10g')
+
+    def transformMatrix(self, matrix = None, offset = None):
+        """Matrix T such that T @ coeffs are the coefficients in the new
+        coordinates p' = matrix @ (p - offset)
+        matrix is any orthogonal 3x3 matrix (rotations, and reflections such as
+        flipping an axis), offset the new isocenter in the present coordinates
+
+        A harmonic polynomial of degree maxOrder stays one under rotation (the
+        Wigner-D matrices only mix terms of the same degree) and under translation
+        (the addition theorem only mixes in lower degrees), so T is exact. It is
+        computed by projecting the moved basis onto the basis with sphereQuadrature
+        on the sphere of radius r0
+        """
+        matrix = np.eye(3) if matrix is None else np.asarray(matrix, dtype = float)
+        offset = np.zeros(3) if offset is None else np.asarray(offset, dtype = float)
+        points, weights = sphereQuadrature(self.maxOrder, self.r0)
+        # On the sphere of radius r0 the basis is orthonormal over the solid angle
+        return (self._basis(points)*weights[:,None]).T @ self._basis(points @ matrix + offset)
+
+    def transformed(self, matrix = None, offset = None):
+        """Model in the new coordinates p' = matrix @ (p - offset)
+        Field columns named Bx, By and Bz are rotated with the coordinates
+        """
+        coeffs = self.transformMatrix(matrix, offset) @ self.coeffs
+        if matrix is not None and all(name in self.fieldNames for name in ('Bx', 'By', 'Bz')):
+            components = [self.fieldNames.index(name) for name in ('Bx', 'By', 'Bz')]
+            coeffs[:,components] = coeffs[:,components] @ np.asarray(matrix, dtype = float).T
+        return SphericalHarmonicModel(coeffs, self.r0, self.fieldNames)
+
+    def homogeneity(self, diameter, center = None, column = 0):
+        """Std dev and peak-to-peak of a field column over the surface of a DSV
+        of the given diameter about center, in ppm of the mean field
+        The std dev is exact for the model, the peak-to-peak is sampled on the
+        quadrature points
+        """
+        center = np.zeros(3) if center is None else np.asarray(center, dtype = float)
+        points, weights = sphereQuadrature(self.maxOrder + 1, diameter/2)
+        field = self._basis(points + center) @ self.coeffs[:,column]
+        mean = np.sum(weights*field)/np.sum(weights)
+        std = np.sqrt(np.sum(weights*np.square(field - mean))/np.sum(weights))
+        return std/abs(mean)*1e6, np.ptp(field)/abs(mean)*1e6
+
+    def findIsocenter(self, diameter, column = 0, metric = 'std'):
+        """Offset of the DSV center that minimizes the std dev or peak-to-peak
+        (metric = 'std' or 'ptp') of a field column over a DSV of the given diameter
+        Returns the offset, to use with transformed(offset = offset)
+        """
+        from scipy.optimize import minimize
+        index = 0 if metric == 'std' else 1
+        result = minimize(lambda center: self.homogeneity(diameter, center, column)[index], np.zeros(3),
+                          method = 'Nelder-Mead', options = {'xatol': 1e-3*diameter, 'fatol': 1e-3})
+        return result.x
+
+class RecursiveSphericalHarmonicFit:
+    """Least squares fit of one field column, updated as points are measured
+
+    Points are added one at a time or in small batches with update(). Until
+    the basis is determined (at least (maxOrder+1)**2 points spread enough to
+    make the normal equations well conditioned) the normal equations are
+    accumulated. After that the coefficients and their covariance are updated
+    by recursive least squares, which costs O(nTerms^2) per point however many
+    points were measured before, and gives the same coefficients as a batch fit
+    of all points.
+
+    r0 is the normalisation radius and diameter the DSV over which the
+    homogeneity and the uncertainty of the fitted field are estimated, both
+    fixed in advance (the radius and diameter of the planned map). The fit has
+    converged once the RMS standard error of the fitted field over the DSV
+    surface is below tolerance ppm of the mean field. The noise is estimated
+    from the residuals, which with few points more than terms say little about
+    the field between the points, so convergence needs at least minPoints
+    points, 2 (maxOrder+1)**2 by default.
+    """
+    def __init__(self, maxOrder, r0, diameter, tolerance = 1., minPoints = None):
+        self.maxOrder = maxOrder
+        self.nTerms = (maxOrder + 1)**2
+        self.r0 = float(r0)
+        self.diameter = diameter
+        self.tolerance = tolerance
+        self.minPoints = 2*self.nTerms if minPoints is None else minPoints
+        self.nPoints = 0
+        self.convergedAt = None
+        self.coeffs = None
+        self._gram = np.zeros((self.nTerms, self.nTerms))
+        self._rhs = np.zeros(self.nTerms)
+        self._points = [] # Basis rows and values until the recursive updates start
+        self._sumSquares = 0.
+        self._nextAttempt = self.nTerms
+        self._P = None
+        # Exact average of h^T P h over the DSV surface is trace(P @ surfaceGram)
+        points, weights = sphereQuadrature(maxOrder, diameter/2)
+        surfaceBasis = basisAt(points, maxOrder, self.r0)
+        self._surfaceBasis = surfaceBasis
+        self._surfaceWeights = weights/np.sum(weights)
+        self._surfaceGram = (surfaceBasis*self._surfaceWeights[:,None]).T @ surfaceBasis
+
+    def _initialize(self):
+        """Switch from the normal equations to recursive updates once they are well conditioned"""
+        eigenvalues = np.linalg.eigvalsh(self._gram)
+        if eigenvalues[0] <= eigenvalues[-1]*1e-10:
+            return
+        self._P = np.linalg.inv(self._gram)
+        self._P = (self._P + self._P.T)/2
+        self.coeffs = self._P @ self._rhs
+        # From the residuals themselves, y^T y - c^T A^T y cancels to rounding noise
+        H = np.concatenate([H for H, _ in self._points])
+        y = np.concatenate([y for _, y in self._points])
+        self._sumSquares = np.sum(np.square(H @ self.coeffs - y))
+        self._gram = self._rhs = self._points = None
+
+    def update(self, points, values):
+        """Add measured points (k x 3, or 3 for a single point) and their field values"""
+        H = basisAt(np.atleast_2d(points), self.maxOrder, self.r0)
+        y = np.atleast_1d(np.asarray(values, dtype = float))
+        self.nPoints += len(y)
+        if self._P is None:
+            self._gram += H.T @ H
+            self._rhs += H.T @ y
+            self._points.append((H, y))
+            if self.nPoints >= self._nextAttempt:
+                # The eigenvalue check is O(nTerms^3), so it is tried once per nTerms/4 points
+                self._nextAttempt = self.nPoints + max(self.nTerms//4, 1)
+                self._initialize()
+        else:
+            PHt = self._P @ H.T
+            S = H @ PHt + np.eye(len(y))
+            gain = solve(S, PHt.T, assume_a = 'pos').T
+            innovation = y - H @ self.coeffs
+            self.coeffs = self.coeffs + gain @ innovation
+            self._sumSquares += innovation @ solve(S, innovation, assume_a = 'pos')
+            self._P = self._P - gain @ PHt.T
+            self._P = (self._P + self._P.T)/2
+        if (self.convergedAt is None and self.nPoints >= self.minPoints and self.fieldUncertainty() is not None
+                and self.fieldUncertainty() < self.tolerance):
+            self.convergedAt = self.nPoints
+
+    def noiseVariance(self):
+        """Residual variance of the points about the fit, None until there are more points than terms"""
+        if self._P is None or self.nPoints <= self.nTerms:
+            return None
+        return max(self._sumSquares, 0)/(self.nPoints - self.nTerms)
+
+    def covariance(self):
+        """Covariance of the coefficients"""
+        noiseVariance = self.noiseVariance()
+        return None if noiseVariance is None else noiseVariance*self._P
+
+    def meanField(self):
+        return self._surfaceWeights @ (self._surfaceBasis @ self.coeffs)
+
+    def fieldUncertainty(self):
+        """RMS standard error of the fitted field over the DSV surface, in ppm of the mean field"""
+        noiseVariance = self.noiseVariance()
+        if noiseVariance is None:
+            return None
+        return np.sqrt(noiseVariance*np.sum(self._P*self._surfaceGram))/abs(self.meanField())*1e6
+
+    def homogeneity(self):
+        """Present estimate of the std dev and peak-to-peak over the DSV in ppm, as SphericalHarmonicModel.homogeneity"""
+        if self.coeffs is None:
+            return None
+        return self.model().homogeneity(self.diameter)
+
+    def model(self):
+        return SphericalHarmonicModel(self.coeffs, self.r0)
+
+if __name__ == "__main__":
+    import time
+    from scipy.special import sph_harm
+
+    def getRealSphericalHarmonics_sph_harm(coords, maxOrder):
+        """Term by term construction with scipy.special.sph_harm for comparison"""
+        r0          = np.nanmean(coords[...,0])
+        spherHarm   = np.zeros((np.shape(coords[...,0]) + ((maxOrder + 1)**2,)))
+        idx         = 0
+        for n in range(maxOrder+1):
+            for m in range(-n,n+1):
+                if m < 0:
+                    spherHarm[...,idx] = ((1j/np.sqrt(2))*(np.divide(coords[...,0],r0)**n)*(sph_harm(m,n,coords[...,2], coords[...,1])-((-1)**m)*sph_harm(-m,n,coords[...,2], coords[...,1]))).real
+                elif m > 0:
+                    spherHarm[...,idx] = ((1/np.sqrt(2))*(np.divide(coords[...,0],r0)**n)*(sph_harm(-m,n,coords[...,2], coords[...,1])+((-1)**m)*sph_harm(m,n,coords[...,2], coords[...,1]))).real
+                else:
+                    spherHarm[...,idx] = np.multiply(sph_harm(m,n,coords[...,2], coords[...,1]),np.divide(coords[...,0],r0)**n).real
+                idx += 1
+        return spherHarm
+
+    rawData = np.genfromtxt('NIST_Smallbach_Swap_Centered.csv', dtype = float, delimiter = ',', skip_header = 1)[:,:4]
+    spher_coords = cartToSpher(rawData[:,:3])
+
+    for maxOrder in (15, 30):
+        start_time = time.time()
+        reference = getRealSphericalHarmonics_sph_harm(spher_coords, maxOrder)
+        sph_harm_time = time.time() - start_time
+
+        start_time = time.time()
+        spherHarm = getRealSphericalHarmonics(spher_coords, maxOrder)
+        recurrence_time = time.time() - start_time
+
+        error = np.nanmax(np.abs(spherHarm - reference))/np.nanmax(np.abs(reference))
+        print(f'Order {maxOrder}: sph_harm {sph_harm_time:.3f} s, recurrence {recurrence_time:.3f} s, max deviation {error:.1e}')
+
+    # The NIST map fit, sampled on quadrature grids of its order and lower
+    maxOrder = 15
+    fit = SphericalHarmonicModel(fitMaps(rawData[:,:3], rawData[:,3:], maxOrder), np.nanmean(spher_coords[:,0]))
+    points, _ = sphereQuadrature(maxOrder, fit.r0)
+    values = fit.evaluate(points)[:,0]
+    start_time = time.time()
+    coeffs = quadratureTransform(values, maxOrder, fit.r0)
+    quadrature_time = time.time() - start_time
+    start_time = time.time()
+    fitMaps(points, values[:,None], maxOrder)
+    lstsq_time = time.time() - start_time
+    print(f'Quadrature transform of {len(points)} points {quadrature_time*1e3:.1f} ms, least squares {lstsq_time*1e3:.1f} ms, '
+          f'max coefficient deviation {np.max(np.abs(coeffs - fit.coeffs[:,0]))/abs(fit.coeffs[0,0]):.1e}')
+    for gridOrder in (maxOrder, 10, 6):
+        diagnostics = aliasingDiagnostics(fit.evaluate(sphereQuadrature(gridOrder, fit.r0)[0])[:,0], gridOrder, fit.r0)
+        print(f'Order {gridOrder} grid: residual {diagnostics["residual"]:.2f} ppm, Nyquist term {diagnostics["nyquist"]:.2f} ppm, '
+              f'top degree {diagnostics["topDegreeFraction"]*100:.1f}% of the power')
+
+    # Live fits of the map streamed in random orders must not converge before the points determine the
+    # field: once converged, they agree with the batch fit of all points to a few times the tolerance
+    tolerance = 50
+    points, weights = sphereQuadrature(15, 50)
+    for maxOrder in (9, 12):
+        batch = SphericalHarmonicModel(fitMaps(rawData[:,:3], rawData[:,3:], maxOrder), np.nanmean(spher_coords[:,0]))
+        for seed in range(6):
+            stream = rawData[np.random.default_rng(seed).permutation(len(rawData))]
+            liveFit = RecursiveSphericalHarmonicFit(maxOrder, 50, 100, tolerance)
+            for start in range(0, len(stream), 20):
+                liveFit.update(stream[start:start + 20,:3], stream[start:start + 20,3])
+                if liveFit.convergedAt is not None:
+                    break
+            error = np.sqrt(np.average(np.square(liveFit.model().evaluate(points) - batch.evaluate(points))[:,0],
+                                       weights = weights))/abs(batch.coeffs[0,0])*1e6
+            print(f'Live fit order {maxOrder}, stream {seed}: converged after {liveFit.convergedAt} points, '
+                  f'{error:.1f} ppm from the batch fit')
+            assert liveFit.convergedAt is not None and error < 3*tolerance, f'False convergence of stream {seed}'